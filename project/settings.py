@@ -41,11 +41,13 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'webapp.metrics.MetricsMiddleware',  # First, so it times the whole stack
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'webapp.routers.PrimaryPinningMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -78,9 +80,23 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
-    }
+    },
+    # Read alias for admin lists and reports (see webapp/routers.py). Point NAME at a copy
+    # kept in sync with the primary (e.g. Litestream, or a PostgreSQL streaming replica);
+    # by default it opens a separate connection to the primary file.
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'db.sqlite3',
+        'TEST': {'MIRROR': 'default'},
+    },
 }
 
+DATABASE_ROUTERS = ['webapp.routers.ReadReplicaRouter']
+
+DATABASE_READ_ALIAS = 'replica'
+
+DATABASE_REPLICA_STALENESS = 5  # Seconds a session keeps reading from the primary after a write
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
@@ -126,3 +142,87 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 # User session
 
 SESSION_EXPIRE_AT_BROWSER_CLOSE = True  # Enable browser-session cookies
+
+# Access policy
+
+ACCESS_POLICY_TTL = 60  # Seconds a compiled access policy is reused at most (changes from any process apply to the next swipe), 0 resolves every swipe with one query
+
+# Access records are buffered in memory and written in batches (see webapp/writebehind.py)
+
+ACCESS_LOG = {
+    'BUFFERED': True,
+    'BATCH_SIZE': 200,
+    'FLUSH_INTERVAL': 1.0,  # Seconds
+    'QUEUE_SIZE': 10000,
+    'BACKPRESSURE': 'block',  # 'block' waits up to BLOCK_TIMEOUT for room, 'sync' inserts inline
+    'BLOCK_TIMEOUT': 2.0,  # Seconds
+    'SPOOL_DIR': BASE_DIR / 'spool',  # Crash-safe spool, replayed on the next start
+}
+
+# Admin activity (the audit trail) goes through the same write-behind log, spooled next to the access records
+
+AUDIT_LOG = {
+    'BUFFERED': True,
+    'BATCH_SIZE': 200,
+    'FLUSH_INTERVAL': 1.0,  # Seconds
+    'QUEUE_SIZE': 10000,
+    'BACKPRESSURE': 'block',
+    'BLOCK_TIMEOUT': 2.0,  # Seconds
+    'SPOOL_DIR': BASE_DIR / 'spool',
+}
+
+# Cards past their due date are flagged by `manage.py expire_cards`, or by a timer (see webapp/expiry.py)
+
+CARD_EXPIRY = {
+    'SWEEPER': False,  # True runs the timer in every process serving the app
+    'INTERVAL': 300,  # Seconds between sweeps when no card expires sooner
+}
+
+# Device heartbeats (/auth/heartbeat) are coalesced in memory and written in bulk (see webapp/heartbeat.py)
+
+HEARTBEAT = {
+    'FLUSH_INTERVAL': 30,  # Seconds, each device is written at most once per interval
+    'STALE_AFTER': 120,  # Seconds without a heartbeat before the device list flags a device
+}
+
+# Offline allowlists are synced off the request path, once per burst of changes (see webapp/allowlist.py)
+
+ALLOWLIST = {
+    'DELAY': 2,  # Seconds changes are coalesced before their locks are synced
+}
+
+# Optional reader gateway, `manage.py gateway`: swipes over a compact binary protocol on TCP and UDP (see webapp/gateway.py)
+
+GATEWAY = {
+    'HOST': '127.0.0.1',
+    'PORT': 8700,  # Shared by TCP and UDP
+    'WORKERS': 4,  # Threads deciding swipes
+    'IDLE_TIMEOUT': 300,  # Seconds
+}
+
+# Live feed of access and activity records at /events, served by the ASGI application (see webapp/events.py)
+
+EVENT_STREAM = {
+    'POLL_INTERVAL': 2,  # Seconds, how late records written by other processes may reach the stream
+    'CLIENT_QUEUE': 200,  # Events a client may lag behind before it is disconnected (it resumes from the database)
+    'REPLAY_LIMIT': 500,  # Records per table replayed on reconnect
+    'KEEPALIVE': 15,  # Seconds
+}
+
+# Admin pages cache rendered fragments, keyed by per-model generations (see webapp/fragments.py).
+# The generations live in the database, a per-process cache only costs extra renders.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+}
+
+# PDF reports are rendered by a pool of worker processes and cached on disk (see webapp/jobs.py)
+REPORT_JOBS = {
+    'WORKERS': 2,  # 0 renders inline in the request
+    'TIMEOUT': 300,  # Seconds
+    'ARTIFACT_DIR': BASE_DIR / 'reports',
+    'MAX_BYTES': 500 * 1024 * 1024,
+    'MAX_AGE': 7 * 24 * 3600,  # Seconds since the last download
+}
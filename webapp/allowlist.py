@@ -0,0 +1,240 @@
+import atexit
+import hashlib
+import logging
+import os
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from webapp.models import AllowlistEntry
+from webapp.models import Lock
+from webapp.policy import AccessPolicy
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+  'BUFFERED': True,   # False syncs inline as soon as the transaction commits
+  'DELAY': 2,         # Seconds changes are coalesced before the allowlists are synced
+}
+
+# Scope of a sync covering every lock; other scopes are `(lock ids, lock group ids)` pairs of sets
+EVERY_LOCK = None
+
+# Scope of the changes of the current transaction, set by `schedule_sync` and cleared when they commit
+_dirty = threading.local()
+
+
+def options():
+  return {**DEFAULTS, **getattr(settings, 'ALLOWLIST', {})}
+
+
+def card_hash(card_uuid):
+  """
+  Hashes a card uuid the way door devices do before looking it up offline.
+
+  Args:
+      card_uuid: The uuid read from the card.
+
+  Returns:
+      The first 128 bits of the SHA-256 of the uuid, as 32 hex characters.
+  """
+  return hashlib.sha256(card_uuid.encode()).hexdigest()[:32]
+
+
+def build(lock_mask, access_policy, now=None):
+  """Returns `{card_hash: (due_date, override_lock_pin)}` for every unexpired card allowed on a lock."""
+  now = now or timezone.now()
+  entries = {}
+  for card_uuid, card in access_policy.cards.items():
+    # Cards without a due date are never valid, see `AccessPolicy.decide`
+    if card.due_date is None or card.due_date < now:
+      continue
+    if card.lock_group_mask and card.lock_group_mask & lock_mask:
+      entries[card_hash(card_uuid)] = (card.due_date, card.override_lock_pin)
+  return entries
+
+
+@transaction.atomic
+def sync(locks=None):
+  """
+  Brings the stored allowlists up to date with the current access policy.
+
+  Every lock is diffed against what its groups grant today. Only locks whose
+  entries actually changed get a new version, so devices keep syncing empty
+  deltas for unrelated edits.
+
+  Args:
+      locks: Optional queryset restricting the locks to sync.
+
+  Returns:
+      The number of locks whose version was bumped.
+  """
+  access_policy = AccessPolicy.compile()
+  locks = (locks if locks is not None else Lock.objects.all()).select_for_update()
+
+  now = timezone.now()
+  bumped = 0
+  for lock in locks.only('id', 'group_mask', 'allowlist_version'):
+    desired = build(lock.group_mask, access_policy, now)
+    current = {entry.card_hash: entry for entry in lock.allowlist_entries.all()}
+    version = lock.allowlist_version + 1
+
+    created, updated = [], []
+    for digest, (due_date, override) in desired.items():
+      entry = current.get(digest)
+      if entry is None:
+        created.append(AllowlistEntry(lock=lock, card_hash=digest, due_date=due_date, override_lock_pin=override, version=version))
+      elif entry.revoked or entry.due_date != due_date or entry.override_lock_pin != override:
+        entry.due_date, entry.override_lock_pin, entry.revoked, entry.version = due_date, override, False, version
+        updated.append(entry)
+    for digest, entry in current.items():
+      if digest not in desired and not entry.revoked:
+        entry.revoked, entry.version = True, version
+        updated.append(entry)
+
+    if created or updated:
+      AllowlistEntry.objects.bulk_create(created)
+      AllowlistEntry.objects.bulk_update(updated, ['due_date', 'override_lock_pin', 'revoked', 'version'])
+      Lock.objects.filter(pk=lock.pk).update(allowlist_version=version)
+      bumped += 1
+  return bumped
+
+
+def merge(scope, other):
+  """Returns the scope covering the locks of both scopes."""
+  if scope is EVERY_LOCK or other is EVERY_LOCK:
+    return EVERY_LOCK
+  return (scope[0] | other[0], scope[1] | other[1])
+
+
+def scoped_locks(scope):
+  """Returns the locks of a scope: the given locks, and the current members of the given lock groups."""
+  if scope is EVERY_LOCK:
+    return Lock.objects.all()
+  lock_ids, lock_group_ids = scope
+  members = Lock.groups.through.objects.filter(lockgroup_id__in=lock_group_ids).values('lock_id')
+  return Lock.objects.filter(Q(pk__in=lock_ids) | Q(pk__in=members))
+
+
+class SyncBuffer:
+  """Coalesces allowlist syncs and runs them off the request path.
+
+  A sync compiles the whole access policy and diffs every lock of its scope,
+  too much to pay on each admin save. Committed changes only merge their
+  scope into the pending one and arm a timer; `DELAY` seconds later a single
+  sync covers every change of the interval. A process dying in between
+  loses its pending scope, which the next sync of every lock (e.g.
+  `rebuild_lock_masks`) repairs, the sync being a diff.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._pid = None
+    self._pending = ()  # Scope waiting to be synced, () when there is none
+    self._timer = None
+
+  def request(self, scope=EVERY_LOCK):
+    """Syncs the locks of `scope`, returning without touching the database when buffered."""
+    opts = options()
+    if not opts['BUFFERED']:
+      sync(scoped_locks(scope))
+      return
+
+    with self._lock:
+      if self._pid != os.getpid():
+        # First use in this process (or first use after a fork)
+        if self._pid is None:
+          atexit.register(self.flush)
+        self._pending = ()
+        self._timer = None
+        self._pid = os.getpid()
+      self._pending = scope if self._pending == () else merge(self._pending, scope)
+      if self._timer is None:
+        self._timer = threading.Timer(opts['DELAY'], self._flush_due)
+        self._timer.daemon = True
+        self._timer.start()
+
+  def pending(self):
+    """Whether changes are waiting to be synced."""
+    return self._pending != ()
+
+  def flush(self):
+    """Runs the pending sync from the calling thread, returning the number of locks bumped."""
+    with self._lock:
+      scope, self._pending = self._pending, ()
+      if self._timer is not None:
+        self._timer.cancel()
+        self._timer = None
+    if scope == ():
+      return 0
+    return sync(scoped_locks(scope))
+
+  def _flush_due(self):
+    try:
+      self.flush()
+    except Exception:
+      logger.exception("Could not sync the allowlists")
+    finally:
+      close_old_connections()
+
+
+syncs = SyncBuffer()
+
+
+def _sync_committed():
+  # Several changes in one transaction each register a callback, the first one does the work
+  if hasattr(_dirty, 'scope'):
+    scope = _dirty.scope
+    del _dirty.scope
+    syncs.request(scope)
+
+
+def schedule_sync(locks=None, lock_groups=None):
+  """
+  Syncs the allowlists once the current transaction commits.
+
+  Every lock is synced unless the change names the locks it touches, which
+  it cannot always tell (e.g. a card moving to another user).
+
+  Args:
+      locks: Optional ids of the locks the change touches.
+      lock_groups: Optional ids of the lock groups whose locks it touches.
+  """
+  if locks is None and lock_groups is None:
+    scope = EVERY_LOCK
+  else:
+    scope = (set(locks or ()), set(lock_groups or ()))
+  _dirty.scope = merge(_dirty.scope, scope) if hasattr(_dirty, 'scope') else scope
+  transaction.on_commit(_sync_committed)
+
+
+def delta(lock, since):
+  """
+  Describes how a device holding version `since` of a lock allowlist gets to the current one.
+
+  Args:
+      lock: The lock driven by the device.
+      since: The version the device already holds, 0 for none.
+
+  Returns:
+      A dict with the current `version`, whether it is a `full` list, the
+      `grant` entries as `[card_hash, due_timestamp, override]` and the
+      `revoke`d card hashes.
+  """
+  version = lock.allowlist_version
+  full = since <= 0 or since > version
+  entries = lock.allowlist_entries.all() if full else lock.allowlist_entries.filter(version__gt=since)
+
+  grant, revoke = [], []
+  for digest, due_date, override, revoked in entries.values_list('card_hash', 'due_date', 'override_lock_pin', 'revoked'):
+    if revoked:
+      if not full:
+        revoke.append(digest)
+    else:
+      grant.append([digest, int(due_date.timestamp()) if due_date else None, int(override)])
+  return {'version': version, 'full': full, 'grant': grant, 'revoke': revoke}
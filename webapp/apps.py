@@ -4,3 +4,12 @@ from django.apps import AppConfig
 class WebappConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'webapp'
+
+    def ready(self):
+        # Connect the model signal handlers
+        from webapp import signals  # noqa: F401
+
+        # Opt-in, so only the processes meant to sweep (e.g. one web worker) do
+        from webapp import expiry
+        if expiry.options()['SWEEPER']:
+            expiry.sweeper.start()
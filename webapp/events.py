@@ -0,0 +1,250 @@
+import asyncio
+import json
+import logging
+import threading
+
+from collections import namedtuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import close_old_connections
+from django.db import connection
+from django.db import transaction
+from django.db.models import Max
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+  'POLL_INTERVAL': 2,    # Seconds between reads of the records written by other processes
+  'CLIENT_QUEUE': 200,   # Events a client may lag behind before it is disconnected to resume later
+  'REPLAY_LIMIT': 500,   # Records per table read at a time, a resuming client reconnects for more
+  'KEEPALIVE': 15,       # Seconds of silence before a comment line keeps proxies from closing the stream
+  'RETRY': 3000,         # Milliseconds browsers wait before reconnecting
+}
+
+ACCESS = 'access'
+ACTIVITY = 'activity'
+
+# One streamed record: its kind, primary key and fields (as exported, see webapp/exports.py)
+Event = namedtuple('Event', ['kind', 'pk', 'data'])
+
+# Last record of each kind a client has seen, sent back as Last-Event-ID when it reconnects
+Cursor = namedtuple('Cursor', [ACCESS, ACTIVITY])
+
+# Queued in place of events once a client lags too far behind
+OVERFLOW = None
+
+
+def options():
+  return {**DEFAULTS, **getattr(settings, 'EVENT_STREAM', {})}
+
+
+def parse_cursor(value):
+  """Parses a Last-Event-ID of the form '<access pk>:<activity pk>', None when missing or malformed."""
+  try:
+    access, activity = (int(part) for part in value.split(':'))
+  except (AttributeError, ValueError):
+    return None
+  return Cursor(access, activity)
+
+
+def _records(kind):
+  from webapp import exports
+  from webapp.models import AccessRecord
+  from webapp.models import ActivityRecord
+
+  if kind == ACCESS:
+    return AccessRecord.objects.select_related('lock__device', 'card__user'), exports.ACCESS_COLUMNS, exports.access_row
+  return ActivityRecord.objects.select_related('user'), exports.ACTIVITY_COLUMNS, exports.activity_row
+
+
+def replay(cursor, limit):
+  """
+  Loads the records written after a cursor, in the order they happened.
+
+  Returns:
+      `(events, complete)`, `complete` being False when a table had more
+      than `limit` records to send.
+  """
+  events, complete = [], True
+  for kind in (ACCESS, ACTIVITY):
+    records, columns, to_row = _records(kind)
+    rows = list(records.filter(pk__gt=getattr(cursor, kind)).order_by('pk')[:limit + 1])
+    complete = complete and len(rows) <= limit
+    events.extend(Event(kind, record.pk, dict(zip(columns, to_row(record)))) for record in rows[:limit])
+  events.sort(key=lambda event: event.data['timestamp'])
+  return events, complete
+
+
+def latest_cursor():
+  """Returns the cursor of the newest records, where a fresh client starts from."""
+  from webapp.models import AccessRecord
+  from webapp.models import ActivityRecord
+
+  return Cursor(
+    AccessRecord.objects.aggregate(last=Max('pk'))['last'] or 0,
+    ActivityRecord.objects.aggregate(last=Max('pk'))['last'] or 0,
+  )
+
+
+def encode(event, cursor):
+  data = json.dumps(event.data, cls=DjangoJSONEncoder)
+  return f"id: {cursor.access}:{cursor.activity}\nevent: {event.kind}\ndata: {data}\n\n"
+
+
+class Subscription:
+  """Events waiting to be streamed to one client, filled from any thread."""
+
+  def __init__(self, loop, limit):
+    self.loop = loop
+    self.limit = limit
+    self.queue = asyncio.Queue()
+    self.overflowed = False
+
+  def push(self, events):
+    self.loop.call_soon_threadsafe(self._put, events)
+
+  def _put(self, events):
+    # Runs in the event loop of the client
+    if self.overflowed:
+      return
+    if self.queue.qsize() + len(events) > self.limit:
+      # Holding on to more would let one slow client grow the worker's memory unbounded
+      self.overflowed = True
+      self.queue.put_nowait(OVERFLOW)
+      return
+    for event in events:
+      self.queue.put_nowait(event)
+
+
+class Broker:
+  """Publishes newly written records to the streams of this process.
+
+  One poller thread reads the records written after the newest one it has
+  seen and pushes each of them once to every connected client. It reads
+  every `POLL_INTERVAL` seconds, so the records other processes write
+  (other workers, the gateway, the write-behind flushers) are streamed too,
+  and at once when woken by a write of this process. The poller only runs
+  while some client is connected: an unwatched dashboard costs nothing.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._subscriptions = set()
+    self._written = threading.Event()
+    self._thread = None
+
+  def subscribe(self, loop, limit):
+    """Subscribes a client, starting the poller from the newest records when it is the first one."""
+    subscription = Subscription(loop, limit)
+    with self._lock:
+      self._subscriptions.add(subscription)
+      if self._thread is None:
+        # Read before returning, so the client's own first read cannot miss a record written meanwhile
+        self._thread = threading.Thread(target=self._poll, args=(latest_cursor(),), name='event-poller', daemon=True)
+        self._thread.start()
+    return subscription
+
+  def unsubscribe(self, subscription):
+    with self._lock:
+      self._subscriptions.discard(subscription)
+
+  def has_subscribers(self):
+    return bool(self._subscriptions)
+
+  def notify(self):
+    """Wakes the poller up, records were written by this process."""
+    self._written.set()
+
+  def publish(self, events):
+    """Sends events to every connected client."""
+    with self._lock:
+      subscriptions = list(self._subscriptions)
+    for subscription in subscriptions:
+      try:
+        subscription.push(events)
+      except RuntimeError:
+        # The client's event loop is gone
+        self.unsubscribe(subscription)
+
+  def _poll(self, cursor):
+    try:
+      while True:
+        self._written.wait(options()['POLL_INTERVAL'])
+        # Cleared before reading, so a write committed meanwhile wakes the poller again
+        self._written.clear()
+        with self._lock:
+          if not self._subscriptions:
+            self._thread = None
+            return
+        try:
+          complete = False
+          while not complete:
+            events, complete = replay(cursor, options()['REPLAY_LIMIT'])
+            for event in events:
+              cursor = cursor._replace(**{event.kind: max(event.pk, getattr(cursor, event.kind))})
+            if events:
+              self.publish(events)
+        except Exception:
+          # Streaming is best effort, the next round reads from the same cursor
+          logger.exception("Could not read new records to stream")
+        finally:
+          close_old_connections()
+    finally:
+      connection.close()
+
+
+broker = Broker()
+
+
+def published():
+  """Wakes the poller once the current transaction commits."""
+  if broker.has_subscribers():
+    transaction.on_commit(broker.notify)
+
+
+async def stream(cursor=None):
+  """
+  Yields the Server-Sent Events of new access and activity records.
+
+  A client resuming with a cursor first gets the records it missed, read
+  from the database once, so reconnecting to another worker or after a
+  restart loses nothing. Then it waits on the events the broker publishes.
+  A client lagging `CLIENT_QUEUE` events behind is cut off and catches up
+  the same way once its browser reconnects.
+
+  Args:
+      cursor: The `Cursor` of the last event the client received, if any.
+  """
+  opts = options()
+  subscription = await sync_to_async(broker.subscribe)(asyncio.get_running_loop(), opts['CLIENT_QUEUE'])
+  try:
+    yield f"retry: {opts['RETRY']}\n\n"
+
+    # Subscribed first, so nothing written meanwhile falls between the replay and the live events
+    if cursor is None:
+      cursor = await sync_to_async(latest_cursor)()
+    else:
+      events, complete = await sync_to_async(replay)(cursor, opts['REPLAY_LIMIT'])
+      for event in events:
+        cursor = cursor._replace(**{event.kind: max(event.pk, getattr(cursor, event.kind))})
+        yield encode(event, cursor)
+      if not complete:
+        return  # The browser reconnects right away for the rest
+
+    while True:
+      try:
+        event = await asyncio.wait_for(subscription.queue.get(), opts['KEEPALIVE'])
+      except asyncio.TimeoutError:
+        yield ": keepalive\n\n"
+        continue
+      if event is OVERFLOW:
+        return
+      if event.pk <= getattr(cursor, event.kind):
+        continue  # Already replayed
+      cursor = cursor._replace(**{event.kind: event.pk})
+      yield encode(event, cursor)
+  finally:
+    broker.unsubscribe(subscription)
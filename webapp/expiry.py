@@ -0,0 +1,119 @@
+import logging
+import threading
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db import transaction
+from django.utils import timezone
+
+from webapp import allowlist
+from webapp.models import ActivityRecord
+from webapp.models import Card
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+  'SWEEPER': False,  # Run the in-process timer, in the processes that should sweep
+  'INTERVAL': 300,   # Seconds between sweeps when no card expires sooner
+  'MIN_DELAY': 1.0,  # Seconds the timer waits at least between two sweeps
+}
+
+
+def options():
+  return {**DEFAULTS, **getattr(settings, 'CARD_EXPIRY', {})}
+
+
+def sweep(now=None):
+  """
+  Marks the cards whose due date has passed as expired, in one UPDATE.
+
+  Live cards are found through the partial index on their due date, so a sweep
+  only reads the cards crossing expiry since the previous one. One
+  ActivityRecord summarizes the sweep, and the allowlists are synced so
+  devices drop the expired cards. The access policy is left alone: it
+  checks the due date of every swipe already.
+
+  Args:
+      now: Time to expire cards at, defaults to the current time.
+
+  Returns:
+      The number of cards expired.
+  """
+  now = now or timezone.now()
+  with transaction.atomic():
+    count = Card.objects.filter(expired=False, due_date__lte=now).update(expired=True)
+    if count:
+      ActivityRecord.objects.create(type=ActivityRecord.Type.UPDATE, message=f"{count} cards expired")
+      # `update()` sends no post_save; only the allowlists are stale, see `AccessPolicy.decide`
+      allowlist.schedule_sync()
+  return count
+
+
+def next_expiry(now=None):
+  """Returns when the next live card expires, or None, with one index seek."""
+  now = now or timezone.now()
+  live = Card.objects.filter(expired=False, due_date__gt=now).order_by('due_date')
+  return live.values_list('due_date', flat=True).first()
+
+
+def expiring(window, now=None):
+  """Returns the live cards crossing their due date within `window` (a timedelta) from now."""
+  now = now or timezone.now()
+  return Card.objects.filter(expired=False, due_date__gt=now, due_date__lte=now + window)
+
+
+class Sweeper:
+  """Runs `sweep` from a daemon thread, waking up right when the next card expires.
+
+  After every sweep the timer sleeps until the next due date, or for
+  `INTERVAL` seconds if that comes first, so cards created meanwhile are
+  still picked up in time.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._stop = threading.Event()
+    self._thread = None
+
+  def start(self):
+    with self._lock:
+      if self._thread is not None and self._thread.is_alive():
+        return
+      self._stop.clear()
+      self._thread = threading.Thread(target=self._run, name='card-expiry-sweeper', daemon=True)
+      self._thread.start()
+
+  def stop(self):
+    self._stop.set()
+    if self._thread is not None:
+      self._thread.join()
+
+  def delay(self):
+    """Seconds until the next sweep is due."""
+    opts = options()
+    now = timezone.now()
+    upcoming = next_expiry(now)
+    delay = opts['INTERVAL']
+    if upcoming is not None:
+      delay = min(delay, (upcoming - now) / timedelta(seconds=1))
+    return max(delay, opts['MIN_DELAY'])
+
+  def _run(self):
+    delay = options()['MIN_DELAY']
+    while not self._stop.wait(delay):
+      try:
+        expired = sweep()
+        if expired:
+          logger.info("Expired %d cards", expired)
+        delay = self.delay()
+      except Exception:
+        logger.exception("Could not sweep expired cards")
+        delay = options()['INTERVAL']
+      finally:
+        close_old_connections()
+
+
+sweeper = Sweeper()
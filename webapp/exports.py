@@ -0,0 +1,122 @@
+import csv
+import json
+
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+
+from webapp.models import AccessRecord
+from webapp.models import ActivityRecord
+
+
+# Rows fetched from the database at a time, overridable with `EXPORT_CHUNK_SIZE`
+CHUNK_SIZE = 2000
+
+FORMATS = {
+  'csv': 'text/csv; charset=utf-8',
+  'ndjson': 'application/x-ndjson',
+}
+
+ACCESS_COLUMNS = ('id', 'timestamp', 'lock', 'device', 'card', 'user', 'is_locked')
+ACTIVITY_COLUMNS = ('id', 'timestamp', 'type', 'message', 'user')
+
+
+def access_records(lock=None, card=None, user=None, since=None, until=None):
+  """Returns the access records matching a lock name, card uuid, username and `[since, until)` window."""
+  records = AccessRecord.objects.select_related('lock__device', 'card__user').order_by('timestamp')
+  if lock:
+    records = records.filter(lock__name=lock)
+  if card:
+    records = records.filter(card__uuid=card)
+  if user:
+    records = records.filter(card__user__username=user)
+  return _window(records, since, until)
+
+
+def activity_records(user=None, type=None, since=None, until=None):
+  """Returns the activity records matching a username, type and `[since, until)` window."""
+  records = ActivityRecord.objects.select_related('user').order_by('timestamp')
+  if user:
+    records = records.filter(user__username=user)
+  if type:
+    records = records.filter(type=type)
+  return _window(records, since, until)
+
+
+def _window(records, since, until):
+  if since is not None:
+    records = records.filter(timestamp__gte=since)
+  if until is not None:
+    records = records.filter(timestamp__lt=until)
+  return records
+
+
+def access_row(record):
+  lock, card = record.lock, record.card
+  return (
+    record.id,
+    record.timestamp.isoformat(),
+    lock.name if lock else None,
+    lock.device.chip_id if lock and lock.device else None,
+    card.uuid if card else None,
+    card.user.username if card and card.user else None,
+    record.is_locked,
+  )
+
+
+def activity_row(record):
+  return (
+    record.id,
+    record.timestamp.isoformat(),
+    record.type,
+    record.message,
+    record.user.username if record.user else None,
+  )
+
+
+class Echo:
+  """File-like object handing back whatever `csv.writer` writes to it."""
+
+  def write(self, value):
+    return value
+
+
+def stream(records, columns, to_row, format):
+  """
+  Serializes records lazily, one database chunk at a time.
+
+  Args:
+      records: Queryset to export, read with `iterator()`.
+      columns: Names of the values returned by `to_row`.
+      to_row: Function turning a record into a tuple of values.
+      format: 'csv' or 'ndjson'.
+
+  Yields:
+      Chunks of the encoded output. The CSV header goes out before the
+      query runs, so clients get their first bytes right away.
+  """
+  chunk_size = getattr(settings, 'EXPORT_CHUNK_SIZE', CHUNK_SIZE)
+
+  if format == 'csv':
+    writer = csv.writer(Echo())
+    yield writer.writerow(columns)
+    encode = lambda row: writer.writerow(['' if value is None else value for value in row])
+  else:
+    encode = lambda row: json.dumps(dict(zip(columns, row))) + '\n'
+
+  batch = []
+  for record in records.iterator(chunk_size=chunk_size):
+    batch.append(encode(to_row(record)))
+    if len(batch) >= chunk_size:
+      yield ''.join(batch)
+      batch = []
+  if batch:
+    yield ''.join(batch)
+
+
+def response(records, columns, to_row, format, name):
+  """Returns a streaming download of `records`, named after `name` and today's date."""
+  filename = f"{name}_{timezone.localdate().strftime('%Y%m%d')}.{format}"
+  response = StreamingHttpResponse(stream(records, columns, to_row, format), content_type=FORMATS[format])
+  response['Content-Disposition'] = f'attachment; filename="{filename}"'
+  return response
@@ -0,0 +1,97 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.db.models import F
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
+
+from webapp import roles
+from webapp.models import Generation
+
+
+# Attribute of the request holding the generations read for it
+CACHE_ATTR = '_generations'
+
+
+def _name(model):
+  return model._meta.model_name
+
+
+def bump(*models):
+  """
+  Moves the generation of models forward after their rows changed.
+
+  The counters live in the database rather than in the (possibly per-process)
+  cache, so every web worker sees a bump as soon as its transaction commits.
+
+  Args:
+      *models: Model classes whose rows were saved or deleted.
+  """
+  for name in map(_name, models):
+    if not Generation.objects.filter(name=name).update(value=F('value') + 1):
+      Generation.objects.get_or_create(name=name, defaults={'value': 1})
+
+
+def generations(request, *models):
+  """
+  Returns the current generation of models, read once per request.
+
+  Args:
+      request: The request being served, the generations are memoized on it.
+      *models: Model classes the page depends on.
+
+  Returns:
+      A dict mapping model names (e.g. 'lock') to their generation, 0 for a
+      model that never changed.
+  """
+  names = {_name(model) for model in models}
+  known = getattr(request, CACHE_ATTR, {})
+  missing = names - known.keys()
+  if missing:
+    known = {**known, **dict.fromkeys(missing, 0)}
+    known.update(Generation.objects.filter(name__in=missing).values_list('name', 'value'))
+    setattr(request, CACHE_ATTR, known)
+  return {name: known[name] for name in names}
+
+
+def etag(request, *models, period=None):
+  """
+  Computes the ETag of an admin page from the generations it depends on.
+
+  The page also shows who is signed in and carries their CSRF token, so both
+  are part of the tag. Pages with a pending notification get no tag at all:
+  the notification is shown once and must not be hidden behind a 304.
+  Pages that also depend on the time (e.g. which devices went silent) pass
+  a `period` in seconds, the tag then changes at least that often.
+  """
+  if 'message' in request.session:
+    return None
+  versions = generations(request, *models)
+  key = [
+    sorted(versions.items()),
+    request.user.pk,
+    sorted(roles.group_names(request.user)),
+    request.get_full_path(),
+    request.COOKIES.get(settings.CSRF_COOKIE_NAME),
+    int(time.time() // period) if period else None,
+  ]
+  return hashlib.sha256(repr(key).encode()).hexdigest()[:32]
+
+
+def versioned(*models, period=None):
+  """
+  Answers conditional GETs of a view with a 304 while the models it shows are unchanged.
+
+  Browsers are told to revalidate every time, so an edit shows up on the
+  next visit without waiting for a cache lifetime to run out.
+
+  Args:
+      *models: Model classes the rendered page depends on.
+      period: Seconds after which the page is rendered again even if the
+          models are unchanged, see `etag`.
+  """
+  def decorator(view):
+    conditional = condition(etag_func=lambda request, *args, **kwargs: etag(request, *models, period=period))(view)
+    return cache_control(private=True, no_cache=True)(conditional)
+  return decorator
@@ -0,0 +1,318 @@
+import asyncio
+import logging
+import socket
+import struct
+import threading
+
+from collections import OrderedDict
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from webapp import policy
+from webapp import swipes
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+  'HOST': '127.0.0.1',
+  'PORT': 8700,          # Shared by TCP and UDP
+  'UDP': True,           # Also answer swipes sent as single datagrams
+  'WORKERS': 4,          # Threads deciding swipes, the ORM being synchronous
+  'IDLE_TIMEOUT': 300,   # Seconds a TCP connection may stay silent before it is closed
+  'UDP_REPLAY': 4096,    # Recent UDP answers kept to resend to readers retrying a lost reply
+}
+
+VERSION = 1
+
+# Request: version, request id, flags, chip id length, card uuid length, then the chip id and uuid (UTF-8)
+REQUEST_HEADER = struct.Struct('!BHBBB')
+
+# Response: version, request id, status, message length, then the message (ASCII)
+RESPONSE_HEADER = struct.Struct('!BHBB')
+
+# Request flag set when the door's pin is set, the `status` of `/auth`
+LOCKED = 0x01
+
+# Status answered to a malformed request, next to the decision codes of webapp/policy.py
+BAD_REQUEST = 0xFF
+
+# One swipe sent by a reader; `id` is echoed back so answers can be matched to requests
+Request = namedtuple('Request', ['id', 'chip_id', 'card_uuid', 'is_locked'])
+
+# Answer to one swipe: the decision status and message of `/auth`
+Response = namedtuple('Response', ['id', 'status', 'message'])
+
+
+def options():
+  return {**DEFAULTS, **getattr(settings, 'GATEWAY', {})}
+
+
+def encode_request(request):
+  chip_id = request.chip_id.encode()
+  card_uuid = request.card_uuid.encode()
+  flags = LOCKED if request.is_locked else 0
+  return REQUEST_HEADER.pack(VERSION, request.id, flags, len(chip_id), len(card_uuid)) + chip_id + card_uuid
+
+
+def decode_request(data):
+  """
+  Decodes one complete request frame.
+
+  Raises:
+      ValueError: If the frame is truncated, too long, of another version or
+          not UTF-8.
+  """
+  if len(data) < REQUEST_HEADER.size:
+    raise ValueError("Truncated request")
+  version, id, flags, chip_length, uuid_length = REQUEST_HEADER.unpack_from(data)
+  if version != VERSION:
+    raise ValueError(f"Unsupported protocol version {version}")
+  if len(data) != REQUEST_HEADER.size + chip_length + uuid_length:
+    raise ValueError("Request length does not match its header")
+  body = data[REQUEST_HEADER.size:]
+  try:
+    chip_id = body[:chip_length].decode()
+    card_uuid = body[chip_length:].decode()
+  except UnicodeDecodeError:
+    raise ValueError("Chip id and uuid must be UTF-8")
+  return Request(id, chip_id, card_uuid, bool(flags & LOCKED))
+
+
+def encode_response(response):
+  message = response.message.encode('ascii', 'replace')[:255]
+  return RESPONSE_HEADER.pack(VERSION, response.id, response.status, len(message)) + message
+
+
+def decode_response(data):
+  """Decodes one complete response frame, raising ValueError when it is malformed."""
+  if len(data) < RESPONSE_HEADER.size:
+    raise ValueError("Truncated response")
+  version, id, status, length = RESPONSE_HEADER.unpack_from(data)
+  if version != VERSION or len(data) != RESPONSE_HEADER.size + length:
+    raise ValueError("Malformed response")
+  return Response(id, status, data[RESPONSE_HEADER.size:].decode('ascii'))
+
+
+def _decide(request):
+  # Runs in a worker thread, which gets the connection handling of a request thread
+  close_old_connections()
+  try:
+    return swipes.authorize(request.card_uuid, request.chip_id, int(request.is_locked))
+  finally:
+    close_old_connections()
+
+
+class Gateway:
+  """Answers reader swipes over persistent TCP connections and UDP.
+
+  Every connection is a coroutine of one event loop, so a process holds
+  thousands of idle readers at the cost of their socket buffers. Decisions
+  go through `swipes.authorize`, like `/auth`, on a small thread pool that
+  keeps the synchronous ORM off the event loop. With a compiled access policy
+  and the write-behind access log, a swipe costs one primary key lookup: the
+  shared policy generation. So a card revoked from any other process is
+  denied here on its next swipe.
+  """
+
+  def __init__(self, workers=None):
+    self.workers = workers or options()['WORKERS']
+    self.executor = None
+    self.server = None
+    self.udp = None
+    self.address = None
+    self.connections = set()
+
+  async def start(self, host=None, port=None, udp=None):
+    """Starts listening, returning the bound `(host, port)` (useful with port 0)."""
+    opts = options()
+    host = opts['HOST'] if host is None else host
+    port = opts['PORT'] if port is None else port
+    self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='gateway')
+    self.server = await asyncio.start_server(self.handle, host, port)
+    self.address = self.server.sockets[0].getsockname()[:2]
+    if opts['UDP'] if udp is None else udp:
+      self.udp, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+        lambda: DatagramProtocol(self, opts['UDP_REPLAY']),
+        local_addr=self.address
+      )
+    return self.address
+
+  async def serve_forever(self):
+    async with self.server:
+      await self.server.serve_forever()
+
+  async def close(self):
+    if self.udp is not None:
+      self.udp.close()
+    self.server.close()
+    # Readers still connected are cut off, they reconnect to the next gateway
+    for task in list(self.connections):
+      task.cancel()
+    await asyncio.gather(*self.connections, return_exceptions=True)
+    await self.server.wait_closed()
+    self.executor.shutdown(wait=True)
+
+  async def answer(self, request):
+    """Decides one swipe, failing closed if the decision raises."""
+    try:
+      decision = await asyncio.get_running_loop().run_in_executor(self.executor, _decide, request)
+    except Exception:
+      logger.exception("Could not decide swipe of %s at %s", request.card_uuid, request.chip_id)
+      return Response(request.id, policy.NOT_AUTHORIZED, "ERROR")
+    return Response(request.id, decision.status, decision.message)
+
+  async def handle(self, reader, writer):
+    """Serves one TCP connection: frames are answered in the order they arrive."""
+    timeout = options()['IDLE_TIMEOUT']
+    task = asyncio.current_task()
+    self.connections.add(task)
+    try:
+      while True:
+        header = await asyncio.wait_for(reader.readexactly(REQUEST_HEADER.size), timeout)
+        _, id, _, chip_length, uuid_length = REQUEST_HEADER.unpack(header)
+        body = await asyncio.wait_for(reader.readexactly(chip_length + uuid_length), timeout)
+        try:
+          request = decode_request(header + body)
+        except ValueError:
+          # The stream cannot be trusted to be in sync anymore
+          writer.write(encode_response(Response(id, BAD_REQUEST, "BAD REQUEST")))
+          await writer.drain()
+          break
+        response = await self.answer(request)
+        writer.write(encode_response(response))
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+      pass  # Closed by the reader, or silent for too long
+    finally:
+      self.connections.discard(task)
+      writer.close()
+
+
+class DatagramProtocol(asyncio.DatagramProtocol):
+  """Answers swipes sent as single datagrams.
+
+  A reader that misses a reply sends the same request again; the recent
+  answers are kept by sender and request id, so a retry is answered again
+  without being decided, and logged, twice.
+  """
+
+  def __init__(self, gateway, replay_size):
+    self.gateway = gateway
+    self.replay_size = replay_size
+    self.transport = None
+    self.answers = OrderedDict()  # (address, request id) -> encoded response, None while deciding
+    self.tasks = set()
+
+  def connection_made(self, transport):
+    self.transport = transport
+
+  def datagram_received(self, data, addr):
+    try:
+      request = decode_request(data)
+    except ValueError:
+      if len(data) >= REQUEST_HEADER.size:
+        _, id, *_ = REQUEST_HEADER.unpack_from(data)
+        self.transport.sendto(encode_response(Response(id, BAD_REQUEST, "BAD REQUEST")), addr)
+      return
+
+    key = (addr, request.id)
+    if key in self.answers:
+      if self.answers[key] is not None:
+        self.transport.sendto(self.answers[key], addr)
+      return
+    self.answers[key] = None
+    task = asyncio.ensure_future(self._answer(key, request, addr))
+    self.tasks.add(task)
+    task.add_done_callback(self.tasks.discard)
+
+  async def _answer(self, key, request, addr):
+    data = encode_response(await self.gateway.answer(request))
+    self.answers[key] = data
+    while len(self.answers) > self.replay_size:
+      self.answers.popitem(last=False)
+    self.transport.sendto(data, addr)
+
+
+def serve(host=None, port=None, udp=None, workers=None, ready=None):
+  """Runs a gateway until interrupted, e.g. from `manage.py gateway`.
+
+  Args:
+      ready: Optional function called with the bound `(host, port)`.
+  """
+  async def main():
+    gateway = Gateway(workers)
+    address = await gateway.start(host, port, udp)
+    if ready is not None:
+      ready(address)
+    try:
+      await gateway.serve_forever()
+    finally:
+      await gateway.close()
+
+  asyncio.run(main())
+
+
+@contextmanager
+def running(host='127.0.0.1', port=0, udp=True, workers=None):
+  """Runs a gateway on an event loop thread of its own for the duration of a block, yielding its `(host, port)`."""
+  loop = asyncio.new_event_loop()
+  thread = threading.Thread(target=loop.run_forever, name='gateway-loop', daemon=True)
+  thread.start()
+  gateway = Gateway(workers)
+  try:
+    yield asyncio.run_coroutine_threadsafe(gateway.start(host, port, udp), loop).result()
+  finally:
+    if gateway.server is not None:
+      asyncio.run_coroutine_threadsafe(gateway.close(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+
+class Client:
+  """Blocking stand-in for a reader, speaking the gateway protocol over TCP or UDP.
+
+  Used by `authbench` and the tests; one client is one reader connection.
+  """
+
+  def __init__(self, host, port, udp=False, timeout=5.0):
+    self.udp = udp
+    if udp:
+      self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+      self.socket.settimeout(timeout)
+      self.socket.connect((host, port))
+    else:
+      self.socket = socket.create_connection((host, port), timeout)
+      self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    self._next_id = 0
+
+  def authorize(self, card_uuid, chip_id, is_locked=0):
+    """Sends one swipe and waits for its `Response`."""
+    self._next_id = (self._next_id + 1) % 0x10000
+    self.socket.sendall(encode_request(Request(self._next_id, chip_id, card_uuid, bool(is_locked))))
+    while True:
+      if self.udp:
+        response = decode_response(self.socket.recv(RESPONSE_HEADER.size + 255))
+      else:
+        header = self._receive(RESPONSE_HEADER.size)
+        response = decode_response(header + self._receive(header[-1]))
+      if response.id == self._next_id:
+        return response
+      # A late answer to an earlier request that timed out
+
+  def close(self):
+    self.socket.close()
+
+  def _receive(self, size):
+    data = b''
+    while len(data) < size:
+      chunk = self.socket.recv(size - len(data))
+      if not chunk:
+        raise ConnectionError("Connection closed by the gateway")
+      data += chunk
+    return data
@@ -0,0 +1,157 @@
+import atexit
+import logging
+import os
+import threading
+
+from collections import namedtuple
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db import transaction
+from django.utils import timezone
+
+from webapp import fragments
+from webapp.models import Device
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+  'BUFFERED': True,       # False writes every heartbeat inline
+  'FLUSH_INTERVAL': 30,   # Seconds heartbeats are coalesced in memory before being written
+  'BATCH_SIZE': 500,      # Devices per UPDATE
+  'STALE_AFTER': 120,     # Seconds of silence after which the device list flags a device
+}
+
+# Fields a heartbeat writes
+FIELDS = ['last_seen', 'firmware', 'rssi']
+
+# Latest heartbeat of a device: when it was received, and what the device reported (None when it did not)
+Beat = namedtuple('Beat', ['seen', 'firmware', 'rssi'])
+
+
+def options():
+  return {**DEFAULTS, **getattr(settings, 'HEARTBEAT', {})}
+
+
+def stale_since(now=None):
+  """Returns the time before which a last_seen makes a device stale."""
+  return (now or timezone.now()) - timedelta(seconds=options()['STALE_AFTER'])
+
+
+def stale(now=None):
+  """Returns the devices silent for more than `STALE_AFTER` seconds, read through the last_seen index.
+
+  Devices that never sent a heartbeat (e.g. older firmware) are not stale.
+  """
+  return Device.objects.filter(last_seen__lt=stale_since(now))
+
+
+def store(beats):
+  """
+  Writes heartbeats to their devices, in one SELECT and an UPDATE per `BATCH_SIZE` devices.
+
+  The Device generation only moves when a device comes back online or
+  reports new firmware, not on every flush.
+
+  Args:
+      beats: Dict mapping chip ids to their latest `Beat`. Unknown chip ids
+          are skipped.
+
+  Returns:
+      The number of devices updated.
+  """
+  if not beats:
+    return 0
+  devices = list(Device.objects.filter(chip_id__in=beats))
+  since = stale_since()
+  shown = False  # Whether a device page shows something new beyond its time period
+  for device in devices:
+    beat = beats[device.chip_id]
+    if device.last_seen is None or device.last_seen < since:
+      shown = True  # Back online
+    device.last_seen = beat.seen
+    if beat.firmware is not None:
+      shown = shown or beat.firmware != device.firmware
+      device.firmware = beat.firmware
+    if beat.rssi is not None:
+      device.rssi = beat.rssi
+  if devices:
+    with transaction.atomic():
+      # `bulk_update` sends no post_save: heartbeats do not change the access policy
+      Device.objects.bulk_update(devices, FIELDS, batch_size=options()['BATCH_SIZE'])
+      # The device lists already refresh every FLUSH_INTERVAL for last_seen, rssi and the
+      # devices going silent, so only a device coming back or new firmware moves the generation
+      if shown:
+        fragments.bump(Device)
+  return len(devices)
+
+
+class HeartbeatBuffer:
+  """Coalesces device heartbeats in memory and writes them in bulk.
+
+  Only the latest heartbeat of each device is kept, so however often a
+  device reports, it is written at most once per `FLUSH_INTERVAL`. A timer
+  is armed by the first heartbeat after a flush, which bounds how late a
+  last_seen can be without a thread waking up while devices are silent.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._pid = None
+    self._pending = {}
+    self._timer = None
+
+  def record(self, chip_id, firmware=None, rssi=None, seen=None):
+    """Records one heartbeat, returning without touching the database when buffered."""
+    opts = options()
+    beat = Beat(seen or timezone.now(), firmware, rssi)
+    if not opts['BUFFERED']:
+      store({chip_id: beat})
+      return
+
+    with self._lock:
+      if self._pid != os.getpid():
+        # First use in this process (or first use after a fork)
+        if self._pid is None:
+          atexit.register(self.flush)
+        self._pending = {}
+        self._timer = None
+        self._pid = os.getpid()
+      earlier = self._pending.get(chip_id)
+      if earlier is not None:
+        # Keep what an earlier heartbeat of the interval reported and this one did not
+        beat = beat._replace(
+          firmware=earlier.firmware if firmware is None else firmware,
+          rssi=earlier.rssi if rssi is None else rssi,
+        )
+      self._pending[chip_id] = beat
+      if self._timer is None:
+        self._timer = threading.Timer(opts['FLUSH_INTERVAL'], self._flush_due)
+        self._timer.daemon = True
+        self._timer.start()
+
+  def pending(self):
+    """Number of devices whose heartbeat has not been written yet."""
+    return len(self._pending)
+
+  def flush(self):
+    """Writes the pending heartbeats from the calling thread."""
+    with self._lock:
+      beats, self._pending = self._pending, {}
+      if self._timer is not None:
+        self._timer.cancel()
+        self._timer = None
+    return store(beats)
+
+  def _flush_due(self):
+    try:
+      self.flush()
+    except Exception:
+      logger.exception("Could not write device heartbeats")
+    finally:
+      close_old_connections()
+
+
+heartbeats = HeartbeatBuffer()
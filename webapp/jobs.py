@@ -0,0 +1,217 @@
+import logging
+import multiprocessing
+import os
+import re
+import signal
+import threading
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+  'WORKERS': 2,                  # Worker processes, 0 runs jobs inline in the calling thread
+  'TIMEOUT': 300,                # Seconds a job may run before it is abandoned
+  'ARTIFACT_DIR': None,          # Directory holding the finished files and the job state
+  'MAX_BYTES': 500 * 1024 ** 2,  # Finished files kept, oldest downloads are evicted first
+  'MAX_AGE': 7 * 24 * 3600,      # Seconds a finished file is kept after its last download
+}
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+# Job ids end up in file names, anything else is rejected
+JOB_ID = re.compile(r'[0-9a-f]{16,64}')
+
+
+class JobTimeout(Exception):
+  pass
+
+
+def _alarm(signum, frame):
+  raise JobTimeout("Job exceeded its timeout")
+
+
+def _execute(func, base, suffix, timeout, args):
+  """Runs one job in a worker process, leaving either its artifact or an error file behind."""
+  tmp = f'{base}.{os.getpid()}.tmp'
+  if timeout and hasattr(signal, 'SIGALRM'):
+    signal.signal(signal.SIGALRM, _alarm)
+    signal.alarm(int(timeout))
+  try:
+    func(tmp, *args)
+    os.replace(tmp, base + suffix)
+  except Exception as e:
+    logger.exception("Job %s failed", os.path.basename(base))
+    with open(base + '.error', 'w', encoding='utf-8') as f:
+      f.write(f'{type(e).__name__}: {e}')
+    if os.path.exists(tmp):
+      os.remove(tmp)
+  finally:
+    if timeout and hasattr(signal, 'SIGALRM'):
+      signal.alarm(0)
+    _remove(base + '.pending')
+
+
+def _remove(path):
+  try:
+    os.remove(path)
+  except FileNotFoundError:
+    pass
+
+
+class JobRunner:
+  """Runs file-producing jobs in a process pool and keeps their results on disk.
+
+  A job is identified by the caller, typically a digest of everything its
+  output depends on, so submitting the same job again returns the cached
+  file. The state of every job lives in `ARTIFACT_DIR` next to its file,
+  which lets any web worker process poll a job submitted by another one.
+  """
+
+  def __init__(self, setting_name, suffix):
+    self.setting_name = setting_name
+    self.suffix = suffix
+
+    self._lock = threading.Lock()
+    self._pid = None
+    self._pool = None
+
+  @property
+  def options(self):
+    return {**DEFAULTS, **getattr(settings, self.setting_name, {})}
+
+  def path(self, job_id):
+    """Returns the path of the finished file of a job."""
+    return self._base(job_id) + self.suffix
+
+  def status(self, job_id):
+    """Returns PENDING, DONE or FAILED, or None for a job that was never submitted or got evicted."""
+    if not JOB_ID.fullmatch(job_id):
+      return None
+    base = self._base(job_id)
+    if os.path.exists(base + self.suffix):
+      return DONE
+    if os.path.exists(base + '.error'):
+      return FAILED
+    try:
+      started = os.path.getmtime(base + '.pending')
+    except FileNotFoundError:
+      return None
+    return PENDING if time.time() - started < self.options['TIMEOUT'] else FAILED
+
+  def error(self, job_id):
+    """Returns why a job failed."""
+    try:
+      with open(self._base(job_id) + '.error', encoding='utf-8') as f:
+        return f.read()
+    except FileNotFoundError:
+      return "Job timed out"
+
+  def submit(self, job_id, func, *args):
+    """
+    Queues `func(path, *args)` unless the job is already finished or running.
+
+    Args:
+        job_id: Hex digest identifying the job and its result.
+        func: Importable function writing the result to `path`.
+        *args: Picklable arguments for `func`.
+
+    Returns:
+        The status of the job once queued.
+    """
+    if not JOB_ID.fullmatch(job_id):
+      raise ValueError(f"Invalid job id: {job_id}")
+    status = self.status(job_id)
+    if status in (PENDING, DONE):
+      return status
+
+    options = self.options
+    os.makedirs(options['ARTIFACT_DIR'], exist_ok=True)
+    base = self._base(job_id)
+    _remove(base + '.error')
+    _remove(base + '.pending')  # Left behind by a job that timed out
+    try:
+      # Exclusive create: of several processes submitting the same job, one runs it
+      os.close(os.open(base + '.pending', os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+      return PENDING
+
+    if not options['WORKERS']:
+      _execute(func, base, self.suffix, 0, args)
+      self.evict()
+      return self.status(job_id)
+
+    future = self._executor(options).submit(_execute, func, base, self.suffix, options['TIMEOUT'], args)
+    future.add_done_callback(lambda future: self._finished(base, future))
+    return PENDING
+
+  def touch(self, job_id):
+    """Marks a finished file as just downloaded, keeping it out of the next eviction."""
+    try:
+      os.utime(self.path(job_id))
+    except FileNotFoundError:
+      pass
+
+  def evict(self):
+    """Deletes finished files past `MAX_AGE`, then the least recently downloaded ones past `MAX_BYTES`."""
+    options = self.options
+    if not os.path.isdir(options['ARTIFACT_DIR']):
+      return 0
+    now = time.time()
+    files = []
+    for entry in os.scandir(options['ARTIFACT_DIR']):
+      if entry.name.endswith((self.suffix, '.error')):
+        stat = entry.stat()
+        files.append((stat.st_mtime, stat.st_size, entry.path))
+
+    evicted = 0
+    total = sum(size for _, size, _ in files)
+    for mtime, size, path in sorted(files):
+      if now - mtime < options['MAX_AGE'] and total <= options['MAX_BYTES']:
+        break
+      _remove(path)
+      total -= size
+      evicted += 1
+    return evicted
+
+  # ---------------------------------------------------------------------------------
+  # Internals
+  # ---------------------------------------------------------------------------------
+
+  def _base(self, job_id):
+    return os.path.join(self.options['ARTIFACT_DIR'], job_id)
+
+  def _executor(self, options):
+    with self._lock:
+      if self._pid != os.getpid() or self._pool is None:
+        # Spawned workers set Django up from scratch instead of sharing the parent's connections
+        self._pool = ProcessPoolExecutor(
+          max_workers=options['WORKERS'],
+          mp_context=multiprocessing.get_context('spawn'),
+          initializer=django.setup,
+        )
+        self._pid = os.getpid()
+      return self._pool
+
+  def _finished(self, base, future):
+    error = future.exception()
+    if error is not None:
+      # The worker died (e.g. killed by the OOM killer), `_execute` could not record it
+      logger.error("Job %s failed: %s", os.path.basename(base), error)
+      with open(base + '.error', 'w', encoding='utf-8') as f:
+        f.write(f'{type(error).__name__}: {error}')
+      _remove(base + '.pending')
+      with self._lock:
+        self._pool = None
+    try:
+      self.evict()
+    except OSError:
+      logger.exception("Could not evict old artifacts")
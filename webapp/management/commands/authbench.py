@@ -0,0 +1,328 @@
+import json
+import os
+import queue
+import random
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+from collections import Counter
+from contextlib import nullcontext
+from datetime import timedelta
+from urllib.parse import urlencode
+from urllib.request import urlopen
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import Client
+from django.test import override_settings
+from django.test.utils import setup_test_environment
+from django.test.utils import teardown_test_environment
+from django.urls import reverse
+from django.utils import timezone
+
+from webapp import allowlist
+from webapp import gateway
+from webapp import policy
+from webapp.models import Card
+from webapp.models import Device
+from webapp.models import Lock
+from webapp.models import LockGroup
+from webapp.models import UserGroup
+from webapp.writebehind import access_log
+from webapp.writebehind import audit_log
+
+
+# Every row seeded by this command is named with this prefix
+PREFIX = 'bench-'
+
+
+def percentile(values, p):
+  """Nearest-rank percentile of an already sorted list."""
+  if not values:
+    return None
+  rank = max(0, min(len(values) - 1, round(p / 100 * len(values)) - 1))
+  return values[rank]
+
+
+class Command(BaseCommand):
+  help = "Seeds a synthetic population and measures /auth (or reader gateway) latency under concurrent swipe traffic"
+
+  def add_arguments(self, parser):
+    population = parser.add_argument_group('population')
+    population.add_argument('--users', type=int, default=1000)
+    population.add_argument('--cards-per-user', type=int, default=1)
+    population.add_argument('--user-groups', type=int, default=10)
+    population.add_argument('--lock-groups', type=int, default=8)
+    population.add_argument('--locks', type=int, default=50)
+    population.add_argument('--groups-per-lock', type=int, default=2, help="Lock groups each lock belongs to")
+    population.add_argument('--grants-per-user-group', type=int, default=3, help="Lock groups each user group may open")
+    population.add_argument('--expired-ratio', type=float, default=0.05, help="Fraction of cards past their due date")
+
+    traffic = parser.add_argument_group('traffic')
+    traffic.add_argument('--swipes', type=int, default=5000)
+    traffic.add_argument('--concurrency', type=int, default=8)
+    traffic.add_argument('--locked-ratio', type=float, default=0.1, help="Fraction of swipes on doors with the pin set")
+    traffic.add_argument('--unknown-ratio', type=float, default=0.02, help="Fraction of swipes with unknown cards")
+    traffic.add_argument('--seed', type=int, default=0)
+
+    target = parser.add_argument_group('target')
+    target.add_argument('--url', help="Replay against a running server (e.g. http://127.0.0.1:8000) instead of the test client")
+    target.add_argument('--protocol', choices=['http', 'tcp', 'udp'], default='http', help="tcp and udp replay through the reader gateway")
+    target.add_argument('--gateway', help="HOST:PORT of a running gateway, instead of one started in this process")
+    target.add_argument('--in-place', action='store_true', help="Seed the configured database instead of a throwaway one")
+    target.add_argument('--keep', action='store_true', help="With --in-place, keep the seeded rows")
+    target.add_argument('--output', help="Write the JSON report to this file")
+
+  def handle(self, *args, **options):
+    if (options['url'] or options['gateway']) and not options['in_place']:
+      raise CommandError("--url and --gateway need --in-place, the server cannot see a throwaway database")
+    if options['url'] and options['protocol'] != 'http' or options['gateway'] and options['protocol'] == 'http':
+      raise CommandError("--url replays over http, --gateway over tcp or udp")
+    if options['concurrency'] < 1 or options['swipes'] < 1:
+      raise CommandError("--concurrency and --swipes must be positive")
+
+    rng = random.Random(options['seed'])
+    setup_test_environment()
+    old_name = None if options['in_place'] else self.create_database()
+    # Rows logged against a throwaway database must not be replayed into the real one from the shared spool
+    spool_dir = None if options['in_place'] else tempfile.mkdtemp()
+    try:
+      with override_settings(**self.private_logs(spool_dir)) if spool_dir else nullcontext():
+        try:
+          population = self.seed(rng, options)
+          # The syncs scheduled by the seeding run now rather than during the timed swipes
+          allowlist.syncs.flush()
+          swipes = self.plan(rng, population, options)
+          report = self.replay(swipes, options)
+          report['population'] = {name: len(rows) for name, rows in population.items()}
+        finally:
+          access_log.flush()
+          audit_log.flush()
+          allowlist.syncs.flush()
+    finally:
+      if old_name is not None:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        shutil.rmtree(spool_dir, ignore_errors=True)
+      else:
+        if not options['keep']:
+          self.cleanup()
+        allowlist.syncs.flush()
+      teardown_test_environment()
+
+    report['config'] = {name: options[name] for name in (
+      'users', 'cards_per_user', 'user_groups', 'lock_groups', 'locks', 'groups_per_lock',
+      'grants_per_user_group', 'expired_ratio', 'swipes', 'concurrency', 'locked_ratio',
+      'unknown_ratio', 'seed', 'url', 'protocol', 'gateway'
+    )}
+    report['commit'] = self.commit()
+    report['timestamp'] = timezone.now().isoformat()
+
+    output = json.dumps(report, indent=2)
+    if options['output']:
+      with open(options['output'], 'w') as f:
+        f.write(output)
+    self.stdout.write(output)
+
+  # ---------------------------------------------------------------------------------
+  # Database
+  # ---------------------------------------------------------------------------------
+
+  def create_database(self):
+    """Creates a throwaway database; SQLite gets a file so threads share it."""
+    if connection.vendor == 'sqlite':
+      test_settings = connection.settings_dict.setdefault('TEST', {})
+      test_settings['NAME'] = os.path.join(tempfile.mkdtemp(), 'authbench.sqlite3')
+    return connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+
+  def private_logs(self, spool_dir):
+    """Settings spooling the write-behind logs to `spool_dir`, e.g. while a throwaway database is in use."""
+    return {name: {**getattr(settings, name, {}), 'SPOOL_DIR': spool_dir} for name in ('ACCESS_LOG', 'AUDIT_LOG')}
+
+  def cleanup(self):
+    Card.objects.filter(uuid__startswith=PREFIX).delete()
+    User.objects.filter(username__startswith=PREFIX).delete()
+    Lock.objects.filter(name__startswith=PREFIX).delete()
+    Device.objects.filter(chip_id__startswith=PREFIX).delete()
+    UserGroup.objects.filter(name__startswith=PREFIX).delete()
+    LockGroup.objects.filter(name__startswith=PREFIX).delete()
+
+  def commit(self):
+    try:
+      return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+      return None
+
+  # ---------------------------------------------------------------------------------
+  # Population
+  # ---------------------------------------------------------------------------------
+
+  def seed(self, rng, options):
+    # LockGroup.save assigns the bit index, so lock groups are created one by one
+    lock_groups = [LockGroup.objects.create(name=f'{PREFIX}lock-group-{i}') for i in range(options['lock_groups'])]
+    user_groups = [UserGroup.objects.create(name=f'{PREFIX}user-group-{i}') for i in range(options['user_groups'])]
+    for user_group in user_groups:
+      user_group.lock_groups.set(rng.sample(lock_groups, min(options['grants_per_user_group'], len(lock_groups))))
+
+    Device.objects.bulk_create([
+      Device(chip_id=f'{PREFIX}chip-{i}', status=Device.Status.TRUSTED) for i in range(options['locks'])
+    ])
+    devices = list(Device.objects.filter(chip_id__startswith=PREFIX).order_by('id'))
+    Lock.objects.bulk_create([
+      Lock(name=f'{PREFIX}lock-{i}', device=device) for i, device in enumerate(devices)
+    ])
+    locks = list(Lock.objects.filter(name__startswith=PREFIX).order_by('id'))
+    Lock.groups.through.objects.bulk_create([
+      Lock.groups.through(lock=lock, lockgroup=lock_group)
+      for lock in locks
+      for lock_group in rng.sample(lock_groups, min(options['groups_per_lock'], len(lock_groups)))
+    ])
+    Lock.objects.filter(name__startswith=PREFIX).refresh_masks()
+
+    User.objects.bulk_create([
+      User(username=f'{PREFIX}user-{i}', password='!') for i in range(options['users'])
+    ])
+    users = list(User.objects.filter(username__startswith=PREFIX).order_by('id'))
+    User.groups.through.objects.bulk_create([
+      User.groups.through(user=user, group_id=rng.choice(user_groups).pk) for user in users
+    ] if user_groups else [])
+
+    now = timezone.now()
+    Card.objects.bulk_create([
+      Card(
+        uuid=f'{PREFIX}card-{user.pk}-{n}',
+        user=user,
+        due_date=now - timedelta(days=1) if rng.random() < options['expired_ratio'] else now + timedelta(days=365)
+      )
+      for user in users
+      for n in range(options['cards_per_user'])
+    ])
+    cards = list(Card.objects.filter(uuid__startswith=PREFIX).values_list('uuid', flat=True))
+
+    # Bulk inserts bypass the model signals
+    policy.invalidate()
+    return {
+      'lock_groups': lock_groups, 'user_groups': user_groups, 'devices': devices,
+      'locks': locks, 'users': users, 'cards': cards
+    }
+
+  def plan(self, rng, population, options):
+    chip_ids = [device.chip_id for device in population['devices']]
+    if not chip_ids or not population['cards']:
+      raise CommandError("The population needs at least one lock and one card")
+    swipes = []
+    for i in range(options['swipes']):
+      if rng.random() < options['unknown_ratio']:
+        card_uuid = f'{PREFIX}unknown-{i}'
+      else:
+        card_uuid = rng.choice(population['cards'])
+      swipes.append({'uuid': card_uuid, 'dev': rng.choice(chip_ids), 'status': int(rng.random() < options['locked_ratio'])})
+    return swipes
+
+  # ---------------------------------------------------------------------------------
+  # Traffic
+  # ---------------------------------------------------------------------------------
+
+  def replay(self, swipes, options):
+    if options['protocol'] == 'http' or options['gateway']:
+      return self.replay_to(swipes, options, options['gateway'])
+
+    # In-process gateway, sharing the throwaway database with the replay
+    with gateway.running(udp=options['protocol'] == 'udp') as (host, port):
+      return self.replay_to(swipes, options, f'{host}:{port}')
+
+  def replay_to(self, swipes, options, address):
+    pending = queue.Queue()
+    for swipe in swipes:
+      pending.put(swipe)
+
+    results = []
+    results_lock = threading.Lock()
+
+    def worker():
+      if address:
+        host, port = address.rsplit(':', 1)
+        client = gateway.Client(host, int(port), udp=options['protocol'] == 'udp')
+      else:
+        client = Client()
+      queries = []
+
+      def count(execute, sql, params, many, context):
+        queries.append(sql)
+        return execute(sql, params, many, context)
+
+      local = []
+      with connection.execute_wrapper(count):
+        while True:
+          try:
+            swipe = pending.get_nowait()
+          except queue.Empty:
+            break
+          queries.clear()
+          started = time.perf_counter()
+          try:
+            message = self.request(client, swipe, options['url'])
+          except Exception as e:
+            message = None
+            self.stderr.write(f"{type(e).__name__}: {e}")
+          latency = time.perf_counter() - started
+          # Queries run by a server or gateway thread are not seen from here
+          local.append((latency, None if options['url'] or address else len(queries), message))
+      connection.close()
+      if address:
+        client.close()
+      with results_lock:
+        results.extend(local)
+
+    threads = [threading.Thread(target=worker) for _ in range(options['concurrency'])]
+    started = time.perf_counter()
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency * 1000 for latency, _, _ in results)
+    query_counts = [count for _, count, _ in results if count is not None]
+    errors = sum(1 for _, _, message in results if message is None)
+    return {
+      'requests': len(results),
+      'errors': errors,
+      'error_rate': errors / len(results),
+      'duration_s': elapsed,
+      'requests_per_s': len(results) / elapsed,
+      'latency_ms': {
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'mean': sum(latencies) / len(latencies),
+        'max': latencies[-1],
+      },
+      'queries_per_request': {
+        'mean': sum(query_counts) / len(query_counts),
+        'max': max(query_counts),
+      } if query_counts else None,
+      'outcomes': dict(Counter(message for _, _, message in results if message is not None)),
+    }
+
+  def request(self, client, swipe, url):
+    """Sends one swipe, returning the decision message or raising on any failure."""
+    if isinstance(client, gateway.Client):
+      response = client.authorize(swipe['uuid'], swipe['dev'], swipe['status'])
+      if response.status == gateway.BAD_REQUEST:
+        raise RuntimeError(response.message)
+      return response.message
+
+    if url:
+      with urlopen(f"{url.rstrip('/')}{reverse('auth')}?{urlencode(swipe)}", timeout=10) as response:
+        return json.loads(response.read())['message']
+
+    response = client.get(reverse('auth'), swipe)
+    if response.status_code != 200:
+      raise RuntimeError(f"HTTP {response.status_code}")
+    return response.json()['message']
@@ -0,0 +1,20 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from webapp import expiry
+
+
+class Command(BaseCommand):
+  help = "Marks the cards past their due date as expired, e.g. from cron"
+
+  def add_arguments(self, parser):
+    parser.add_argument('--window', type=int, default=3600, help="Also report the cards expiring within this many seconds")
+
+  def handle(self, *args, **options):
+    expired = expiry.sweep()
+    upcoming = expiry.expiring(timedelta(seconds=options['window'])).count()
+    next_expiry = expiry.next_expiry()
+
+    self.stdout.write(self.style.SUCCESS(f"Expired {expired} cards"))
+    self.stdout.write(f"{upcoming} cards expire within {options['window']} seconds, next one at {next_expiry or 'never'}")
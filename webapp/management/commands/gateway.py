@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from webapp import gateway
+from webapp.writebehind import access_log
+from webapp.writebehind import audit_log
+
+
+class Command(BaseCommand):
+  help = "Answers reader swipes over the compact binary protocol, on TCP and UDP (see webapp/gateway.py)"
+
+  def add_arguments(self, parser):
+    parser.add_argument('--host', help="Address to listen on, defaults to GATEWAY['HOST']")
+    parser.add_argument('--port', type=int, help="TCP and UDP port, defaults to GATEWAY['PORT']")
+    parser.add_argument('--no-udp', action='store_true', help="Only accept TCP connections")
+    parser.add_argument('--workers', type=int, help="Threads deciding swipes, defaults to GATEWAY['WORKERS']")
+
+  def handle(self, *args, **options):
+    def ready(address):
+      self.stdout.write(self.style.SUCCESS(f"Gateway listening on {address[0]}:{address[1]}"))
+
+    try:
+      gateway.serve(options['host'], options['port'], False if options['no_udp'] else None, options['workers'], ready)
+    except KeyboardInterrupt:
+      pass
+    finally:
+      access_log.flush()
+      audit_log.flush()
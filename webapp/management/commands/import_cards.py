@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from webapp import provisioning
+from webapp.models import ActivityRecord
+
+
+class Command(BaseCommand):
+  help = "Creates cards from a CSV file of uuid,username,due_date rows"
+
+  def add_arguments(self, parser):
+    parser.add_argument('path', help="CSV file, with or without a header row")
+    parser.add_argument('--dry-run', action='store_true', help="Only validate the rows")
+
+  def handle(self, *args, **options):
+    try:
+      with open(options['path'], encoding='utf-8-sig', newline='') as f:
+        result = provisioning.import_cards(f, dry_run=options['dry_run'])
+    except (OSError, ValueError) as e:
+      raise CommandError(e)
+
+    for error in result.errors:
+      self.stderr.write(f"Line {error.line} ({error.key}): {error.message}")
+
+    if options['dry_run']:
+      self.stdout.write(f"{result.created} cards would be imported, {len(result.errors)} rows rejected")
+      return
+
+    message = f"{result.created} cards imported from {options['path']}, {len(result.errors)} rows rejected"
+    if result.created:
+      ActivityRecord.objects.create(type=ActivityRecord.Type.CREATE, message=message)
+    self.stdout.write(self.style.SUCCESS(message))
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from webapp import provisioning
+from webapp.models import ActivityRecord
+
+
+class Command(BaseCommand):
+  help = "Creates users from a CSV or JSON file of first_name,last_name,username,email,password,group rows"
+
+  def add_arguments(self, parser):
+    parser.add_argument('path', help="CSV file (header optional) or JSON array of objects")
+    parser.add_argument('--format', choices=['csv', 'json'], help="Defaults to the file extension")
+    parser.add_argument('--workers', type=int, help="Password hashing processes, defaults to the number of cores")
+    parser.add_argument('--dry-run', action='store_true', help="Only validate the rows")
+
+  def handle(self, *args, **options):
+    path = options['path']
+    import_format = options['format'] or ('json' if path.lower().endswith('.json') else 'csv')
+    try:
+      with open(path, encoding='utf-8-sig', newline='') as f:
+        result = provisioning.import_users(f, import_format, dry_run=options['dry_run'], workers=options['workers'])
+    except (OSError, ValueError) as e:
+      raise CommandError(e)
+
+    for error in result.errors:
+      self.stderr.write(f"Line {error.line} ({error.key}): {error.message}")
+
+    if options['dry_run']:
+      self.stdout.write(f"{result.created} users would be imported, {len(result.errors)} rows rejected")
+      return
+
+    message = f"{result.created} users imported from {path}, {len(result.errors)} rows rejected"
+    if result.created:
+      ActivityRecord.objects.create(type=ActivityRecord.Type.CREATE, message=message)
+    rate = result.created / result.seconds if result.seconds else 0
+    self.stdout.write(self.style.SUCCESS(f"{message} ({rate:.1f} users/s)"))
@@ -0,0 +1,38 @@
+from datetime import timezone as dt_timezone
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+from django.db.models.functions import TruncHour
+
+from webapp.models import AccessRecord
+from webapp.models import AccessRollup
+
+
+BATCH_SIZE = 1000
+
+
+class Command(BaseCommand):
+  help = "Recounts the hourly access rollups from the access records, e.g. to backfill them"
+
+  def handle(self, *args, **options):
+    counts = (
+      AccessRecord.objects
+      .annotate(hour=TruncHour('timestamp', tzinfo=dt_timezone.utc))
+      .order_by()
+      .values('lock_id', 'hour', 'outcome')
+      .annotate(count=Count('id'))
+    )
+
+    created = 0
+    with transaction.atomic():
+      AccessRollup.objects.all().delete()
+      batch = []
+      for row in counts.iterator(chunk_size=BATCH_SIZE):
+        batch.append(AccessRollup(**row))
+        if len(batch) == BATCH_SIZE:
+          created += len(AccessRollup.objects.bulk_create(batch))
+          batch = []
+      created += len(AccessRollup.objects.bulk_create(batch))
+
+    self.stdout.write(self.style.SUCCESS(f"Rebuilt {created} access rollups"))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from webapp import allowlist
+from webapp import policy
+from webapp.models import Lock
+from webapp.models import LockGroup
+from webapp.models import UserGroup
+
+
+class Command(BaseCommand):
+  help = "Assigns bit indexes to lock groups and recomputes every lock and user group mask"
+
+  def handle(self, *args, **options):
+    with transaction.atomic():
+      for lock_group in LockGroup.objects.filter(bit=None).order_by('id'):
+        lock_group.save()
+
+      locks = Lock.objects.all().refresh_masks()
+      user_groups = UserGroup.objects.all().refresh_masks()
+
+    policy.invalidate()
+    allowlist.sync()
+    self.stdout.write(self.style.SUCCESS(f"Rebuilt masks for {len(locks)} locks and {len(user_groups)} user groups"))
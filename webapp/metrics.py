@@ -0,0 +1,157 @@
+import threading
+import time
+
+from bisect import bisect_left
+from contextlib import ExitStack
+
+from django.db import connections
+
+
+# Upper bounds (seconds) of the request latency histogram buckets, +Inf is implicit
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Layout of the per-view counters row
+COUNT, LATENCY_SUM, SQL_QUERIES, SQL_SECONDS, RESPONSE_BYTES, BUCKETS = range(6)
+ROW_SIZE = BUCKETS + len(LATENCY_BUCKETS) + 1
+
+_local = threading.local()
+_registries = {}  # ThreadStats by thread, folded into `_retired` once their thread has exited
+_registries_lock = threading.Lock()
+
+
+class ThreadStats:
+  """Counters owned by a single thread, only ever written by that thread."""
+
+  def __init__(self):
+    self.views = {}
+    self.statuses = {}
+
+  def add(self, other):
+    """Adds the counters of `other` to these."""
+    for view, row in list(other.views.items()):
+      total = self.views.setdefault(view, [0] * ROW_SIZE)
+      for i, value in enumerate(list(row)):
+        total[i] += value
+    for key, count in list(other.statuses.items()):
+      self.statuses[key] = self.statuses.get(key, 0) + count
+
+
+# Counters of the threads that have exited, e.g. recycled by the server
+_retired = ThreadStats()
+
+
+def _retire_dead_threads():
+  # Called with `_registries_lock` held; a thread that has exited no longer writes its counters
+  for thread in [thread for thread in _registries if not thread.is_alive()]:
+    _retired.add(_registries.pop(thread))
+
+
+def _thread_stats():
+  stats = getattr(_local, 'stats', None)
+  if stats is None:
+    stats = _local.stats = ThreadStats()
+    with _registries_lock:
+      _retire_dead_threads()
+      _registries[threading.current_thread()] = stats
+  return stats
+
+
+def record(view, status, elapsed, queries, sql_seconds, size):
+  """Adds one request to the calling thread's counters, without taking any lock."""
+  stats = _thread_stats()
+  row = stats.views.get(view)
+  if row is None:
+    row = stats.views[view] = [0] * ROW_SIZE
+  row[COUNT] += 1
+  row[LATENCY_SUM] += elapsed
+  row[SQL_QUERIES] += queries
+  row[SQL_SECONDS] += sql_seconds
+  row[RESPONSE_BYTES] += size
+  row[BUCKETS + bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+
+  key = (view, f'{status // 100}xx')
+  stats.statuses[key] = stats.statuses.get(key, 0) + 1
+
+
+def collect():
+  """Sums every thread's counters into `({view: row}, {(view, status): count})`."""
+  total = ThreadStats()
+  with _registries_lock:
+    _retire_dead_threads()
+    total.add(_retired)
+    registries = list(_registries.values())
+
+  for stats in registries:
+    total.add(stats)
+  return total.views, total.statuses
+
+
+def _sample(lines, name, labels, value):
+  rendered = ','.join(f'{key}="{label}"' for key, label in labels)
+  lines.append(f'{name}{{{rendered}}} {value}')
+
+
+def render():
+  """Renders the collected counters in the Prometheus text exposition format."""
+  views, statuses = collect()
+  lines = []
+
+  lines.append('# HELP heimdall_http_requests_total Requests handled, by view and status class.')
+  lines.append('# TYPE heimdall_http_requests_total counter')
+  for (view, status), count in sorted(statuses.items()):
+    _sample(lines, 'heimdall_http_requests_total', [('view', view), ('status', status)], count)
+
+  lines.append('# HELP heimdall_http_request_duration_seconds Request latency, by view.')
+  lines.append('# TYPE heimdall_http_request_duration_seconds histogram')
+  for view, row in sorted(views.items()):
+    cumulative = 0
+    for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), row[BUCKETS:]):
+      cumulative += count
+      _sample(lines, 'heimdall_http_request_duration_seconds_bucket', [('view', view), ('le', bound)], cumulative)
+    _sample(lines, 'heimdall_http_request_duration_seconds_sum', [('view', view)], row[LATENCY_SUM])
+    _sample(lines, 'heimdall_http_request_duration_seconds_count', [('view', view)], row[COUNT])
+
+  counters = [
+    ('heimdall_sql_queries_total', 'SQL queries executed while handling requests, by view.', SQL_QUERIES),
+    ('heimdall_sql_duration_seconds_total', 'Time spent executing SQL while handling requests, by view.', SQL_SECONDS),
+    ('heimdall_http_response_bytes_total', 'Response body bytes sent (streaming responses excluded), by view.', RESPONSE_BYTES),
+  ]
+  for name, description, column in counters:
+    lines.append(f'# HELP {name} {description}')
+    lines.append(f'# TYPE {name} counter')
+    for view, row in sorted(views.items()):
+      _sample(lines, name, [('view', view)], row[column])
+
+  return '\n'.join(lines) + '\n'
+
+
+class MetricsMiddleware:
+  """Times every request and counts the SQL it runs on any database, keyed by URL name."""
+
+  def __init__(self, get_response):
+    self.get_response = get_response
+
+  def __call__(self, request):
+    sql = [0, 0.0]
+
+    def count_sql(execute, query, params, many, context):
+      started = time.perf_counter()
+      try:
+        return execute(query, params, many, context)
+      finally:
+        sql[0] += 1
+        sql[1] += time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ExitStack() as wrappers:
+      # Reads routed to the replica (see webapp/routers.py) run on a connection of their own
+      for conn in connections.all():
+        wrappers.enter_context(conn.execute_wrapper(count_sql))
+      response = self.get_response(request)
+    elapsed = time.perf_counter() - started
+
+    match = request.resolver_match
+    view = match.url_name if match and match.url_name else 'unresolved'
+    size = 0 if response.streaming else len(response.content)
+    record(view, response.status_code, elapsed, sql[0], sql[1], size)
+    return response
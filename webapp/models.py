@@ -1,13 +1,56 @@
+from collections import Counter
+from datetime import timezone as dt_timezone
+
+from django.db import IntegrityError
 from django.db import models
+from django.db import transaction
+from django.db.models import F
+from django.db.models import Q
 from django.utils import timezone
 
 from django.contrib.auth.models import User
 from django.contrib.auth.models import Group
+from django.contrib.auth.models import GroupManager
+
+from webapp import events
+
+
+# Lock group bits are stored in signed 64-bit integer columns, the sign bit is never used
+MAX_LOCK_GROUPS = 63
+
+
+def group_mask(bits):
+  """
+  Folds lock group bit indexes into a single integer mask.
+
+  Args:
+      bits: Iterable of `LockGroup.bit` values (None values are ignored).
+
+  Returns:
+      The integer with every given bit set.
+  """
+  mask = 0
+  for bit in bits:
+    if bit is not None:
+      mask |= 1 << bit
+  return mask
 
 
 class LockGroup(models.Model):
   name = models.CharField(max_length=255, unique=True)
 
+  # Stable bit index of this group inside `Lock.group_mask` and `UserGroup.lock_group_mask`
+  bit = models.PositiveSmallIntegerField(unique=True, null=True, editable=False)
+
+  def save(self, *args, **kwargs):
+    if self.bit is None:
+      used = set(LockGroup.objects.exclude(bit=None).values_list('bit', flat=True))
+      free = [bit for bit in range(MAX_LOCK_GROUPS) if bit not in used]
+      if not free:
+        raise ValueError(f"No more than {MAX_LOCK_GROUPS} lock groups are supported")
+      self.bit = free[0]
+    super().save(*args, **kwargs)
+
   def tag(self):
     """
     Converts a lock group name to a blog tag format (lowercase, spaces replaced with hyphens).
@@ -24,12 +67,70 @@ class LockGroup(models.Model):
     return f"{self.name}"
 
 
+class MaskQuerySet(models.QuerySet):
+  """Queryset for models carrying a lock group mask column."""
+
+  mask_field = None
+  mask_relation = None
+
+  def sharing_mask(self, mask):
+    """Rows whose mask shares at least one lock group with `mask`, evaluated in SQL."""
+    return self.alias(shared_mask=F(self.mask_field).bitand(mask)).filter(~Q(shared_mask=0))
+
+  def refresh_masks(self):
+    """Recomputes the stored mask of every row in the queryset from its lock groups."""
+    relation = self.model._meta.get_field(self.mask_relation)
+    through = relation.remote_field.through
+    source = relation.m2m_field_name()
+
+    bits = {pk: [] for pk in self.values_list('pk', flat=True)}
+    rows = through.objects.filter(**{f'{source}__in': bits}).values_list(source, 'lockgroup__bit')
+    for pk, bit in rows:
+      bits[pk].append(bit)
+
+    masks = {pk: group_mask(pk_bits) for pk, pk_bits in bits.items()}
+    for pk, mask in masks.items():
+      self.model.objects.filter(pk=pk).update(**{self.mask_field: mask})
+    return masks
+
+  def clear_bit(self, bit):
+    """Removes a lock group bit from every row in the queryset."""
+    return self.update(**{self.mask_field: F(self.mask_field).bitand(~group_mask([bit]))})
+
+
+class UserGroupQuerySet(MaskQuerySet):
+  mask_field = 'lock_group_mask'
+  mask_relation = 'lock_groups'
+
+  def with_access_to(self, lock):
+    """User groups allowed on `lock`."""
+    return self.sharing_mask(lock.group_mask)
+
+
+class UserGroupManager(GroupManager.from_queryset(UserGroupQuerySet)):
+  pass
+
+
+class LockQuerySet(MaskQuerySet):
+  mask_field = 'group_mask'
+  mask_relation = 'groups'
+
+  def accessible_by(self, user_group):
+    """Locks that members of `user_group` may open."""
+    return self.sharing_mask(user_group.lock_group_mask)
+
+
 class UserGroup(Group):
   # Flag to indicate if door should open even with lock pin
   override_lock_pin = models.BooleanField(default=False)
   
   lock_groups = models.ManyToManyField(LockGroup)  # Optional related_name
 
+  # Kept in sync with `lock_groups` by the m2m signal handlers
+  lock_group_mask = models.BigIntegerField(default=0, editable=False)
+
+  objects = UserGroupManager()
+
 
 class Device(models.Model):
   class Status(models.TextChoices):
@@ -42,6 +143,11 @@ class Device(models.Model):
   # The new indicator field
   status = models.CharField(max_length=10, choices=Status.choices, default=Status.UNKNOWN)
 
+  # Reported by the device heartbeat (see webapp/heartbeat.py), indexed to list silent devices
+  last_seen = models.DateTimeField(null=True, blank=True, editable=False, db_index=True)
+  firmware = models.CharField(max_length=64, blank=True, editable=False)
+  rssi = models.SmallIntegerField(null=True, blank=True, editable=False)  # dBm
+
 
 class Lock(models.Model):
   id = models.AutoField(primary_key=True)
@@ -49,14 +155,36 @@ class Lock(models.Model):
   groups = models.ManyToManyField(LockGroup)  # Optional related_name
   device = models.ForeignKey(Device, on_delete=models.CASCADE, null=True)
 
+  # Kept in sync with `groups` by the m2m signal handlers
+  group_mask = models.BigIntegerField(default=0, editable=False)
+
+  # Bumped every time the offline allowlist of this lock changes (see webapp/allowlist.py)
+  allowlist_version = models.PositiveIntegerField(default=0, editable=False)
+
+  objects = LockQuerySet.as_manager()
+
 
 class Card(models.Model):
   id = models.AutoField(primary_key=True)
   uuid = models.CharField(max_length=255, unique=True)
   created_at = models.DateTimeField(auto_now_add=True)
   due_date = models.DateTimeField(blank=True, null=True)
+  # Set when saved past its due date, or by the expiry sweeper once that date passes (see webapp/expiry.py)
+  expired = models.BooleanField(default=False, editable=False)
   user = models.ForeignKey(User, on_delete=models.CASCADE, null=True)
-  
+
+  class Meta:
+    # Live cards by due date: the sweeper's lookups and the lists leaving expired cards out.
+    # Expired cards pile up over the years and are left out of the index altogether.
+    indexes = [models.Index(fields=['due_date'], condition=Q(expired=False), name='card_live_due_date_idx')]
+
+  def save(self, *args, **kwargs):
+    self.expired = self.due_date is not None and self.is_overdue()
+    update_fields = kwargs.get('update_fields')
+    if update_fields is not None and 'due_date' in update_fields:
+      kwargs['update_fields'] = {*update_fields, 'expired'}
+    super().save(*args, **kwargs)
+
   def is_overdue(self):
     """
     Checks if the current datetime is past the due_date of the model instance.
@@ -64,18 +192,125 @@ class Card(models.Model):
     return timezone.now() > self.due_date # datetime.now().astimezone(self.due_date.tzinfo) > self.due_date
 
 
+class AllowlistEntry(models.Model):
+  lock = models.ForeignKey(Lock, on_delete=models.CASCADE, related_name='allowlist_entries')
+  card_hash = models.CharField(max_length=64)
+  due_date = models.DateTimeField(blank=True, null=True)
+  override_lock_pin = models.BooleanField(default=False)
+
+  # Lock allowlist version at which this entry last changed
+  version = models.PositiveIntegerField()
+
+  # Tombstone kept so devices syncing a delta learn about the revocation
+  revoked = models.BooleanField(default=False)
+
+  class Meta:
+    unique_together = [('lock', 'card_hash')]
+    indexes = [models.Index(fields=['lock', 'version'])]
+
+
+class AccessRecordQuerySet(models.QuerySet):
+
+  def bulk_create(self, objs, *args, **kwargs):
+    """Inserts the records and counts them in their hourly rollups, in one transaction."""
+    with transaction.atomic(using=self.db, savepoint=False):
+      objs = super().bulk_create(objs, *args, **kwargs)
+      AccessRollup.objects.add(objs)
+      events.published()
+    return objs
+
+
 class AccessRecord(models.Model):
-  timestamp = models.DateTimeField(auto_now_add=True)
+
+  # Same codes as the decisions returned to the door devices (see webapp/policy.py)
+  class Outcome(models.IntegerChoices):
+    DENIED = 0, 'Denied'
+    GRANTED = 1, 'Granted'
+    DO_NOT_DISTURB = 2, 'Do not disturb'
+
+  # Set when the swipe happens, not when a buffered row reaches the database
+  timestamp = models.DateTimeField(default=timezone.now, editable=False)
   is_locked = models.BooleanField(default=False)
-  card = models.ForeignKey(Card, on_delete=models.CASCADE, null=True)
-  lock = models.ForeignKey(Lock, on_delete=models.CASCADE, null=True)
+  # Null for records logged before outcomes were stored
+  outcome = models.PositiveSmallIntegerField(choices=Outcome.choices, null=True, editable=False)
+  # Covered by the composite indexes below
+  card = models.ForeignKey(Card, on_delete=models.CASCADE, null=True, db_index=False)
+  lock = models.ForeignKey(Lock, on_delete=models.CASCADE, null=True, db_index=False)
 
   class Meta:
     ordering = ['-timestamp']  # Order logs by most recent first
+    # Every listing reads newest first, optionally narrowed to one lock or card
+    indexes = [
+      models.Index(fields=['lock', '-timestamp']),
+      models.Index(fields=['card', '-timestamp']),
+      models.Index(fields=['-timestamp']),
+    ]
+
+  objects = AccessRecordQuerySet.as_manager()
 
   def __str__(self):
     return f"{self.timestamp} - "  # Truncate message for display
 
+  def save(self, *args, **kwargs):
+    adding = self._state.adding
+    with transaction.atomic():
+      super().save(*args, **kwargs)
+      if adding:
+        AccessRollup.objects.add([self])
+        events.published()
+
+
+def hour_of(timestamp):
+  """Truncates an aware datetime to the start of its hour, in UTC."""
+  return timestamp.astimezone(dt_timezone.utc).replace(minute=0, second=0, microsecond=0)
+
+
+class AccessRollupQuerySet(models.QuerySet):
+
+  def add(self, records):
+    """Counts access records in their (lock, hour, outcome) rollups."""
+    counts = Counter((record.lock_id, hour_of(record.timestamp), record.outcome) for record in records)
+    for (lock_id, hour, outcome), count in counts.items():
+      key = {'lock_id': lock_id, 'hour': hour, 'outcome': outcome}
+      if self.filter(**key).update(count=F('count') + count):
+        continue
+      try:
+        with transaction.atomic():
+          self.create(count=count, **key)
+      except IntegrityError:
+        # Created by another writer since the update above
+        self.filter(**key).update(count=F('count') + count)
+
+
+class AccessRollup(models.Model):
+  """Number of access records per lock, hour and outcome, kept up to date as records are written.
+
+  Rollups are never decremented: deleting access records (or the cards they
+  belong to) leaves the counts as they were, `rebuild_access_rollups` recounts them.
+  """
+  lock = models.ForeignKey(Lock, on_delete=models.CASCADE, null=True)
+  hour = models.DateTimeField()  # Start of the hour, in UTC
+  outcome = models.PositiveSmallIntegerField(choices=AccessRecord.Outcome.choices, null=True)
+  count = models.PositiveIntegerField(default=0)
+
+  objects = AccessRollupQuerySet.as_manager()
+
+  class Meta:
+    unique_together = [('lock', 'hour', 'outcome')]
+    indexes = [models.Index(fields=['hour'])]
+
+  def __str__(self):
+    return f"{self.hour} - {self.lock_id}: {self.count}"
+
+
+class ActivityRecordQuerySet(models.QuerySet):
+
+  def bulk_create(self, objs, *args, **kwargs):
+    """Inserts the records and wakes the connected dashboards once committed."""
+    objs = super().bulk_create(objs, *args, **kwargs)
+    events.published()
+    return objs
+
 
 class ActivityRecord(models.Model):
   
@@ -86,7 +321,8 @@ class ActivityRecord(models.Model):
         LOGIN = 'login', 'Login'
         LOGOUT = 'logout', 'Logout'
 
-  timestamp = models.DateTimeField(auto_now_add=True)
+  # Set when the action happens, not when a buffered row reaches the database
+  timestamp = models.DateTimeField(default=timezone.now, editable=False)
   type = models.CharField(max_length=6, choices=Type.choices)
   message = models.TextField()
   
@@ -94,8 +330,32 @@ class ActivityRecord(models.Model):
   user = models.ForeignKey(User, on_delete=models.SET_NULL, blank=True, null=True)
   # Additional data fields can be added based on your needs
 
+  objects = ActivityRecordQuerySet.as_manager()
+
   class Meta:
     ordering = ['-timestamp']  # Order logs by most recent first
+    indexes = [
+      models.Index(fields=['-timestamp']),
+      models.Index(fields=['type', '-timestamp']),
+    ]
+
+  def __str__(self):
+    return f"{self.timestamp} - {self.type}: {self.message[:50]}"  # Truncate message for display
+
+  def save(self, *args, **kwargs):
+    adding = self._state.adding
+    super().save(*args, **kwargs)
+    if adding:
+      events.published()
+
+
+class Generation(models.Model):
+  """Counter moved forward whenever the rows of a model change, versioning the cached admin fragments.
+
+  The 'accesspolicy' row versions the compiled access policy (see webapp/policy.py).
+  """
+  name = models.CharField(max_length=100, primary_key=True)  # Model name, e.g. 'lock'
+  value = models.PositiveBigIntegerField(default=0)
 
   def __str__(self):
-    return f"{self.timestamp} - {self.type}: {self.message[:50]}"  # Truncate message for display
\ No newline at end of file
+    return f"{self.name}: {self.value}"
@@ -0,0 +1,259 @@
+import threading
+import time
+
+from collections import namedtuple
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import F
+from django.db.models import OuterRef
+from django.db.models import Subquery
+from django.utils import timezone
+
+from webapp.models import Card
+from webapp.models import Device
+from webapp.models import Generation
+from webapp.models import Lock
+
+
+# Decision codes returned to the door devices
+NOT_AUTHORIZED = 0
+AUTHORIZED = 1
+DO_NOT_DISTURB = 2
+
+RESPONSE_MESSAGES = {
+  AUTHORIZED: "AUTHORIZED",
+  DO_NOT_DISTURB: "DO NOT DISTURB",
+  NOT_AUTHORIZED: "NOT AUTHORIZED"
+}
+
+# chip_id -> device row, the lock it drives (if any) and that lock's group mask
+DeviceEntry = namedtuple('DeviceEntry', ['device_id', 'status', 'lock_id', 'group_mask'])
+
+# card uuid -> card row plus the lock group mask granted by the owner's UserGroup
+CardEntry = namedtuple('CardEntry', ['card_id', 'due_date', 'lock_group_mask', 'override_lock_pin'])
+
+# Answer to one swipe: response status and message, plus the AccessRecord fields to log (if any)
+Decision = namedtuple('Decision', ['status', 'message', 'record'])
+
+# Generation row moved forward by every change to the policy, shared by all processes
+GENERATION = 'accesspolicy'
+
+
+class AccessPolicy:
+  """Immutable, query-free view of everything `authorize` needs to decide a swipe.
+
+  A policy is compiled from the database in a fixed number of queries and then
+  answers decisions from plain dictionaries. The lock of a device is the first
+  one it drives, the user's effective group is their first Django group, which
+  must also be a `UserGroup`.
+  """
+
+  def __init__(self, devices, cards):
+    self.devices = devices
+    self.cards = cards
+    self.compiled_at = time.monotonic()
+    self.generation = None  # Stored generation the snapshot was compiled at, see `get_policy`
+
+  @classmethod
+  def compile(cls, card_uuids=None, chip_ids=None):
+    """Builds a policy from the current database state in three queries.
+
+    Args:
+        card_uuids: Optional iterable restricting the policy to these cards.
+        chip_ids: Optional iterable restricting the policy to these devices.
+    """
+    devices = Device.objects.order_by('id', 'lock__id')
+    memberships = User.groups.through.objects.order_by('user_id', 'group_id')
+    cards = Card.objects.all()
+    if chip_ids is not None:
+      devices = devices.filter(chip_id__in=chip_ids)
+    if card_uuids is not None:
+      memberships = memberships.filter(user__card__uuid__in=card_uuids).distinct()
+      cards = cards.filter(uuid__in=card_uuids)
+
+    # Every device with its first lock, the same one `Lock.objects.filter(device=...).first()` returns
+    device_entries = {}
+    for device_id, chip_id, status, lock_id, mask in devices.values_list('id', 'chip_id', 'status', 'lock__id', 'lock__group_mask'):
+      if chip_id not in device_entries:
+        device_entries[chip_id] = DeviceEntry(device_id, status, lock_id, mask or 0)
+
+    # Effective group per user, the same one `user.groups.first()` returns, resolved to its UserGroup
+    user_groups = {}
+    rows = memberships.values_list('user_id', 'group__usergroup__lock_group_mask', 'group__usergroup__override_lock_pin')
+    for user_id, mask, override in rows:
+      user_groups.setdefault(user_id, (mask, bool(override)))
+
+    card_entries = {}
+    for card_id, uuid, due_date, user_id in cards.values_list('id', 'uuid', 'due_date', 'user_id'):
+      mask, override = user_groups.get(user_id, (None, False))
+      card_entries[uuid] = CardEntry(card_id, due_date, mask, override)
+
+    return cls(device_entries, card_entries)
+
+  def device(self, chip_id):
+    return self.devices.get(chip_id)
+
+  def card(self, card_uuid):
+    return self.cards.get(card_uuid)
+
+  def decide(self, card, device, is_locked, now=None):
+    """Returns the decision code for a known card swiped at a known device."""
+    if card.lock_group_mask is None or device.lock_id is None:
+      return NOT_AUTHORIZED
+
+    now = now or timezone.now()
+    has_group_access = bool(card.lock_group_mask & device.group_mask)
+    is_valid_card = card.due_date is not None and now <= card.due_date
+
+    if not (has_group_access and is_valid_card):
+      return NOT_AUTHORIZED
+
+    if is_locked and not card.override_lock_pin:
+      return DO_NOT_DISTURB
+
+    return AUTHORIZED
+
+  def evaluate(self, card_uuid, device, is_locked):
+    """Answers a swipe exactly as `authorize` does.
+
+    Returns:
+        A `Decision` whose `record` holds the `AccessRecord` fields to log, or
+        None when the swipe must not be logged.
+    """
+    if device.status != Device.Status.TRUSTED:
+      status_display = dict(Device.Status.choices).get(device.status, device.status)
+      return Decision(NOT_AUTHORIZED, f"DEVICE {status_display.upper()}", None)
+
+    card = self.card(card_uuid)
+    if card is None:
+      return Decision(NOT_AUTHORIZED, "CARD UNKNOWN", None)
+
+    authorized = self.decide(card, device, is_locked)
+    record = {'is_locked': bool(is_locked), 'card_id': card.card_id, 'lock_id': device.lock_id, 'outcome': authorized}
+    return Decision(authorized, RESPONSE_MESSAGES.get(authorized, "ERROR"), record)
+
+
+def resolve(card_uuid, chip_id):
+  """Builds a policy holding just one card and one device, in a single query.
+
+  The device row is annotated with scalar subqueries for its first lock, the
+  card and the UserGroup behind the card owner's first group, so a swipe is
+  decided without a compiled snapshot in one round trip.
+  """
+  first_lock = Lock.objects.filter(device=OuterRef('pk')).order_by('id')
+  card = Card.objects.filter(uuid=card_uuid)
+  first_group = User.groups.through.objects.filter(user__card__uuid=card_uuid).order_by('group_id')
+
+  row = Device.objects.filter(chip_id=chip_id).annotate(
+    lock_id=Subquery(first_lock.values('id')[:1]),
+    lock_group_mask=Subquery(first_lock.values('group_mask')[:1]),
+    card_id=Subquery(card.values('id')[:1]),
+    card_due_date=Subquery(card.values('due_date')[:1]),
+    user_group_mask=Subquery(first_group.values('group__usergroup__lock_group_mask')[:1]),
+    user_group_override=Subquery(first_group.values('group__usergroup__override_lock_pin')[:1]),
+  ).values_list(
+    'id', 'status', 'lock_id', 'lock_group_mask',
+    'card_id', 'card_due_date', 'user_group_mask', 'user_group_override'
+  ).first()
+
+  if row is None:
+    return AccessPolicy({}, {})
+
+  device_id, status, lock_id, lock_mask, card_id, due_date, user_mask, override = row
+  devices = {chip_id: DeviceEntry(device_id, status, lock_id, lock_mask or 0)}
+  cards = {card_uuid: CardEntry(card_id, due_date, user_mask, bool(override))} if card_id is not None else {}
+  return AccessPolicy(devices, cards)
+
+
+def policy_for(card_uuid, chip_id):
+  """Returns the policy `authorize` should use for one swipe.
+
+  This is the shared compiled snapshot, or a single-query `resolve` when
+  `ACCESS_POLICY_TTL` is 0 and snapshots are disabled.
+  """
+  if getattr(settings, 'ACCESS_POLICY_TTL', 60) > 0:
+    return get_policy()
+  return resolve(card_uuid, chip_id)
+
+
+_lock = threading.Lock()
+_policy = None
+_generation = 0
+
+
+def stored_generation():
+  """Reads the shared policy generation, with one primary key lookup."""
+  return Generation.objects.filter(name=GENERATION).values_list('value', flat=True).first() or 0
+
+
+def _is_current(policy, stored, ttl):
+  return policy is not None and policy.generation == stored and time.monotonic() - policy.compiled_at < ttl
+
+
+def get_policy():
+  """Returns the current compiled policy, compiling it on first use or after a change.
+
+  Every call checks the stored generation, so a change committed by any
+  process (another web worker, the reader gateway, a management command)
+  is enforced by the next swipe everywhere. `ACCESS_POLICY_TTL` only bounds
+  how long one snapshot is reused.
+  """
+  global _policy
+
+  # Read before compiling: a change committed meanwhile leaves the snapshot
+  # labelled older than its data, and the next call compiles again
+  stored = stored_generation()
+  ttl = getattr(settings, 'ACCESS_POLICY_TTL', 60)
+  policy = _policy
+  if _is_current(policy, stored, ttl):
+    return policy
+
+  with _lock:
+    policy = _policy
+    if _is_current(policy, stored, ttl):
+      return policy
+    generation = _generation
+    policy = AccessPolicy.compile()
+    policy.generation = stored
+    # Only publish the snapshot if nothing changed while it was being compiled
+    if generation == _generation:
+      _policy = policy
+  return policy
+
+
+def is_registered(chip_id):
+  """Tells whether a device is registered, from the compiled snapshot when it knows the device.
+
+  Unlike swipes, heartbeats need no current policy: a device deleted since the
+  snapshot is skipped when its heartbeat is written. So the stored generation
+  is not read.
+  """
+  snapshot = _policy
+  if snapshot is None and getattr(settings, 'ACCESS_POLICY_TTL', 60) > 0:
+    snapshot = get_policy()
+  if snapshot is not None and snapshot.device(chip_id) is not None:
+    return True
+  return Device.objects.filter(chip_id=chip_id).exists()
+
+
+def _drop_policy():
+  global _policy, _generation
+  _generation += 1
+  _policy = None
+
+
+def invalidate():
+  """
+  Drops the compiled policy of every process.
+
+  The stored generation moves forward in the transaction making the change,
+  so other processes compile again exactly when the change becomes visible
+  to them. This process drops its snapshot now and again once the
+  transaction commits.
+  """
+  if not Generation.objects.filter(name=GENERATION).update(value=F('value') + 1):
+    Generation.objects.get_or_create(name=GENERATION, defaults={'value': 1})
+  _drop_policy()
+  transaction.on_commit(_drop_policy)
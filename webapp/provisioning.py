@@ -0,0 +1,289 @@
+import csv
+import json
+import multiprocessing
+import os
+import time
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from datetime import time as day_time
+
+import django
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from django.utils.dateparse import parse_datetime
+
+from webapp import allowlist
+from webapp import policy
+from webapp.models import Card
+from webapp.models import UserGroup
+
+
+# Rows inserted per `bulk_create`, overridable with `IMPORT_CHUNK_SIZE`
+CHUNK_SIZE = 500
+
+CARD_COLUMNS = ('uuid', 'username', 'due_date')
+USER_COLUMNS = ('first_name', 'last_name', 'username', 'email', 'password', 'group')
+
+# One rejected line of an import file, `key` being the uuid or username it was about
+RowError = namedtuple('RowError', ['line', 'key', 'message'])
+
+# Outcome of an import: the number of rows created, the rejected lines in file order and the time it took
+ImportResult = namedtuple('ImportResult', ['created', 'errors', 'seconds'], defaults=[None])
+
+
+def read_rows(lines, columns, format='csv'):
+  """
+  Reads the rows of an import file, skipping blank lines and an optional header.
+
+  Args:
+      lines: Iterable of text lines, e.g. an open file.
+      columns: Expected column names, in order.
+      format: 'csv', or 'json' for an array of objects keyed by column name.
+
+  Yields:
+      `(line, values)` tuples, `values` being the stripped cells of the row.
+      For JSON, `line` is the position of the object in the array, from 1.
+
+  Raises:
+      ValueError: If the file is not readable as UTF-8 CSV or JSON.
+  """
+  if format == 'json':
+    yield from _read_objects(lines, columns)
+    return
+
+  reader = csv.reader(lines)
+  first = True
+  try:
+    for values in reader:
+      values = [value.strip() for value in values]
+      if not any(values):
+        continue
+      if first and [value.lower() for value in values] == list(columns):
+        first = False
+        continue
+      first = False
+      yield reader.line_num, values
+  except csv.Error as e:
+    raise ValueError(f"Unreadable CSV file, line {reader.line_num}: {e}")
+
+
+def _read_objects(lines, columns):
+  items = json.loads(''.join(lines))
+  if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+    raise ValueError("Expected a JSON array of objects")
+  for line, item in enumerate(items, 1):
+    yield line, ['' if item.get(column) is None else str(item[column]).strip() for column in columns]
+
+
+def parse_due_date(value):
+  """Parses an ISO date or datetime, a bare date keeping the card valid until the end of that day."""
+  parsed = parse_datetime(value)
+  if parsed is None:
+    day = parse_date(value)
+    if day is None:
+      raise ValueError(f"Invalid due date: {value}")
+    parsed = datetime.combine(day, day_time.max)
+  if timezone.is_naive(parsed):
+    parsed = timezone.make_aware(parsed)
+  return parsed
+
+
+def import_cards(lines, dry_run=False):
+  """
+  Creates cards from `uuid,username,due_date` CSV rows.
+
+  Every row is checked before anything is written: usernames are resolved
+  and existing uuids looked up with one query each, repeated uuids are
+  caught in memory. The valid rows are then inserted in chunks, all in one
+  transaction, and the rejected ones reported by line.
+
+  Args:
+      lines: Iterable of CSV text lines.
+      dry_run: Only validate the rows.
+
+  Returns:
+      An `ImportResult`, `created` counting the cards a dry run would create.
+
+  Raises:
+      ValueError: If the file is not readable as UTF-8 CSV.
+  """
+  started = time.monotonic()
+  errors = []
+  rows = {}  # uuid -> (line, username, due_date) of its first occurrence
+  for line, values in read_rows(lines, CARD_COLUMNS):
+    if len(values) != len(CARD_COLUMNS):
+      errors.append(RowError(line, values[0], f"Expected {len(CARD_COLUMNS)} columns, got {len(values)}"))
+      continue
+    uuid, username, due_date = values
+    if not uuid or not username:
+      errors.append(RowError(line, uuid, "Missing uuid or username"))
+      continue
+    if len(uuid) > Card._meta.get_field('uuid').max_length:
+      errors.append(RowError(line, uuid, "Uuid is too long"))
+      continue
+    try:
+      due_date = parse_due_date(due_date)
+    except ValueError as e:
+      errors.append(RowError(line, uuid, str(e)))
+      continue
+    if uuid in rows:
+      first = rows[uuid]
+      reason = "Duplicate of" if first[1:] == (username, due_date) else "Conflicts with"
+      errors.append(RowError(line, uuid, f"{reason} line {first[0]}"))
+      continue
+    rows[uuid] = (line, username, due_date)
+
+  users = dict(User.objects.filter(username__in={row[1] for row in rows.values()}).values_list('username', 'id'))
+  existing = set(Card.objects.filter(uuid__in=rows).values_list('uuid', flat=True))
+
+  cards = []
+  for uuid, (line, username, due_date) in rows.items():
+    if uuid in existing:
+      errors.append(RowError(line, uuid, "Card already exists"))
+    elif username not in users:
+      errors.append(RowError(line, uuid, f"Unknown user: {username}"))
+    else:
+      card = Card(uuid=uuid, user_id=users[username], due_date=due_date)
+      # `bulk_create` skips `Card.save`, which flags the cards already past their due date
+      card.expired = card.is_overdue()
+      cards.append(card)
+
+  if cards and not dry_run:
+    chunk_size = getattr(settings, 'IMPORT_CHUNK_SIZE', CHUNK_SIZE)
+    with transaction.atomic():
+      for start in range(0, len(cards), chunk_size):
+        Card.objects.bulk_create(cards[start:start + chunk_size])
+      # `bulk_create` sends no post_save, do what the Card signal handlers would
+      policy.invalidate()
+      allowlist.schedule_sync()
+
+  return ImportResult(len(cards), sorted(errors), time.monotonic() - started)
+
+
+def hash_passwords(passwords, workers=None):
+  """
+  Hashes passwords with the configured hasher, spread over a pool of processes.
+
+  Password hashing is deliberately slow and holds the GIL, so a thread pool
+  would not help: every worker process hashes its share on its own core.
+
+  Args:
+      passwords: Raw passwords, None or '' giving an unusable password.
+      workers: Processes to use, defaults to `PASSWORD_HASH_WORKERS` or the
+          number of cores. 1 hashes in the calling process.
+
+  Returns:
+      The encoded passwords, in the same order.
+  """
+  if workers is None:
+    workers = getattr(settings, 'PASSWORD_HASH_WORKERS', None) or os.cpu_count() or 1
+  passwords = [password or None for password in passwords]
+  usable = sum(password is not None for password in passwords)
+  if workers <= 1 or usable <= 1:
+    return [make_password(password) for password in passwords]
+
+  workers = min(workers, usable)
+  # Spawned workers set Django up from scratch, the hasher settings come with it
+  with ProcessPoolExecutor(
+    max_workers=workers,
+    mp_context=multiprocessing.get_context('spawn'),
+    initializer=django.setup,
+  ) as pool:
+    return list(pool.map(make_password, passwords, chunksize=max(1, len(passwords) // (workers * 4))))
+
+
+def import_users(lines, format='csv', dry_run=False, workers=None):
+  """
+  Creates users from `first_name,last_name,username,email,password,group` rows.
+
+  Rows are validated first, looking existing usernames and the named user
+  groups up with one query each. The passwords of the valid rows are then
+  hashed in parallel (see `hash_passwords`), and the users and their group
+  memberships inserted with `bulk_create`, all in one transaction. A blank
+  password gives a user who cannot sign in, e.g. a card holder.
+
+  Args:
+      lines: Iterable of CSV or JSON text lines.
+      format: 'csv' or 'json'.
+      dry_run: Only validate the rows, nothing is hashed.
+      workers: Password hashing processes, see `hash_passwords`.
+
+  Returns:
+      An `ImportResult`, `created` counting the users a dry run would create.
+
+  Raises:
+      ValueError: If the file is not readable as UTF-8 CSV or JSON.
+  """
+  started = time.monotonic()
+  errors = []
+  rows = {}  # username -> (line, values) of its first occurrence
+  max_length = User._meta.get_field('username').max_length
+  for line, values in read_rows(lines, USER_COLUMNS, format):
+    if len(values) != len(USER_COLUMNS):
+      errors.append(RowError(line, values[0], f"Expected {len(USER_COLUMNS)} columns, got {len(values)}"))
+      continue
+    first_name, last_name, username, email, password, group = values
+    if not username or not group:
+      errors.append(RowError(line, username, "Missing username or group"))
+      continue
+    try:
+      if len(username) > max_length:
+        raise ValidationError("Username is too long")
+      User.username_validator(username)
+      if email:
+        validate_email(email)
+    except ValidationError as e:
+      errors.append(RowError(line, username, ' '.join(e.messages)))
+      continue
+    if username in rows:
+      first = rows[username]
+      reason = "Duplicate of" if first[1] == values else "Conflicts with"
+      errors.append(RowError(line, username, f"{reason} line {first[0]}"))
+      continue
+    rows[username] = (line, values)
+
+  existing = set(User.objects.filter(username__in=rows).values_list('username', flat=True))
+  groups = dict(UserGroup.objects.filter(name__in={values[5] for _, values in rows.values()}).values_list('name', 'id'))
+
+  valid = []
+  for username, (line, values) in rows.items():
+    if username in existing:
+      errors.append(RowError(line, username, "User already exists"))
+    elif values[5] not in groups:
+      errors.append(RowError(line, username, f"Unknown user group: {values[5]}"))
+    else:
+      valid.append(values)
+
+  if valid and not dry_run:
+    passwords = hash_passwords([values[4] for values in valid], workers)
+    users = [
+      User(first_name=first_name, last_name=last_name, username=username, email=email, password=password)
+      for (first_name, last_name, username, email, _, _), password in zip(valid, passwords)
+    ]
+    Membership = User.groups.through
+    chunk_size = getattr(settings, 'IMPORT_CHUNK_SIZE', CHUNK_SIZE)
+    with transaction.atomic():
+      for start in range(0, len(users), chunk_size):
+        chunk = User.objects.bulk_create(users[start:start + chunk_size])
+        ids = {user.username: user.pk for user in chunk}
+        if None in ids.values():
+          # Backends that cannot return the primary keys of bulk inserted rows
+          ids = dict(User.objects.filter(username__in=ids).values_list('username', 'id'))
+        Membership.objects.bulk_create([
+          Membership(user_id=ids[values[2]], group_id=groups[values[5]])
+          for values in valid[start:start + chunk_size]
+        ])
+      # `bulk_create` sends no m2m_changed, do what the membership signal handlers would
+      policy.invalidate()
+      allowlist.schedule_sync()
+
+  return ImportResult(len(valid), sorted(errors), time.monotonic() - started)
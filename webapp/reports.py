@@ -0,0 +1,128 @@
+import hashlib
+import itertools
+
+from datetime import datetime
+from datetime import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Max
+from django.template.loader import render_to_string
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from weasyprint import HTML
+
+from webapp.jobs import JobRunner
+from webapp.models import AccessRecord
+from webapp.models import Lock
+from webapp.routers import use_replica
+
+
+# Records fetched and laid out at a time, overridable with `REPORT_CHUNK_SIZE`
+CHUNK_SIZE = 500
+
+# Records a single report may hold, overridable with `REPORT_MAX_RECORDS`; see `render_pdf`
+MAX_RECORDS = 20000
+
+report_jobs = JobRunner('REPORT_JOBS', '.pdf')
+
+
+def day_bounds(start=None, end=None):
+  """
+  Converts an inclusive range of dates into the datetimes bounding it.
+
+  Args:
+      start: First day of the range as 'YYYY-MM-DD', or None for no lower bound.
+      end: Last day of the range as 'YYYY-MM-DD', or None for no upper bound.
+
+  Returns:
+      A `(since, until)` tuple of aware datetimes in the current time zone,
+      `until` being exclusive. Either one is None when its day is missing.
+
+  Raises:
+      ValueError: If a day is not a valid 'YYYY-MM-DD' date.
+  """
+  bounds = []
+  for day, offset in ((start, 0), (end, 1)):
+    if not day:
+      bounds.append(None)
+      continue
+    date = parse_date(day)
+    if date is None:
+      raise ValueError(f"Invalid date string format: {day}")
+    bounds.append(timezone.make_aware(datetime.combine(date + timedelta(days=offset), time.min)))
+  return tuple(bounds)
+
+
+def access_records(lock, since=None, until=None):
+  """Returns the access records of a lock in `[since, until)`, with everything the report prints."""
+  records = AccessRecord.objects.filter(lock=lock).select_related('lock__device', 'card__user')
+  if since is not None:
+    records = records.filter(timestamp__gte=since)
+  if until is not None:
+    records = records.filter(timestamp__lt=until)
+  return records
+
+
+def render_pdf(doc_name, records, chunk_size=None, target=None):
+  """
+  Renders an access report as a PDF, one chunk of records at a time.
+
+  Records are streamed from the database with `iterator()` and every chunk is
+  rendered and laid out on its own, so the HTML and the model instances in
+  memory are bounded by the chunk size. The laid out pages are not, WeasyPrint
+  only writes a PDF from a whole document: peak memory is bounded by
+  `max_records()` instead, which the report view enforces before a job is
+  submitted.
+
+  Args:
+      doc_name: Title printed on the report.
+      records: Queryset of the access records to print.
+      chunk_size: Records per chunk, defaults to `REPORT_CHUNK_SIZE`.
+      target: Optional file name or file object to write the PDF to.
+
+  Returns:
+      The PDF document as bytes, or None when written to `target`.
+  """
+  chunk_size = chunk_size or getattr(settings, 'REPORT_CHUNK_SIZE', CHUNK_SIZE)
+  rows = records.iterator(chunk_size=chunk_size)
+
+  document, pages = None, []
+  while True:
+    chunk = list(itertools.islice(rows, chunk_size))
+    # An empty report still gets its header page
+    if not chunk and document is not None:
+      break
+    html = render_to_string('webapp/report.html', {'access_records': chunk, 'doc_name': doc_name})
+    rendered = HTML(string=html).render()
+    document = document or rendered
+    pages.extend(rendered.pages)
+    if len(chunk) < chunk_size:
+      break
+  return document.copy(pages).write_pdf(target)
+
+
+def max_records():
+  return getattr(settings, 'REPORT_MAX_RECORDS', MAX_RECORDS)
+
+
+def job_id(lock, since=None, until=None):
+  """
+  Identifies the report of a lock over a range of time.
+
+  The newest record id in the range is part of the key, so the cached PDF
+  is replaced as soon as a new swipe (or a late buffered one) falls in it.
+
+  Returns:
+      A 32 hex characters digest, usable as a `report_jobs` job id.
+  """
+  last = access_records(lock, since, until).aggregate(last=Max('id'))['last']
+  key = [lock.pk, lock.name, since and since.isoformat(), until and until.isoformat(), last]
+  return hashlib.sha256(repr(key).encode()).hexdigest()[:32]
+
+
+def write_report(path, lock_id, since, until, doc_name):
+  """Renders a report to `path`, run by the `report_jobs` worker processes."""
+  with use_replica():
+    lock = Lock.objects.get(pk=lock_id)
+    render_pdf(doc_name, access_records(lock, since, until), target=path)
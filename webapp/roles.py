@@ -0,0 +1,35 @@
+# Attribute of the user object holding its group names for the rest of the request
+CACHE_ATTR = '_group_names'
+
+
+def group_names(user):
+  """
+  Returns the names of the groups a user belongs to, querying them at most once.
+
+  The names are memoized on the user object. `request.user` is loaded anew
+  for every request, so the decorators, the view and its templates share
+  one lookup per request.
+
+  Args:
+      user: A user, possibly anonymous.
+
+  Returns:
+      A frozenset of group names.
+  """
+  if not user.is_authenticated:
+    return frozenset()
+  names = getattr(user, CACHE_ATTR, None)
+  if names is None:
+    names = frozenset(user.groups.values_list('name', flat=True))
+    setattr(user, CACHE_ATTR, names)
+  return names
+
+
+def in_groups(user, allowed_groups):
+  """Whether the user belongs to any of the allowed groups, superusers always do."""
+  return user.is_superuser or not group_names(user).isdisjoint(allowed_groups)
+
+
+def forget(user):
+  """Drops the memoized group names after the user's groups changed."""
+  user.__dict__.pop(CACHE_ATTR, None)
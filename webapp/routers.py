@@ -0,0 +1,82 @@
+import time
+
+from contextlib import contextmanager
+from functools import wraps
+
+from asgiref.local import Local
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.db import connections
+
+
+# Session key holding the time until which the session reads from the primary
+PIN_KEY = '_db_primary_until'
+
+_state = Local()
+
+
+def read_alias():
+  """Returns the configured read alias, or None when no replica is configured."""
+  alias = getattr(settings, 'DATABASE_READ_ALIAS', None)
+  return alias if alias in connections.settings else None
+
+
+@contextmanager
+def use_replica():
+  """Routes the reads made inside the block to the read alias."""
+  previous = getattr(_state, 'replica', False)
+  _state.replica = True
+  try:
+    yield
+  finally:
+    _state.replica = previous
+
+
+def read_replica(view):
+  """Serves a read-heavy view from the read alias, unless its session wrote recently."""
+  @wraps(view)
+  def wrapper(request, *args, **kwargs):
+    session = getattr(request, 'session', None)
+    if session is not None and session.get(PIN_KEY, 0) > time.time():
+      return view(request, *args, **kwargs)
+    with use_replica():
+      return view(request, *args, **kwargs)
+  return wrapper
+
+
+class ReadReplicaRouter:
+  """Sends writes to the primary and the reads of `read_replica` views to the read alias."""
+
+  def db_for_read(self, model, **hints):
+    if getattr(_state, 'replica', False):
+      return read_alias()
+    return None
+
+  def db_for_write(self, model, **hints):
+    # Session saves happen on most admin requests and never feed a replicated read
+    if model._meta.app_label != 'sessions':
+      _state.wrote = True
+    return DEFAULT_DB_ALIAS
+
+  def allow_relation(self, obj1, obj2, **hints):
+    # The read alias holds the same data as the primary
+    return True
+
+
+class PrimaryPinningMiddleware:
+  """Pins a session to the primary for `DATABASE_REPLICA_STALENESS` seconds after it writes.
+
+  Must come after the session middleware.
+  """
+
+  def __init__(self, get_response):
+    self.get_response = get_response
+
+  def __call__(self, request):
+    _state.wrote = False
+    response = self.get_response(request)
+    # Only signed-in sessions browse the admin views, device requests never get a session
+    user = getattr(request, 'user', None)
+    if _state.wrote and user is not None and user.is_authenticated:
+      request.session[PIN_KEY] = time.time() + getattr(settings, 'DATABASE_REPLICA_STALENESS', 5)
+    return response
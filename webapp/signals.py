@@ -0,0 +1,167 @@
+from django.contrib.auth.models import Group
+from django.contrib.auth.models import User
+from django.db.models.signals import m2m_changed
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from webapp import allowlist
+from webapp import fragments
+from webapp import policy
+from webapp import roles
+from webapp.models import Card
+from webapp.models import Device
+from webapp.models import Lock
+from webapp.models import LockGroup
+from webapp.models import UserGroup
+
+
+# =====================================================================================
+# Lock Group Masks
+# =====================================================================================
+
+def sync_masks(model, instance, reverse, pk_set):
+  queryset = model.objects.all()
+  if reverse:
+    # The instance is the LockGroup, pk_set holds the affected rows (None on clear)
+    if pk_set is not None:
+      queryset = queryset.filter(pk__in=pk_set)
+    queryset.refresh_masks()
+  else:
+    masks = queryset.filter(pk=instance.pk).refresh_masks()
+    setattr(instance, queryset.mask_field, masks.get(instance.pk, 0))
+
+
+@receiver(m2m_changed, sender=Lock.groups.through)
+def sync_lock_mask(sender, instance, action, reverse, pk_set, **kwargs):
+  if action in ('post_add', 'post_remove', 'post_clear'):
+    sync_masks(Lock, instance, reverse, pk_set)
+
+
+@receiver(m2m_changed, sender=UserGroup.lock_groups.through)
+def sync_user_group_mask(sender, instance, action, reverse, pk_set, **kwargs):
+  if action in ('post_add', 'post_remove', 'post_clear'):
+    sync_masks(UserGroup, instance, reverse, pk_set)
+
+
+@receiver(post_delete, sender=LockGroup)
+def release_lock_group_bit(sender, instance, **kwargs):
+  # Membership rows are removed by the cascade without m2m signals
+  Lock.objects.clear_bit(instance.bit)
+  UserGroup.objects.clear_bit(instance.bit)
+
+
+# =====================================================================================
+# Access Policy
+# =====================================================================================
+
+@receiver(post_save, sender=Card)
+@receiver(post_delete, sender=Card)
+@receiver(post_save, sender=Device)
+@receiver(post_delete, sender=Device)
+@receiver(post_save, sender=Lock)
+@receiver(post_delete, sender=Lock)
+@receiver(post_save, sender=LockGroup)
+@receiver(post_delete, sender=LockGroup)
+@receiver(post_save, sender=UserGroup)
+@receiver(post_delete, sender=UserGroup)
+@receiver(post_delete, sender=Group)
+def invalidate_policy(sender, **kwargs):
+  policy.invalidate()
+
+
+@receiver(m2m_changed, sender=Lock.groups.through)
+@receiver(m2m_changed, sender=UserGroup.lock_groups.through)
+@receiver(m2m_changed, sender=User.groups.through)
+def invalidate_policy_on_membership(sender, action, **kwargs):
+  if action in ('post_add', 'post_remove', 'post_clear'):
+    policy.invalidate()
+
+
+# =====================================================================================
+# Offline Allowlists
+# =====================================================================================
+
+@receiver(post_save, sender=Card)
+@receiver(post_delete, sender=Card)
+@receiver(post_save, sender=UserGroup)
+@receiver(post_delete, sender=UserGroup)
+@receiver(post_delete, sender=LockGroup)
+@receiver(post_delete, sender=Group)
+def sync_allowlists(sender, **kwargs):
+  # Whose cards these were, or which locks held a bit, is gone by now: every lock is diffed
+  allowlist.schedule_sync()
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def sync_allowlists_on_membership(sender, action, **kwargs):
+  if action in ('post_add', 'post_remove', 'post_clear'):
+    allowlist.schedule_sync()
+
+
+@receiver(post_save, sender=Lock)
+def sync_lock_allowlist(sender, instance, **kwargs):
+  allowlist.schedule_sync(locks=[instance.pk])
+
+
+@receiver(m2m_changed, sender=Lock.groups.through)
+def sync_allowlists_on_lock_groups(sender, instance, action, reverse, pk_set, **kwargs):
+  if action in ('post_add', 'post_remove', 'post_clear'):
+    if not reverse:
+      allowlist.schedule_sync(locks=[instance.pk])
+    elif pk_set is not None:
+      allowlist.schedule_sync(locks=pk_set)
+    else:
+      allowlist.schedule_sync()
+
+
+@receiver(m2m_changed, sender=UserGroup.lock_groups.through)
+def sync_allowlists_on_grants(sender, instance, action, reverse, pk_set, **kwargs):
+  # Only the locks of the lock groups granted or withdrawn can change
+  if action in ('post_add', 'post_remove', 'post_clear'):
+    if reverse:
+      allowlist.schedule_sync(lock_groups=[instance.pk])
+    elif pk_set is not None:
+      allowlist.schedule_sync(lock_groups=pk_set)
+    else:
+      allowlist.schedule_sync()
+
+
+# =====================================================================================
+# Roles
+# =====================================================================================
+
+@receiver(m2m_changed, sender=User.groups.through)
+def forget_roles_on_membership(sender, instance, action, reverse, **kwargs):
+  # Only the user object at hand is memoized (see `roles.group_names`)
+  if not reverse and action in ('post_add', 'post_remove', 'post_clear'):
+    roles.forget(instance)
+
+
+# =====================================================================================
+# Admin Fragments
+# =====================================================================================
+
+@receiver(post_save, sender=Device)
+@receiver(post_delete, sender=Device)
+@receiver(post_save, sender=Lock)
+@receiver(post_delete, sender=Lock)
+@receiver(post_save, sender=LockGroup)
+@receiver(post_delete, sender=LockGroup)
+@receiver(post_save, sender=UserGroup)
+@receiver(post_delete, sender=UserGroup)
+def bump_generation(sender, **kwargs):
+  fragments.bump(sender)
+
+
+@receiver(post_delete, sender=Group)
+def bump_user_group_generation(sender, **kwargs):
+  # Deleting the Group row behind a UserGroup removes the latter too
+  fragments.bump(UserGroup)
+
+
+@receiver(m2m_changed, sender=Lock.groups.through)
+@receiver(m2m_changed, sender=UserGroup.lock_groups.through)
+def bump_generation_on_membership(sender, action, **kwargs):
+  if action in ('post_add', 'post_remove', 'post_clear'):
+    fragments.bump(Lock if sender is Lock.groups.through else UserGroup)
@@ -1,5 +1,19 @@
 $(document).ready(function () {
-    $('table').DataTable({
-        responsive: true
+    $('table').each(function () {
+        // Tables with a data-source are paged, ordered and searched by the server
+        const source = $(this).data('source');
+        if (source) {
+            $(this).DataTable({
+                responsive: true,
+                serverSide: true,
+                processing: true,
+                searchDelay: 400,
+                ajax: source
+            });
+        } else {
+            $(this).DataTable({
+                responsive: true
+            });
+        }
     });
-});
\ No newline at end of file
+});
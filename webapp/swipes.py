@@ -0,0 +1,53 @@
+from webapp import policy
+from webapp.models import ActivityRecord
+from webapp.models import Device
+from webapp.writebehind import access_log
+from webapp.writebehind import audit_log
+
+
+def authorize(card_uuid, chip_id, is_locked):
+  """
+  Decides one swipe and logs it, for every door-facing entry point.
+
+  Both the `/auth` view and the reader gateway (webapp/gateway.py) answer
+  through here, so a reader gets the same decision over either.
+
+  Args:
+      card_uuid: UUID read from the card.
+      chip_id: Hardware chip id of the reader.
+      is_locked: Whether the door's pin is set.
+
+  Returns:
+      The `policy.Decision` to send back.
+  """
+  access_policy = policy.policy_for(card_uuid, chip_id)
+
+  # --- STEP 1: Device Verification & Auto-Registration ---
+  # Known devices are answered from the compiled policy; new ones are registered as UNKNOWN
+  device = access_policy.device(chip_id)
+  if device is None:
+    device, created = Device.objects.get_or_create(
+      chip_id=chip_id,
+      defaults={'status': Device.Status.UNKNOWN}
+    )
+
+    if created:
+      audit_log.write(
+        type=ActivityRecord.Type.CREATE,
+        message=f"New device {chip_id} connected"
+      )
+    else:
+      # Registered by another worker since our policy was compiled
+      policy.invalidate()
+
+    access_policy = policy.policy_for(card_uuid, chip_id)
+    device = access_policy.device(chip_id)
+
+  # --- STEP 2..4: Device Gate, Card Verification & Logic Delegation ---
+  decision = access_policy.evaluate(card_uuid, device, is_locked)
+
+  # --- STEP 5: Logging ---
+  if decision.record is not None:
+    access_log.write(**decision.record)
+
+  return decision
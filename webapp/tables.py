@@ -0,0 +1,92 @@
+from collections import namedtuple
+from functools import reduce
+from operator import or_
+
+from django.db.models import Q
+from django.http import JsonResponse
+from django.utils import timezone
+from django.utils.formats import date_format
+from django.utils.html import format_html
+
+
+# Rows sent per page when the client asks for "All" (length=-1) or more
+MAX_PAGE_LENGTH = 100
+
+# One table column: the field it is ordered by and the fields a global search looks into
+Column = namedtuple('Column', ['order', 'search'], defaults=[None, ()])
+
+
+def local_datetime(value, format='Y-m-d H:i:s'):
+  """Formats a datetime in the current time zone, as the `date` template filter does."""
+  return date_format(timezone.localtime(value), format) if value else ''
+
+
+def action_button(css_class, icon, url, new_tab=False):
+  """Renders one of the round action buttons of the admin tables."""
+  onclick = f"window.open('{url}', '_blank')" if new_tab else f"location.href='{url}'"
+  return format_html('<button class="btn btn-more {}" onclick="{}"><i class="bi {}"></i></button>', css_class, onclick, icon)
+
+
+def server_side(request, queryset, columns, to_row, row_class=None):
+  """
+  Answers a DataTables server-side processing request with one page of rows.
+
+  Ordering, searching and slicing all happen in SQL, so the cost of a page
+  depends on its length rather than on the size of the table.
+
+  Args:
+      request: GET request carrying the DataTables `draw`, `start`, `length`,
+          `search[value]` and `order[i][column|dir]` parameters.
+      queryset: Every row the user may see, in its default order.
+      columns: A `Column` per table column, in display order.
+      to_row: Function turning an object into its list of (escaped) cells.
+      row_class: Optional function returning a CSS class for an object's row.
+
+  Returns:
+      The JsonResponse expected by DataTables, or a 400 one for bad parameters.
+  """
+  params = request.GET
+  try:
+    draw = int(params.get('draw', 0))
+    start = max(int(params.get('start', 0)), 0)
+    length = int(params.get('length', MAX_PAGE_LENGTH))
+  except ValueError:
+    return JsonResponse({"status": 0, "message": "BAD REQUEST"}, status=400)
+  if length <= 0 or length > MAX_PAGE_LENGTH:
+    length = MAX_PAGE_LENGTH
+
+  total = queryset.count()
+  term = params.get('search[value]', '').strip()
+  lookups = [Q(**{f'{field}__icontains': term}) for column in columns for field in column.search]
+  if term and lookups:
+    queryset = queryset.filter(reduce(or_, lookups))
+    filtered = queryset.count()
+  else:
+    filtered = total
+
+  ordering = []
+  i = 0
+  while f'order[{i}][column]' in params:
+    try:
+      index = int(params[f'order[{i}][column]'])
+      if index < 0:
+        raise IndexError(index)
+      column = columns[index]
+    except (ValueError, IndexError):
+      return JsonResponse({"status": 0, "message": "BAD REQUEST"}, status=400)
+    if column.order:
+      prefix = '-' if params.get(f'order[{i}][dir]') == 'desc' else ''
+      ordering.append(prefix + column.order)
+    i += 1
+  if ordering:
+    # Ties keep a stable order across pages
+    queryset = queryset.order_by(*ordering, '-pk' if ordering[-1].startswith('-') else 'pk')
+
+  data = []
+  for obj in queryset[start:start + length]:
+    row = dict(enumerate(to_row(obj)))
+    if row_class is not None:
+      row['DT_RowClass'] = row_class(obj)
+    data.append(row)
+
+  return JsonResponse({"draw": draw, "recordsTotal": total, "recordsFiltered": filtered, "data": data})
@@ -1,5 +1,7 @@
 from django import template
 
+from webapp import roles
+
 register = template.Library()
 
 
@@ -18,4 +20,4 @@ def remove_from_session(request, key):
 @register.filter
 def in_groups(user, group_list):
     group_names = [g.strip() for g in group_list.split(',')]
-    return user.groups.filter(name__in=group_names).exists() or user.is_superuser
\ No newline at end of file
+    return roles.in_groups(user, group_names)
\ No newline at end of file
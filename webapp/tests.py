@@ -1,3 +1,1464 @@
+import asyncio
+import io
+import json
+import os
+import re
+import socket
+import tempfile
+import threading
+import time
+
+from collections import Counter
+from datetime import datetime
+from datetime import timedelta
+from unittest import skipUnless
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from asgiref.sync import sync_to_async
+
+from django.contrib.auth.hashers import check_password
+from django.contrib.auth.hashers import is_password_usable
+from django.contrib.auth.models import Group
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import OperationalError
+from django.db import connection
+from django.db import connections
 from django.test import TestCase
+from django.test import TransactionTestCase
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from webapp import allowlist
+from webapp import events
+from webapp import expiry
+from webapp import exports
+from webapp import fragments
+from webapp import gateway
+from webapp import heartbeat
+from webapp import jobs
+from webapp import metrics
+from webapp import policy
+from webapp import provisioning
+from webapp import reports
+from webapp import roles
+from webapp import routers
+from webapp.models import AccessRecord
+from webapp.models import AccessRollup
+from webapp.models import AllowlistEntry
+from webapp.models import ActivityRecord
+from webapp.models import Card
+from webapp.models import Device
+from webapp.models import Lock
+from webapp.models import LockGroup
+from webapp.models import MAX_LOCK_GROUPS
+from webapp.models import UserGroup
+from webapp.writebehind import WriteBehindLog
+
+
+# The replica mirror is a second connection that cannot see a TestCase's uncommitted rows
+@override_settings(ACCESS_LOG={'BUFFERED': False}, AUDIT_LOG={'BUFFERED': False}, ALLOWLIST={'BUFFERED': False}, DATABASE_READ_ALIAS=None)
+class AuthorizationTestCase(TestCase):
+  """Shared fixture: one trusted door, one staff card allowed on it."""
+
+  def setUp(self):
+    policy.invalidate()
+    # Generations roll back with every test, the fragments cached for them do not
+    cache.clear()
+
+    self.lock_group = LockGroup.objects.create(name='Main Building')
+    self.user_group = UserGroup.objects.create(name='Staff')
+    self.user_group.lock_groups.set([self.lock_group])
+
+    self.device = Device.objects.create(chip_id='chip-1', status=Device.Status.TRUSTED)
+    self.lock = Lock.objects.create(name='Front Door', device=self.device)
+    self.lock.groups.set([self.lock_group])
+
+    self.user = User.objects.create_user(username='alice', password='secret')
+    self.user.groups.set([self.user_group])
+    self.card = Card.objects.create(uuid='card-1', user=self.user, due_date=timezone.now() + timedelta(days=1))
+
+  def swipe(self, uuid='card-1', chip_id='chip-1', status=0):
+    response = self.client.get(reverse('auth'), {'uuid': uuid, 'dev': chip_id, 'status': status})
+    return response.json()
+
+
+class AccessPolicyTests(AuthorizationTestCase):
+
+  def test_decisions(self):
+    self.assertEqual(self.swipe(), {'status': 1, 'message': 'AUTHORIZED'})
+    self.assertEqual(self.swipe(status=1), {'status': 2, 'message': 'DO NOT DISTURB'})
+    self.assertEqual(self.swipe(uuid='nope'), {'status': 0, 'message': 'CARD UNKNOWN'})
+    self.assertEqual(self.swipe(chip_id='chip-2'), {'status': 0, 'message': 'DEVICE UNKNOWN'})
+    self.assertEqual(AccessRecord.objects.filter(card=self.card, lock=self.lock).count(), 2)
+
+  def test_warm_policy_decides_without_lookups(self):
+    access_policy = policy.get_policy()
+    with CaptureQueriesContext(connection) as queries:
+      card = access_policy.card('card-1')
+      device = access_policy.device('chip-1')
+      self.assertEqual(access_policy.decide(card, device, 0), policy.AUTHORIZED)
+    self.assertEqual(len(queries), 0)
+
+  def test_changes_from_other_processes_apply_to_the_next_swipe(self):
+    self.assertEqual(self.swipe()['status'], 1)
+    # As in another worker: the stored generation moves, this process's snapshot is left alone
+    with mock.patch('webapp.policy._drop_policy'):
+      self.card.delete()
+    self.assertEqual(self.swipe(), {'status': 0, 'message': 'CARD UNKNOWN'})
+
+  def test_current_snapshot_costs_one_lookup(self):
+    self.swipe()
+    with self.assertNumQueries(1):
+      self.assertIs(policy.get_policy(), policy._policy)
+
+  def test_signals_invalidate_policy(self):
+    self.assertEqual(self.swipe()['status'], 1)
+
+    self.user_group.lock_groups.clear()
+    self.assertEqual(self.swipe()['status'], 0)
+
+    self.user_group.lock_groups.add(self.lock_group)
+    self.card.due_date = timezone.now() - timedelta(days=1)
+    self.card.save()
+    self.assertEqual(self.swipe()['status'], 0)
+
+    self.card.due_date = timezone.now() + timedelta(days=1)
+    self.card.save()
+    self.user.groups.clear()
+    self.assertEqual(self.swipe()['status'], 0)
+
+
+class LockGroupMaskTests(AuthorizationTestCase):
+
+  def test_masks_follow_membership(self):
+    self.lock.refresh_from_db()
+    self.user_group.refresh_from_db()
+    self.assertEqual(self.lock.group_mask, 1 << self.lock_group.bit)
+    self.assertEqual(self.user_group.lock_group_mask, 1 << self.lock_group.bit)
+
+    other = LockGroup.objects.create(name='Annex')
+    self.assertNotEqual(other.bit, self.lock_group.bit)
+    other.lock_set.add(self.lock)
+    self.lock.refresh_from_db()
+    self.assertEqual(self.lock.group_mask, (1 << self.lock_group.bit) | (1 << other.bit))
+
+    self.lock_group.delete()
+    self.lock.refresh_from_db()
+    self.user_group.refresh_from_db()
+    self.assertEqual(self.lock.group_mask, 1 << other.bit)
+    self.assertEqual(self.user_group.lock_group_mask, 0)
+
+  def test_masks_in_sql(self):
+    closed = Lock.objects.create(name='Server Room')
+    self.assertQuerySetEqual(Lock.objects.accessible_by(self.user_group), [self.lock])
+    self.assertQuerySetEqual(UserGroup.objects.with_access_to(self.lock), [self.user_group])
+    self.assertFalse(UserGroup.objects.with_access_to(closed).exists())
+
+
+  def test_creating_a_lock_group_past_the_mask_width_is_reported(self):
+    LockGroup.objects.bulk_create([LockGroup(name=f'Wing {bit}', bit=bit) for bit in range(1, MAX_LOCK_GROUPS)])
+    User.objects.create_superuser(username='root', password='secret')
+    self.client.login(username='root', password='secret')
+
+    response = self.client.post(reverse('group_lock_create'), {'name': 'Annex'})
+    self.assertRedirects(response, reverse('group_lock_list'), fetch_redirect_response=False)
+    self.assertFalse(LockGroup.objects.filter(name='Annex').exists())
+    self.assertEqual(self.client.session['message']['type'], 'danger')
+
+
+class WriteBehindLogTests(AuthorizationTestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.spool_dir = tempfile.mkdtemp()
+    self.options = {'BUFFERED': True, 'SPOOL_DIR': self.spool_dir}
+
+  def test_rows_are_buffered_until_flushed(self):
+    with self.settings(ACCESS_LOG=self.options):
+      log = WriteBehindLog(AccessRecord, 'ACCESS_LOG', start_thread=False)
+      for _ in range(3):
+        log.write(is_locked=False, card_id=self.card.id, lock_id=self.lock.id)
+      self.assertEqual(AccessRecord.objects.count(), 0)
+
+      log.flush()
+      self.assertEqual(AccessRecord.objects.count(), 3)
+      # Every spooled row was acknowledged, so the spool starts over
+      self.assertEqual(os.path.getsize(log._spool.name), 0)
+
+  def test_orphaned_spool_is_replayed(self):
+    timestamp = timezone.now().isoformat()
+    row = {'is_locked': True, 'card_id': self.card.id, 'lock_id': self.lock.id, 'timestamp': timestamp}
+    with open(os.path.join(self.spool_dir, 'accessrecord-0.spool'), 'w') as spool:
+      spool.write(json.dumps({'seq': 1, 'row': row}) + '\n')
+      spool.write(json.dumps({'seq': 2, 'row': row}) + '\n')
+      spool.write(json.dumps({'ack': [1]}) + '\n')
+      spool.write('{"seq": 3, "row"')  # Torn by the crash
+
+    with self.settings(ACCESS_LOG=self.options):
+      log = WriteBehindLog(AccessRecord, 'ACCESS_LOG', start_thread=False)
+      self.assertEqual(log.replay(), 1)
+    self.assertEqual(AccessRecord.objects.get().timestamp.isoformat(), timestamp)
+    self.assertEqual(os.listdir(self.spool_dir), [])
+
+  def test_spool_left_with_the_same_pid_is_replayed(self):
+    # A restarted container worker gets the pid of the one that crashed
+    row = {'is_locked': True, 'card_id': self.card.id, 'lock_id': self.lock.id, 'timestamp': timezone.now().isoformat()}
+    with open(os.path.join(self.spool_dir, f'accessrecord-{os.getpid()}.spool'), 'w') as spool:
+      spool.write(json.dumps({'seq': 1, 'row': row}) + '\n')
+
+    with self.settings(ACCESS_LOG=self.options):
+      log = WriteBehindLog(AccessRecord, 'ACCESS_LOG', start_thread=False)
+      log.write(is_locked=False, card_id=self.card.id, lock_id=self.lock.id)
+      self.assertEqual(log.replay(), 1)
+      log.flush()
+    self.assertEqual(AccessRecord.objects.count(), 2)
+    self.assertEqual(os.listdir(self.spool_dir), [os.path.basename(log._spool.name)])
+
+  def test_locked_database_defers_rows_instead_of_blocking(self):
+    with self.settings(ACCESS_LOG={**self.options, 'RETRIES': 2, 'RETRY_DELAY': 0}):
+      log = WriteBehindLog(AccessRecord, 'ACCESS_LOG', start_thread=False)
+      log.write(is_locked=False, card_id=self.card.id, lock_id=self.lock.id)
+      locked = OperationalError('database is locked')
+      with mock.patch.object(AccessRecord.objects, 'bulk_create', side_effect=locked) as bulk_create:
+        log.flush()
+      self.assertEqual(bulk_create.call_count, 3)
+      self.assertEqual(AccessRecord.objects.count(), 0)
+      # Still in the spool, should the process die before the next flush
+      self.assertGreater(os.path.getsize(log._spool.name), 0)
+
+      log.flush()
+    self.assertEqual(AccessRecord.objects.count(), 1)
+    self.assertEqual(os.path.getsize(log._spool.name), 0)
+
+  def test_audit_rows_keep_the_time_and_order_of_the_actions(self):
+    with self.settings(AUDIT_LOG=self.options):
+      log = WriteBehindLog(ActivityRecord, 'AUDIT_LOG', start_thread=False)
+      for i in range(3):
+        log.write(type=ActivityRecord.Type.UPDATE, message=f'Step {i}', user_id=self.user.pk)
+      written = timezone.now()
+      log.flush()
+
+    records = ActivityRecord.objects.filter(user=self.user).order_by('timestamp', 'pk')
+    self.assertEqual([record.message for record in records], ['Step 0', 'Step 1', 'Step 2'])
+    self.assertTrue(all(record.timestamp <= written for record in records))
+
+  def test_admin_actions_are_logged_through_the_audit_log(self):
+    User.objects.create_superuser(username='root', password='secret')
+    with mock.patch('webapp.views.audit_log') as audit_log:
+      self.client.post(reverse('login'), {'username': 'root', 'password': 'secret'})
+    audit_log.write.assert_called_once()
+    self.assertEqual(audit_log.write.call_args.kwargs['type'], ActivityRecord.Type.LOGIN)
+
+
+# Foreign keys are only checked when a transaction commits, which a TestCase never does
+class WriteBehindIntegrityTests(TransactionTestCase):
+
+  def test_rows_of_deleted_users_are_kept(self):
+    user = User.objects.create_user(username='alice')
+    with self.settings(AUDIT_LOG={'BUFFERED': True, 'SPOOL_DIR': None}):
+      log = WriteBehindLog(ActivityRecord, 'AUDIT_LOG', start_thread=False)
+      log.write(type=ActivityRecord.Type.LOGOUT, message='Bye', user_id=user.pk)
+      user.delete()
+      log.flush()
+    # As if the row had been written before the user was deleted
+    self.assertIsNone(ActivityRecord.objects.get(message='Bye').user)
+
+  def test_flush_writes_the_batch_held_by_the_writer_thread(self):
+    with self.settings(AUDIT_LOG={'BUFFERED': True, 'SPOOL_DIR': None, 'FLUSH_INTERVAL': 3600}):
+      log = WriteBehindLog(ActivityRecord, 'AUDIT_LOG')
+      for i in range(50):
+        log.write(type=ActivityRecord.Type.UPDATE, message=f'Row {i}')
+      # Taken off the queue, then held until the batch fills up or the interval is over
+      while log._queue.qsize():
+        time.sleep(0.01)
+      time.sleep(0.1)
+      self.assertEqual(ActivityRecord.objects.count(), 0)
+
+      log.flush()
+    self.assertEqual(ActivityRecord.objects.count(), 50)
+
+
+class AuthBenchCommandTests(TransactionTestCase):
+
+  # The test runner has set up the test environment already
+  @mock.patch('webapp.management.commands.authbench.setup_test_environment')
+  @mock.patch('webapp.management.commands.authbench.teardown_test_environment')
+  def test_smoke(self, *mocks):
+    spool_dir = tempfile.mkdtemp()
+    out = io.StringIO()
+    with self.settings(ACCESS_LOG={'SPOOL_DIR': spool_dir}, AUDIT_LOG={'SPOOL_DIR': spool_dir}):
+      call_command('authbench', users=20, locks=3, swipes=50, concurrency=2, in_place=True, stdout=out)
+    report = json.loads(out.getvalue())
+    self.assertEqual((report['requests'], report['errors']), (50, 0))
+    self.assertFalse(allowlist.syncs.pending())
+    # Seeded rows are removed again, and nothing is left to replay
+    self.assertFalse(Card.objects.exists())
+    self.assertFalse(any(os.path.getsize(os.path.join(spool_dir, name)) for name in os.listdir(spool_dir)))
+
+
+# The gateway decides swipes on threads of its own, which only see committed rows
+@override_settings(ACCESS_LOG={'BUFFERED': False}, AUDIT_LOG={'BUFFERED': False}, ALLOWLIST={'BUFFERED': False}, DATABASE_READ_ALIAS=None)
+class GatewayTests(TransactionTestCase):
+
+  def setUp(self):
+    policy.invalidate()
+    lock_group = LockGroup.objects.create(name='Main Building')
+    user_group = UserGroup.objects.create(name='Staff')
+    user_group.lock_groups.set([lock_group])
+    device = Device.objects.create(chip_id='chip-1', status=Device.Status.TRUSTED)
+    Lock.objects.create(name='Front Door', device=device).groups.set([lock_group])
+    user = User.objects.create_user(username='alice')
+    user.groups.set([user_group])
+    Card.objects.create(uuid='card-1', user=user, due_date=timezone.now() + timedelta(days=1))
+
+  def test_frames(self):
+    request = gateway.Request(7, 'chip-1', 'card-ü', True)
+    self.assertEqual(gateway.decode_request(gateway.encode_request(request)), request)
+    response = gateway.Response(7, 1, 'AUTHORIZED')
+    self.assertEqual(gateway.decode_response(gateway.encode_response(response)), response)
+
+    frame = gateway.encode_request(request)
+    for bad in (frame[:4], frame[:-1], frame + b'x', b'\x02' + frame[1:]):
+      with self.assertRaises(ValueError):
+        gateway.decode_request(bad)
+
+  def test_tcp_answers_like_http(self):
+    swipes = [('card-1', 'chip-1', 0), ('card-1', 'chip-1', 1), ('card-9', 'chip-1', 0), ('card-1', 'chip-2', 0)]
+    expected = [self.client.get(reverse('auth'), {'uuid': u, 'dev': d, 'status': s}).json() for u, d, s in swipes]
+    logged = AccessRecord.objects.count()
+    Device.objects.filter(chip_id='chip-2').delete()
+
+    with gateway.running(udp=False) as (host, port):
+      client = gateway.Client(host, port)
+      answers = [client.authorize(*swipe) for swipe in swipes]
+      client.close()
+
+    self.assertEqual([{"status": a.status, "message": a.message} for a in answers], expected)
+    self.assertEqual(AccessRecord.objects.count(), 2 * logged)
+    self.assertTrue(Device.objects.filter(chip_id='chip-2', status=Device.Status.UNKNOWN).exists())
+
+  def test_revocations_from_other_processes_apply_at_once(self):
+    with gateway.running(udp=False) as (host, port):
+      client = gateway.Client(host, port)
+      self.assertEqual(client.authorize('card-1', 'chip-1').message, 'AUTHORIZED')
+      # Revoked as by a web worker: only the stored generation tells the gateway
+      with mock.patch('webapp.policy._drop_policy'):
+        Card.objects.get(uuid='card-1').delete()
+      self.assertEqual(client.authorize('card-1', 'chip-1').message, 'CARD UNKNOWN')
+      client.close()
+
+  def test_connections_are_multiplexed(self):
+    with gateway.running(udp=False, workers=2) as (host, port):
+      clients = [gateway.Client(host, port) for _ in range(200)]
+      answers = {client.authorize('card-1', 'chip-1').message for client in clients}
+      for client in clients:
+        client.close()
+    self.assertEqual(answers, {'AUTHORIZED'})
+    self.assertEqual(AccessRecord.objects.count(), 200)
+
+  def test_udp_retries_are_decided_once(self):
+    frame = gateway.encode_request(gateway.Request(42, 'chip-1', 'card-1', False))
+    with gateway.running() as (host, port):
+      with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(5)
+        sock.connect((host, port))
+        answers = []
+        for _ in range(2):
+          sock.send(frame)
+          answers.append(gateway.decode_response(sock.recv(512)))
+    self.assertEqual(answers, [gateway.Response(42, policy.AUTHORIZED, 'AUTHORIZED')] * 2)
+    self.assertEqual(AccessRecord.objects.count(), 1)
+
+  def test_malformed_frame_closes_the_connection(self):
+    with gateway.running(udp=False) as (host, port):
+      with socket.create_connection((host, port), timeout=5) as sock:
+        sock.sendall(b'\x09' + gateway.encode_request(gateway.Request(3, 'chip-1', 'card-1', False))[1:])
+        data = b''
+        while chunk := sock.recv(512):
+          data += chunk
+    self.assertEqual(gateway.decode_response(data), gateway.Response(3, gateway.BAD_REQUEST, 'BAD REQUEST'))
+    self.assertEqual(AccessRecord.objects.count(), 0)
+
+
+class AuthorizeBatchTests(AuthorizationTestCase):
+
+  def test_batch_matches_single_swipes(self):
+    swipes = [
+      ['card-1', 'chip-1', 0],
+      ['card-1', 'chip-1', 1],
+      ['nope', 'chip-1', 0],
+      ['card-1', 'chip-2', 0],
+      ['card-1', 'chip-2', 0],
+    ]
+    with CaptureQueriesContext(connection) as queries:
+      response = self.client.post(reverse('auth_batch'), json.dumps(swipes), content_type='application/json')
+    batch = response.json()['results']
+
+    self.assertEqual(AccessRecord.objects.count(), 2)
+    self.assertTrue(Device.objects.filter(chip_id='chip-2', status=Device.Status.UNKNOWN).exists())
+    # Three policy lookups, the device lookup, registration and the policy generation bump, one bulk insert
+    # of access records, then an update and an insert for each of the two new (lock, hour, outcome) rollups
+    self.assertEqual(len([q for q in queries if not q['sql'].startswith(('SAVEPOINT', 'RELEASE'))]), 12)
+
+    single = [self.swipe(uuid, chip_id, status) for uuid, chip_id, status in swipes]
+    self.assertEqual(batch, single)
+
+  def test_malformed_batch(self):
+    for body in ('[["card-1"]]', '[["card-1", "chip-1", 0], ["card-1", 7, 0]]', '[{"uuid": "card-1", "dev": null}]', '["card-1"]', '["ab1"]'):
+      response = self.client.post(reverse('auth_batch'), body, content_type='application/json')
+      self.assertEqual(response.status_code, 400, body)
+    self.assertFalse(Device.objects.filter(chip_id='b').exists())
+
+  def test_devices_registered_meanwhile_are_not_logged_again(self):
+    compile = policy.AccessPolicy.compile
+
+    def compile_then_register(**kwargs):
+      compiled = compile(**kwargs)
+      Device.objects.create(chip_id='chip-2')  # By another worker, after the policy was compiled
+      return compiled
+
+    swipes = [['card-1', 'chip-2', 0], ['card-1', 'chip-3', 0]]
+    with mock.patch('webapp.policy.AccessPolicy.compile', side_effect=compile_then_register):
+      self.client.post(reverse('auth_batch'), json.dumps(swipes), content_type='application/json')
+    messages = ActivityRecord.objects.filter(type=ActivityRecord.Type.CREATE).values_list('message', flat=True)
+    self.assertEqual(list(messages), ["New device chip-3 connected"])
+
+
+@override_settings(ACCESS_POLICY_TTL=0)
+class SingleQueryResolverTests(AuthorizationTestCase):
+  """Without the compiled snapshot every swipe costs one lookup plus the access record writes."""
+
+  # Access record insert, then the rollup update and (first swipe of the hour) insert
+  LOGGED = 3
+
+  def assertSwipe(self, expected, max_queries, **kwargs):
+    with CaptureQueriesContext(connection) as queries:
+      response = self.swipe(**kwargs)
+    self.assertEqual(response, expected)
+    queries = [q['sql'] for q in queries if not q['sql'].startswith(('SAVEPOINT', 'RELEASE'))]
+    self.assertLessEqual(len(queries), max_queries, queries)
+
+  def test_authorized(self):
+    self.assertSwipe({'status': 1, 'message': 'AUTHORIZED'}, 1 + self.LOGGED)
+
+  def test_do_not_disturb(self):
+    self.assertSwipe({'status': 2, 'message': 'DO NOT DISTURB'}, 1 + self.LOGGED, status=1)
+
+  def test_not_authorized(self):
+    self.user_group.lock_groups.clear()
+    self.assertSwipe({'status': 0, 'message': 'NOT AUTHORIZED'}, 1 + self.LOGGED)
+
+  def test_card_unknown(self):
+    self.assertSwipe({'status': 0, 'message': 'CARD UNKNOWN'}, 1, uuid='nope')
+
+  def test_device_unknown(self):
+    Device.objects.create(chip_id='chip-2')
+    self.assertSwipe({'status': 0, 'message': 'DEVICE UNKNOWN'}, 1, chip_id='chip-2')
+
+  def test_non_user_group_membership(self):
+    self.user.groups.set([Group.objects.create(name='Plain')])
+    self.assertSwipe({'status': 0, 'message': 'NOT AUTHORIZED'}, 1 + self.LOGGED)
+
+
+class AllowlistTests(AuthorizationTestCase):
+
+  def fetch(self, since=0, chip_id='chip-1'):
+    return self.client.get(reverse('auth_allowlist'), {'dev': chip_id, 'since': since})
+
+  def test_versioned_deltas(self):
+    allowlist.sync()
+    first = self.fetch().json()
+    self.assertTrue(first['full'])
+    self.assertEqual([entry[0] for entry in first['grant']], [allowlist.card_hash('card-1')])
+    self.assertEqual(first['grant'][0][1], int(self.card.due_date.timestamp()))
+
+    # Nothing changed for this lock, the delta is empty
+    self.assertEqual(allowlist.sync(), 0)
+    self.assertEqual(self.fetch(first['version']).json()['grant'], [])
+
+    bob = User.objects.create_user(username='bob')
+    bob.groups.set([self.user_group])
+    with self.captureOnCommitCallbacks(execute=True):
+      Card.objects.create(uuid='card-2', user=bob, due_date=timezone.now() + timedelta(days=1))
+      self.user.groups.clear()
+
+    second = self.fetch(first['version']).json()
+    self.assertGreater(second['version'], first['version'])
+    self.assertFalse(second['full'])
+    self.assertEqual([entry[0] for entry in second['grant']], [allowlist.card_hash('card-2')])
+    self.assertEqual(second['revoke'], [allowlist.card_hash('card-1')])
+
+  def test_changes_only_sync_the_locks_they_touch(self):
+    other = Lock.objects.create(name='Back Door', device=Device.objects.create(chip_id='chip-2'))
+    allowlist.sync()
+    versions = dict(Lock.objects.values_list('pk', 'allowlist_version'))
+
+    annex = LockGroup.objects.create(name='Annex')
+    with self.captureOnCommitCallbacks(execute=True):
+      other.groups.add(annex)
+    with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True):
+      self.user_group.lock_groups.add(annex)
+    entries = [query for query in queries if query['sql'].startswith('SELECT') and 'webapp_allowlistentry' in query['sql']]
+    self.assertEqual(len(entries), 1)  # Only the lock of the granted group was diffed
+    self.assertGreater(Lock.objects.get(pk=other.pk).allowlist_version, versions[other.pk])
+    self.assertEqual(Lock.objects.get(pk=self.lock.pk).allowlist_version, versions[self.lock.pk])
+
+  @override_settings(ALLOWLIST={'DELAY': 3600})
+  def test_buffered_syncs_are_coalesced_off_the_request_path(self):
+    self.addCleanup(allowlist.syncs.flush)
+    allowlist.sync()
+    with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True):
+      for i in range(3):
+        Card.objects.create(uuid=f'guest-{i}', user=self.user, due_date=timezone.now() + timedelta(days=1))
+    self.assertFalse([query for query in queries if 'webapp_allowlistentry' in query['sql']])
+    self.assertTrue(allowlist.syncs.pending())
+
+    self.assertEqual(allowlist.syncs.flush(), 1)
+    self.assertFalse(allowlist.syncs.pending())
+    self.assertEqual(len(self.fetch().json()['grant']), 4)
+
+  def test_untrusted_device(self):
+    Device.objects.create(chip_id='chip-2')
+    self.assertEqual(self.fetch(chip_id='chip-2').status_code, 403)
+
+
+class MetricsTests(AuthorizationTestCase):
+
+  def test_metrics_are_admin_only(self):
+    response = self.client.get(reverse('metrics'))
+    self.assertEqual(response.status_code, 302)
+
+  def test_requests_are_recorded_per_view(self):
+    self.swipe()
+    User.objects.create_superuser(username='root', password='secret')
+    self.client.login(username='root', password='secret')
+
+    body = self.client.get(reverse('metrics')).content.decode()
+    self.assertIn('heimdall_http_requests_total{view="auth",status="2xx"}', body)
+    self.assertIn('heimdall_http_request_duration_seconds_bucket{view="auth",le="+Inf"}', body)
+    self.assertIn('heimdall_sql_queries_total{view="auth"}', body)
+
+  def test_exited_threads_are_folded_into_a_total(self):
+    before = metrics.collect()[1].get(('retired', '2xx'), 0)
+    for _ in range(3):
+      thread = threading.Thread(target=metrics.record, args=('retired', 200, 0.01, 1, 0.001, 10))
+      thread.start()
+      thread.join()
+    self.assertEqual(metrics.collect()[1][('retired', '2xx')], before + 3)
+    self.assertFalse([thread for thread in metrics._registries if not thread.is_alive()])
+
+
+class ReportTests(AuthorizationTestCase):
+
+  def setUp(self):
+    super().setUp()
+    User.objects.create_superuser(username='root', password='secret')
+    self.client.login(username='root', password='secret')
+    for day in (1, 2, 3):
+      at = timezone.make_aware(datetime(2024, 5, day, 12))
+      AccessRecord.objects.create(timestamp=at, card=self.card, lock=self.lock)
+
+  def test_day_bounds_are_inclusive(self):
+    since, until = reports.day_bounds('2024-05-02', '2024-05-02')
+    self.assertEqual(reports.access_records(self.lock, since, until).count(), 1)
+    self.assertEqual(reports.access_records(self.lock, *reports.day_bounds('2024-05-02')).count(), 2)
+    self.assertEqual(reports.day_bounds(), (None, None))
+    with self.assertRaises(ValueError):
+      reports.day_bounds('2024-13-01')
+
+  @mock.patch('webapp.reports.HTML')
+  def test_records_are_rendered_in_chunks(self, html):
+    html.return_value.render.return_value.pages = ['page']
+    reports.render_pdf('Front Door', reports.access_records(self.lock), chunk_size=2)
+    self.assertEqual(html.call_count, 2)
+    html.return_value.render.return_value.copy.assert_called_once_with(['page', 'page'])
+
+  @mock.patch('webapp.reports.HTML')
+  def test_report_view(self, html):
+    def write_pdf(target):
+      with open(target, 'wb') as f:
+        f.write(b'%PDF')
+    html.return_value.render.return_value.copy.return_value.write_pdf.side_effect = write_pdf
+
+    with self.settings(REPORT_JOBS={'WORKERS': 0, 'ARTIFACT_DIR': tempfile.mkdtemp()}):
+      url = reverse('report', args=['Front Door'])
+      response = self.client.get(url, {'from': '2024-05-01', 'to': '2024-05-02'})
+      self.assertEqual(response.status_code, 200)
+      self.assertEqual(response['Content-Type'], 'application/pdf')
+      self.assertEqual(b''.join(response.streaming_content), b'%PDF')
+      self.assertIn('card-1', html.call_args.kwargs['string'])
+
+      # Served from the cache until a new record falls in the range
+      self.client.get(url, {'from': '2024-05-01', 'to': '2024-05-02'})
+      self.assertEqual(html.call_count, 1)
+      AccessRecord.objects.create(timestamp=timezone.make_aware(datetime(2024, 5, 2, 18)), card=self.card, lock=self.lock)
+      self.client.get(url, {'from': '2024-05-01', 'to': '2024-05-02'})
+      self.assertEqual(html.call_count, 2)
+
+      self.assertEqual(self.client.get(url, {'from': 'May'}).status_code, 400)
+      with self.settings(REPORT_MAX_RECORDS=2):
+        self.assertEqual(self.client.get(url).status_code, 400)
+        self.assertEqual(html.call_count, 2)
+      self.assertEqual(self.client.get(reverse('report', args=['Back Door'])).status_code, 404)
+      self.assertEqual(self.client.get(reverse('report_job', args=['0' * 32])).status_code, 404)
+
+
+class ExportTests(AuthorizationTestCase):
+
+  def setUp(self):
+    super().setUp()
+    User.objects.create_superuser(username='root', password='secret')
+    self.client.login(username='root', password='secret')
+    self.other = Card.objects.create(uuid='card-2', due_date=timezone.now())
+    for day in (1, 2, 3):
+      at = timezone.make_aware(datetime(2024, 5, day, 12))
+      AccessRecord.objects.create(timestamp=at, card=self.card, lock=self.lock, is_locked=day == 3)
+    AccessRecord.objects.create(card=self.other, lock=self.lock)
+
+  def export(self, name, **params):
+    response = self.client.get(reverse(name), params)
+    self.assertEqual(response.status_code, 200)
+    self.assertTrue(response.streaming)
+    return b''.join(response.streaming_content).decode()
+
+  def test_access_csv(self):
+    lines = self.export('export_access', user='alice', to='2024-05-02').splitlines()
+    self.assertEqual(lines[0], 'id,timestamp,lock,device,card,user,is_locked')
+    self.assertEqual(len(lines), 3)
+    self.assertTrue(lines[1].endswith(',Front Door,chip-1,card-1,alice,False'))
+
+  def test_access_ndjson(self):
+    with self.settings(EXPORT_CHUNK_SIZE=2):
+      body = self.export('export_access', format='ndjson', lock='Front Door')
+    rows = [json.loads(line) for line in body.splitlines()]
+    self.assertEqual([row['card'] for row in rows], ['card-1', 'card-1', 'card-1', 'card-2'])
+    self.assertEqual(rows[3]['user'], None)
+    self.assertEqual(len(self.export('export_access', format='ndjson', card='card-2').splitlines()), 1)
+
+  def test_activity(self):
+    self.client.get(reverse('logout'))
+    self.client.login(username='root', password='secret')
+    body = self.export('export_activity', format='ndjson', type=ActivityRecord.Type.LOGOUT)
+    self.assertEqual([json.loads(line)['user'] for line in body.splitlines()], ['root'])
+
+  def test_rows_are_read_in_one_query(self):
+    response = self.client.get(reverse('export_access'))
+    with CaptureQueriesContext(connection) as queries:
+      b''.join(response.streaming_content)
+    self.assertEqual(len(queries), 1)
+
+  def test_bad_requests(self):
+    self.assertEqual(self.client.get(reverse('export_access'), {'format': 'xml'}).status_code, 400)
+    self.assertEqual(self.client.get(reverse('export_activity'), {'from': 'yesterday'}).status_code, 400)
+
+
+class CardImportTests(AuthorizationTestCase):
+
+  CSV = (
+    "uuid,username,due_date\n"
+    "card-2,alice,2030-01-01\n"
+    "card-3,bob,2030-01-01\n"
+    "card-2,alice,2030-01-01\n"
+    "card-4,alice,2030-01-01T08:00:00\n"
+    "card-4,alice,2031-01-01\n"
+    "card-1,alice,2030-01-01\n"
+    "\n"
+    "card-5,alice,someday\n"
+    "card-6,alice\n"
+  )
+
+  def test_rows_are_validated_before_anything_is_written(self):
+    result = provisioning.import_cards(io.StringIO(self.CSV))
+    self.assertEqual(result.created, 2)
+    self.assertEqual([(error.line, error.key, error.message) for error in result.errors], [
+      (3, 'card-3', "Unknown user: bob"),
+      (4, 'card-2', "Duplicate of line 2"),
+      (6, 'card-4', "Conflicts with line 5"),
+      (7, 'card-1', "Card already exists"),
+      (9, 'card-5', "Invalid due date: someday"),
+      (10, 'card-6', "Expected 3 columns, got 2"),
+    ])
+    self.assertEqual(set(Card.objects.filter(user=self.user).values_list('uuid', flat=True)), {'card-1', 'card-2', 'card-4'})
+
+  def test_cards_past_their_due_date_are_imported_expired(self):
+    provisioning.import_cards(io.StringIO("old-card,alice,2001-01-01\nnew-card,alice,2030-01-01\n"))
+    self.assertEqual(set(Card.objects.filter(expired=True).values_list('uuid', flat=True)), {'old-card'})
+
+  def test_dry_run_writes_nothing(self):
+    result = provisioning.import_cards(io.StringIO(self.CSV), dry_run=True)
+    self.assertEqual(result.created, 2)
+    self.assertEqual(Card.objects.count(), 1)
+
+  def test_query_count_does_not_grow_with_rows(self):
+    def cost(n):
+      rows = ''.join(f'import-{n}-{i},alice,2030-01-01\n' for i in range(n))
+      with CaptureQueriesContext(connection) as queries:
+        self.assertEqual(provisioning.import_cards(io.StringIO(rows)).created, n)
+      return len(queries)
+    self.assertEqual(cost(50), cost(5))
+
+  def test_endpoint_reports_errors_and_logs_once(self):
+    User.objects.create_superuser(username='root', password='secret')
+    self.client.login(username='root', password='secret')
+    upload = SimpleUploadedFile('cohort.csv', self.CSV.encode())
+    self.assertEqual(self.swipe('card-2')['status'], 0)
+
+    response = self.client.post(reverse('card_import'), {'file': upload})
+    self.assertEqual(response.status_code, 200)
+    report = response.json()
+    self.assertEqual(report['created'], 2)
+    self.assertEqual(len(report['errors']), 6)
+    self.assertEqual(report['errors'][0], {'line': 3, 'key': 'card-3', 'message': "Unknown user: bob"})
+    self.assertEqual(ActivityRecord.objects.filter(type=ActivityRecord.Type.CREATE).count(), 1)
+    # Imported cards open the doors right away, although `bulk_create` sent no signals
+    self.assertEqual(self.swipe('card-2')['status'], 1)
+
+  def test_endpoint_rejects_unreadable_files(self):
+    User.objects.create_superuser(username='root', password='secret')
+    self.client.login(username='root', password='secret')
+    response = self.client.post(reverse('card_import'), {'file': SimpleUploadedFile('cards.csv', b'\xff\xfe\x00')})
+    self.assertEqual(response.status_code, 400)
+
+  def test_command(self):
+    with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as f:
+      f.write(self.CSV)
+    self.addCleanup(os.remove, f.name)
+
+    out, err = io.StringIO(), io.StringIO()
+    call_command('import_cards', f.name, '--dry-run', stdout=out, stderr=err)
+    self.assertIn("2 cards would be imported, 6 rows rejected", out.getvalue())
+    self.assertIn("Line 3 (card-3): Unknown user: bob", err.getvalue())
+
+    call_command('import_cards', f.name, stdout=out, stderr=io.StringIO())
+    self.assertEqual(Card.objects.count(), 3)
+
+
+class UserImportTests(AuthorizationTestCase):
+
+  CSV = (
+    "first_name,last_name,username,email,password,group\n"
+    "Bob,Stone,bob,bob@example.com,hunter2,Staff\n"
+    "Carol,Reed,carol,,,Staff\n"
+    "Dan,Ross,dan,dan@example.com,pw,Cleaners\n"
+    "Alice,Wong,alice,alice@example.com,pw,Staff\n"
+    "Bob,Stone,bob,bob@example.com,other,Staff\n"
+    "Eve,Fox,eve,not-an-email,pw,Staff\n"
+  )
+
+  def test_rows_are_validated_before_anything_is_written(self):
+    result = provisioning.import_users(io.StringIO(self.CSV), workers=1)
+    self.assertEqual(result.created, 2)
+    self.assertEqual([(error.line, error.key) for error in result.errors], [(4, 'dan'), (5, 'alice'), (6, 'bob'), (7, 'eve')])
+    self.assertEqual(result.errors[0].message, "Unknown user group: Cleaners")
+    self.assertEqual(result.errors[2].message, "Conflicts with line 2")
+
+    bob = User.objects.get(username='bob')
+    self.assertTrue(bob.check_password('hunter2'))
+    self.assertEqual(list(bob.groups.values_list('name', flat=True)), ['Staff'])
+    # No password, no sign in: a card holder
+    self.assertFalse(User.objects.get(username='carol').has_usable_password())
+
+  def test_json_objects(self):
+    data = json.dumps([{'username': 'bob', 'first_name': 'Bob', 'password': 'hunter2', 'group': 'Staff'}])
+    result = provisioning.import_users(io.StringIO(data), 'json', workers=1)
+    self.assertEqual((result.created, result.errors), (1, []))
+    self.assertEqual(User.objects.get(username='bob').first_name, 'Bob')
+
+    with self.assertRaises(ValueError):
+      provisioning.import_users(io.StringIO('{"username": "bob"}'), 'json')
+
+  def test_passwords_are_hashed_by_worker_processes(self):
+    encoded = provisioning.hash_passwords(['one', '', 'two'], workers=2)
+    self.assertTrue(check_password('one', encoded[0]))
+    self.assertFalse(is_password_usable(encoded[1]))
+    self.assertTrue(check_password('two', encoded[2]))
+
+  def test_endpoint_reports_throughput(self):
+    User.objects.create_superuser(username='root', password='secret')
+    self.client.login(username='root', password='secret')
+    with self.settings(PASSWORD_HASH_WORKERS=1):
+      response = self.client.post(reverse('user_import'), {'file': SimpleUploadedFile('staff.csv', self.CSV.encode())})
+    report = response.json()
+    self.assertEqual(report['created'], 2)
+    self.assertEqual(len(report['errors']), 4)
+    self.assertGreater(report['users_per_second'], 0)
+    self.assertEqual(ActivityRecord.objects.filter(type=ActivityRecord.Type.CREATE).count(), 1)
+
+  def test_blank_password_is_kept_on_update(self):
+    User.objects.create_superuser(username='root', password='secret')
+    self.client.login(username='root', password='secret')
+    data = {'first-name': 'Alice', 'last-name': 'Wong', 'username': 'alice', 'password': '', 'email': 'a@example.com', 'group': 'Staff'}
+    with mock.patch('django.contrib.auth.base_user.make_password') as hasher:
+      self.client.post(reverse('user_update', args=['alice']), data)
+    hasher.assert_not_called()
+    self.user.refresh_from_db()
+    self.assertTrue(self.user.check_password('secret'))
+    self.assertEqual(self.user.first_name, 'Alice')
+
+
+class LockViewTests(AuthorizationTestCase):
+
+  def test_update_keeps_the_allowlist_version_of_a_concurrent_sync(self):
+    User.objects.create_superuser(username='root', password='secret')
+    self.client.login(username='root', password='secret')
+    get_group = LockGroup.objects.get
+
+    def synced_meanwhile(**kwargs):
+      # A sync bumps the version after the view has read the lock
+      Lock.objects.filter(pk=self.lock.pk).update(allowlist_version=7)
+      return get_group(**kwargs)
+
+    with mock.patch.object(LockGroup.objects, 'get', side_effect=synced_meanwhile):
+      self.client.post(reverse('lock_update', args=['Front Door']), {'name': 'Main Door', 'device': 'chip-1', 'lock-group': 'Main Building'})
+    lock = Lock.objects.get(pk=self.lock.pk)
+    self.assertEqual(lock.name, 'Main Door')
+    self.assertGreaterEqual(lock.allowlist_version, 7)
+
+
+class CardViewTests(AuthorizationTestCase):
+
+  def setUp(self):
+    super().setUp()
+    User.objects.create_superuser(username='root', password='secret')
+    self.client.login(username='root', password='secret')
+
+  def test_create(self):
+    response = self.client.post(reverse('card_create'), {'uuid': 'card-2', 'due-date': '2099-05-01T18:30', 'user': 'alice'})
+    self.assertRedirects(response, reverse('card_list'), fetch_redirect_response=False)
+    card = Card.objects.get(uuid='card-2')
+    self.assertEqual(card.due_date, timezone.make_aware(datetime(2099, 5, 1, 18, 30)))
+    self.assertFalse(card.expired)
+
+    self.client.post(reverse('card_create'), {'uuid': 'card-3', 'due-date': '2001-05-01T18:30', 'user': 'alice'})
+    self.assertTrue(Card.objects.get(uuid='card-3').expired)
+
+  def test_update(self):
+    response = self.client.post(reverse('card_update', args=['card-1']), {'uuid': 'card-1', 'due-date': '2001-05-01T18:30', 'user': 'alice'})
+    self.assertRedirects(response, reverse('card_detail', args=['card-1']), fetch_redirect_response=False)
+    self.card.refresh_from_db()
+    self.assertEqual(self.card.due_date, timezone.make_aware(datetime(2001, 5, 1, 18, 30)))
+    self.assertTrue(self.card.expired)
+    self.assertEqual(self.swipe()['message'], 'NOT AUTHORIZED')
+
+
+class CardExpiryTests(AuthorizationTestCase):
+
+  def test_saving_a_card_flags_it(self):
+    self.assertFalse(self.card.expired)
+    self.card.due_date = timezone.now() - timedelta(minutes=1)
+    self.card.save(update_fields=['due_date'])
+    self.assertTrue(Card.objects.get(pk=self.card.pk).expired)
+    self.card.due_date = timezone.now() + timedelta(days=1)
+    self.card.save()
+    self.assertFalse(Card.objects.get(pk=self.card.pk).expired)
+
+  def test_sweep_expires_cards_in_bulk_and_logs_once(self):
+    for i in range(3):
+      Card.objects.create(uuid=f'guest-{i}', user=self.user, due_date=timezone.now() + timedelta(hours=i + 1))
+    later = timezone.now() + timedelta(hours=2, minutes=30)
+    self.assertEqual(expiry.expiring(timedelta(hours=3)).count(), 3)
+
+    generation = policy.stored_generation()
+    with self.assertNumQueries(4):  # One UPDATE and the summary record, in a savepoint
+      self.assertEqual(expiry.sweep(later), 2)
+    # The compiled policy checks due dates itself, workers need not recompile
+    self.assertEqual(policy.stored_generation(), generation)
+    self.assertEqual(expiry.sweep(later), 0)
+    self.assertEqual(set(Card.objects.filter(expired=True).values_list('uuid', flat=True)), {'guest-0', 'guest-1'})
+    self.assertEqual(ActivityRecord.objects.get(type=ActivityRecord.Type.UPDATE).message, "2 cards expired")
+    self.assertEqual(expiry.next_expiry(later), Card.objects.get(uuid='guest-2').due_date)
+
+  def test_expired_cards_leave_the_allowlists(self):
+    allowlist.sync()
+    Card.objects.filter(pk=self.card.pk).update(due_date=timezone.now() - timedelta(minutes=1))
+    with self.captureOnCommitCallbacks(execute=True):
+      self.assertEqual(expiry.sweep(), 1)
+    self.assertTrue(AllowlistEntry.objects.get(card_hash=allowlist.card_hash('card-1')).revoked)
+    self.assertEqual(self.swipe()['status'], 0)
+
+  def test_timer_wakes_up_for_the_next_expiry(self):
+    with self.settings(CARD_EXPIRY={'INTERVAL': 300}):
+      self.assertEqual(expiry.Sweeper().delay(), 300)
+      Card.objects.create(uuid='guest', user=self.user, due_date=timezone.now() + timedelta(seconds=10))
+      self.assertLessEqual(expiry.Sweeper().delay(), 10)
+
+  def test_booking_lists_live_cards_only(self):
+    User.objects.create_superuser(username='root', password='secret')
+    self.client.login(username='root', password='secret')
+    Card.objects.create(uuid='old', user=User.objects.create_user(username='former'), due_date=timezone.now())
+    response = self.client.get(reverse('booking'))
+    self.assertContains(response, '@alice')
+    self.assertNotContains(response, '@former')
+
+  def test_command(self):
+    Card.objects.filter(pk=self.card.pk).update(due_date=timezone.now() - timedelta(minutes=1))
+    out = io.StringIO()
+    call_command('expire_cards', stdout=out)
+    self.assertIn("Expired 1 cards", out.getvalue())
+
+
+class EventStreamTests(AuthorizationTestCase):
+
+  def log(self, message):
+    # Published once committed, which a TestCase only pretends to do
+    with self.captureOnCommitCallbacks(execute=True):
+      return ActivityRecord.objects.create(type=ActivityRecord.Type.UPDATE, message=message)
+
+  def parse(self, chunk):
+    fields = dict(line.split(': ', 1) for line in chunk.strip().split('\n'))
+    return fields['id'], fields['event'], json.loads(fields['data'])
+
+  def test_resume_from_last_event_id(self):
+    cursor = events.latest_cursor()
+    for i in range(3):
+      ActivityRecord.objects.create(type=ActivityRecord.Type.UPDATE, message=f'Missed {i}')
+    self.swipe()
+
+    async def read(cursor):
+      return [chunk async for chunk in events.stream(cursor)]
+
+    with self.settings(EVENT_STREAM={'REPLAY_LIMIT': 2}):
+      # More was missed than one replay sends: the stream ends and the browser reconnects for the rest
+      chunks = async_to_sync(read)(cursor)
+    replayed = [self.parse(chunk) for chunk in chunks[1:]]
+    self.assertEqual([data.get('message', data.get('lock')) for _, _, data in replayed], ['Missed 0', 'Missed 1', 'Front Door'])
+    self.assertEqual(events.parse_cursor(replayed[-1][0]).access, AccessRecord.objects.get().pk)
+
+  def test_lagging_client_is_cut_off(self):
+    async def run():
+      subscription = events.Subscription(asyncio.get_running_loop(), 2)
+      event = events.Event(events.ACTIVITY, 1, {})
+      subscription.push([event, event])
+      subscription.push([event])
+      await asyncio.sleep(0)
+      return subscription
+
+    subscription = async_to_sync(run)()
+    self.assertTrue(subscription.overflowed)
+    self.assertEqual(subscription.queue.qsize(), 3)
+    self.assertIs(list(subscription.queue._queue)[-1], events.OVERFLOW)
+
+  def test_unwatched_writes_publish_nothing(self):
+    with mock.patch('webapp.events.transaction.on_commit') as on_commit:
+      self.log('Nobody listens')
+      self.swipe()
+    on_commit.assert_not_called()
+
+  async def test_endpoint(self):
+    await sync_to_async(User.objects.create_superuser)(username='root', password='secret')
+    await self.async_client.alogin(username='root', password='secret')
+    response = await self.async_client.get(reverse('event_stream'))
+    self.assertEqual(response['Content-Type'], 'text/event-stream')
+    self.assertEqual(await anext(response.streaming_content), b'retry: 3000\n\n')
+    await response.streaming_content.aclose()
+
+  def test_endpoint_needs_asgi(self):
+    User.objects.create_superuser(username='root', password='secret')
+    self.client.login(username='root', password='secret')
+    self.assertEqual(self.client.get(reverse('event_stream')).status_code, 501)
+
+
+# The poller reads on a thread of its own, which only sees committed rows
+@override_settings(EVENT_STREAM={'POLL_INTERVAL': 0.05})
+class EventPollerTests(TransactionTestCase):
+
+  def parse(self, chunk):
+    fields = dict(line.split(': ', 1) for line in chunk.strip().split('\n'))
+    return fields['id'], fields['event'], json.loads(fields['data'])
+
+  def log(self, message):
+    return ActivityRecord.objects.create(type=ActivityRecord.Type.UPDATE, message=message)
+
+  async def test_records_are_read_once_for_every_client(self):
+    cursor = await sync_to_async(events.latest_cursor)()
+    streams = [events.stream(cursor) for _ in range(2)]
+    for stream in streams:
+      self.assertEqual(await anext(stream), 'retry: 3000\n\n')
+    self.assertEqual([thread.name for thread in threading.enumerate()].count('event-poller'), 1)
+
+    readers, read = Counter(), events.replay
+
+    def replay(*args):
+      readers[threading.current_thread().name] += 1
+      return read(*args)
+
+    with mock.patch('webapp.events.replay', side_effect=replay):
+      # Written by another process, nothing wakes this one: the poller finds it
+      with mock.patch.object(events.broker, 'notify'):
+        other = await sync_to_async(self.log)('Other')
+      local = await sync_to_async(self.log)('Local')
+      for stream in streams:
+        received = [self.parse(await anext(stream)) for _ in range(2)]
+        self.assertEqual([data['message'] for _, _, data in received], ['Other', 'Local'])
+        self.assertEqual([events.parse_cursor(id).activity for id, _, _ in received], [other.pk, local.pk])
+    # Past their one replay on connect, the clients only waited on their subscriptions
+    self.assertEqual(readers.pop('MainThread'), 2)
+    self.assertEqual(set(readers), {'event-poller'})
+
+    for stream in streams:
+      await stream.aclose()
+    self.assertFalse(events.broker.has_subscribers())
+
+
+class AccessRollupTests(AuthorizationTestCase):
+
+  def test_rollups_follow_every_write_path(self):
+    self.swipe()
+    self.swipe(status=1)
+    self.client.post(reverse('auth_batch'), json.dumps([['card-1', 'chip-1', 0]]), content_type='application/json')
+    with self.settings(ACCESS_LOG={'BUFFERED': True, 'SPOOL_DIR': None}):
+      log = WriteBehindLog(AccessRecord, 'ACCESS_LOG', start_thread=False)
+      log.write(is_locked=False, card_id=self.card.id, lock_id=self.lock.id, outcome=AccessRecord.Outcome.GRANTED)
+      log.flush()
+
+    counts = dict(AccessRollup.objects.values_list('outcome', 'count'))
+    self.assertEqual(counts, {AccessRecord.Outcome.GRANTED: 3, AccessRecord.Outcome.DO_NOT_DISTURB: 1})
+
+  def test_rebuild_and_stats(self):
+    for day, outcome in ((1, AccessRecord.Outcome.GRANTED), (1, AccessRecord.Outcome.GRANTED), (2, AccessRecord.Outcome.DENIED)):
+      AccessRecord.objects.create(timestamp=timezone.make_aware(datetime(2024, 5, day, 12, 30)), lock=self.lock, outcome=outcome)
+    AccessRecord.objects.create(timestamp=timezone.make_aware(datetime(2024, 5, 2, 12, 10)), lock=self.lock)
+    AccessRollup.objects.update(count=0)
+
+    call_command('rebuild_access_rollups', stdout=io.StringIO())
+    self.assertEqual(AccessRollup.objects.count(), 3)
+
+    User.objects.create_superuser(username='root', password='secret')
+    self.client.login(username='root', password='secret')
+    hours = self.client.get(reverse('access_stats'), {'from': '2024-05-02', 'lock': 'Front Door'}).json()['hours']
+    self.assertEqual(hours, [{
+      'hour': '2024-05-02T16:00:00+00:00', 'lock': 'Front Door',
+      'denied': 1, 'granted': 0, 'do_not_disturb': 0, 'unknown': 1,
+    }])
+
+
+class DataTablesTests(AuthorizationTestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.admin = User.objects.create_superuser(username='root', password='secret')
+    self.client.login(username='root', password='secret')
+
+  def page(self, name, **params):
+    response = self.client.get(reverse(name), {'draw': 3, **params})
+    self.assertEqual(response.status_code, 200)
+    body = response.json()
+    self.assertEqual(body['draw'], 3)
+    return body
+
+  def test_paging_ordering_and_search(self):
+    for i in range(30):
+      Card.objects.create(uuid=f'bulk-{i:02}', user=self.user, due_date=timezone.now())
+
+    body = self.page('card_list_data', start=10, length=5, **{'order[0][column]': 0, 'order[0][dir]': 'desc'})
+    self.assertEqual((body['recordsTotal'], body['recordsFiltered']), (31, 31))
+    # card-1 sorts first, then bulk-29 down
+    self.assertEqual([row['0'] for row in body['data']], [f'bulk-{i:02}' for i in range(20, 15, -1)])
+    self.assertEqual(body['data'][0]['1'], '@alice')
+    self.assertIn(reverse('card_detail', args=['bulk-20']), body['data'][0]['4'])
+
+    body = self.page('card_list_data', length=-1, **{'search[value]': 'bulk-2'})
+    self.assertEqual((body['recordsTotal'], body['recordsFiltered'], len(body['data'])), (31, 10, 10))
+
+  def test_page_cost_does_not_depend_on_page_length(self):
+    for i in range(20):
+      lock = Lock.objects.create(name=f'Door {i}', device=Device.objects.create(chip_id=f'chip-door-{i}'))
+      lock.groups.set([self.lock_group])
+
+    def cost(length):
+      with CaptureQueriesContext(connection) as queries:
+        self.page('lock_list_data', length=length)
+      return len(queries)
+    self.assertEqual(cost(2), cost(20))
+
+  def test_operators_only_see_guests(self):
+    operator = User.objects.create_user(username='op', password='secret')
+    operator.groups.add(Group.objects.create(name='Operators'))
+    guest = User.objects.create_user(username='guest')
+    guest.groups.add(Group.objects.create(name='Guests'))
+    Card.objects.create(uuid='card-guest', user=guest, due_date=timezone.now())
+
+    self.client.login(username='op', password='secret')
+    body = self.page('card_list_data')
+    self.assertEqual([row['0'] for row in body['data']], ['@guest'])
+
+  def test_logs_newest_first_and_escaped(self):
+    ActivityRecord.objects.create(type=ActivityRecord.Type.CREATE, message='<b>first</b>')
+    ActivityRecord.objects.create(type=ActivityRecord.Type.UPDATE, message='second')
+    body = self.page('logs_data', **{'order[0][column]': 4, 'order[0][dir]': 'desc'})
+    self.assertEqual([row['2'] for row in body['data']], ['second', '&lt;b&gt;first&lt;/b&gt;'])
+
+  def test_unknown_devices_are_highlighted(self):
+    Device.objects.create(chip_id='chip-new')
+    rows = {row['1']: row for row in self.page('device_list_data')['data']}
+    self.assertEqual(rows['chip-new']['DT_RowClass'], 'tr-unknown')
+    self.assertIn(reverse('device_authorize', args=['chip-new']), rows['chip-new']['6'])
+
+  def test_bad_parameters(self):
+    self.assertEqual(self.client.get(reverse('user_list_data'), {'start': 'x'}).status_code, 400)
+    self.assertEqual(self.client.get(reverse('user_list_data'), {'order[0][column]': 42}).status_code, 400)
+
+
+class ConstantQueryTests(AuthorizationTestCase):
+  """Every admin page costs the same number of queries however many rows it lists."""
+
+  PAGES = [
+    ('booking', []), ('card_list', []), ('card_list_data', []), ('user_list', []), ('user_list_data', []),
+    ('device_list', []), ('device_list_data', []), ('lock_list', []), ('lock_list_data', []),
+    ('group_lock_list', []), ('group_user_list', []), ('group_user_detail', ['Staff']),
+    ('logs', []), ('logs_data', []),
+  ]
+
+  def setUp(self):
+    super().setUp()
+    User.objects.create_superuser(username='root', password='secret')
+    self.client.login(username='root', password='secret')
+
+  def grow(self, n):
+    for i in range(n):
+      lock_group = LockGroup.objects.create(name=f'Wing {n}-{i}')
+      self.user_group.lock_groups.add(lock_group)
+      user = User.objects.create_user(username=f'user-{n}-{i}')
+      user.groups.set([self.user_group])
+      Card.objects.create(uuid=f'card-{n}-{i}', user=user, due_date=timezone.now())
+      device = Device.objects.create(chip_id=f'chip-{n}-{i}')
+      Lock.objects.create(name=f'Door {n}-{i}', device=device).groups.set([lock_group])
+      ActivityRecord.objects.create(type=ActivityRecord.Type.CREATE, message=f'Row {i}', user=user)
+
+  def costs(self):
+    costs = {}
+    for name, args in self.PAGES:
+      with CaptureQueriesContext(connection) as queries:
+        response = self.client.get(reverse(name, args=args))
+      self.assertEqual(response.status_code, 200, name)
+      costs[name] = len(queries)
+    return costs
+
+  def test_query_count_does_not_grow_with_rows(self):
+    self.grow(2)
+    before = self.costs()
+    self.grow(10)
+    self.assertEqual(self.costs(), before)
+
+
+class RoleResolverTests(AuthorizationTestCase):
+
+  def role_queries(self, queries, user):
+    # Lookups of the signed-in user's own groups, as opposed to queries filtering by group
+    return [q['sql'] for q in queries if re.search(rf'"auth_user_groups"\."user_id" = {user.pk}\b', q['sql'])]
+
+  def test_role_checks_cost_one_query_per_request(self):
+    operator = User.objects.create_user(username='op', password='secret')
+    operator.groups.add(Group.objects.create(name='Operators'), Group.objects.create(name='Guests'))
+    self.client.login(username='op', password='secret')
+
+    for name in ('card_list', 'card_list_data', 'user_list'):
+      with CaptureQueriesContext(connection) as queries:
+        self.assertEqual(self.client.get(reverse(name)).status_code, 200)
+      self.assertEqual(len(self.role_queries(queries, operator)), 1, name)
+
+  def test_membership_changes_are_seen(self):
+    self.assertFalse(roles.in_groups(self.user, ['Admins']))
+    self.user.groups.add(Group.objects.create(name='Admins'))
+    self.assertTrue(roles.in_groups(self.user, ['Admins']))
+    self.assertEqual(roles.group_names(self.user), {'Staff', 'Admins'})
+
+
+class FragmentCacheTests(AuthorizationTestCase):
+
+  def setUp(self):
+    super().setUp()
+    User.objects.create_superuser(username='root', password='secret')
+    self.client.login(username='root', password='secret')
+
+  def get(self, name, *args, **headers):
+    with CaptureQueriesContext(connection) as queries:
+      response = self.client.get(reverse(name, args=args), headers=headers)
+    return response, len(queries)
+
+  def test_generations_move_with_saves_and_deletes(self):
+    request = mock.Mock(spec=[])
+    before = fragments.generations(request, Lock, Device)
+    self.assertEqual(fragments.generations(request, Lock, Device), before)
+
+    request = mock.Mock(spec=[])
+    Device.objects.create(chip_id='chip-2')
+    after = fragments.generations(request, Lock, Device)
+    self.assertEqual(after['device'], before['device'] + 1)
+    self.assertEqual(after['lock'], before['lock'])
+
+    request = mock.Mock(spec=[])
+    self.lock.groups.clear()
+    self.assertEqual(fragments.generations(request, Lock)['lock'], before['lock'] + 1)
+
+  def test_fragments_are_rendered_once_per_generation(self):
+    _, cold = self.get('group_user_list')
+    _, warm = self.get('group_user_list')
+    self.assertLess(warm, cold)
+
+    LockGroup.objects.create(name='Annex')
+    UserGroup.objects.create(name='Visitors')
+    response, _ = self.get('group_user_list')
+    self.assertContains(response, 'Annex')
+    self.assertContains(response, 'Visitors')
+
+  def test_checkboxes_follow_the_group_being_edited(self):
+    annex = LockGroup.objects.create(name='Annex')
+    self.get('group_user_detail', 'Staff')
+    self.user_group.lock_groups.add(annex)
+
+    response, _ = self.get('group_user_detail', 'Staff')
+    self.assertContains(response, f'name="{annex.tag()}" checked')
+    UserGroup.objects.create(name='Visitors')
+    response, _ = self.get('group_user_detail', 'Visitors')
+    self.assertNotContains(response, 'checked>')
+
+  def test_unchanged_pages_answer_304(self):
+    self.get('lock_list')  # Sets the CSRF cookie, which is part of the tag
+    response, _ = self.get('lock_list')
+    etag = response['ETag']
+    self.assertIn('no-cache', response['Cache-Control'])
+
+    response, _ = self.get('lock_list', **{'If-None-Match': etag})
+    self.assertEqual(response.status_code, 304)
+    self.assertEqual(response.content, b'')
+
+    Device.objects.create(chip_id='chip-2')
+    response, _ = self.get('lock_list', **{'If-None-Match': etag})
+    self.assertEqual(response.status_code, 200)
+    self.assertNotEqual(response['ETag'], etag)
+
+  def test_etag_varies_with_the_query_string(self):
+    first = self.client.get(reverse('device_list_data'), {'draw': 1})['ETag']
+    second = self.client.get(reverse('device_list_data'), {'draw': 2})['ETag']
+    self.assertNotEqual(first, second)
+
+  def test_pending_notification_is_never_hidden(self):
+    self.get('device_list')
+    etag = self.client.get(reverse('device_list'))['ETag']
+    session = self.client.session
+    session['message'] = {'type': 'info', 'title': 'Device updated', 'content': 'chip-1'}
+    session.save()
+
+    response, _ = self.get('device_list', **{'If-None-Match': etag})
+    self.assertEqual(response.status_code, 200)
+    self.assertFalse(response.has_header('ETag'))
+    self.assertContains(response, 'Device updated')
+
+
+@override_settings(HEARTBEAT={'FLUSH_INTERVAL': 3600})
+class HeartbeatTests(AuthorizationTestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.addCleanup(heartbeat.heartbeats.flush)
+
+  def beat(self, chip_id='chip-1', **params):
+    return self.client.get(reverse('auth_heartbeat'), {'dev': chip_id, **params})
+
+  def test_heartbeats_are_coalesced_in_memory(self):
+    self.assertEqual(self.beat(fw='1.0.0', rssi='-70').json(), {"status": 1, "message": "OK"})
+    with self.assertNumQueries(0):
+      for rssi in range(-69, -59):
+        self.beat(rssi=str(rssi))
+    self.assertEqual(heartbeat.heartbeats.pending(), 1)
+    self.device.refresh_from_db()
+    self.assertIsNone(self.device.last_seen)
+
+    self.assertEqual(heartbeat.heartbeats.flush(), 1)
+    self.assertEqual(heartbeat.heartbeats.pending(), 0)
+    self.device.refresh_from_db()
+    self.assertIsNotNone(self.device.last_seen)
+    self.assertEqual(self.device.firmware, '1.0.0')  # Kept when a heartbeat does not report it
+    self.assertEqual(self.device.rssi, -60)
+
+  def test_flush_writes_the_fleet_in_bulk(self):
+    Device.objects.bulk_create([Device(chip_id=f'chip-{i}') for i in range(2, 50)])
+    for i in range(1, 50):
+      heartbeat.heartbeats.record(f'chip-{i}', rssi=-i)
+    with CaptureQueriesContext(connection) as queries:
+      self.assertEqual(heartbeat.heartbeats.flush(), 49)
+    updates = [query for query in queries if query['sql'].startswith('UPDATE "webapp_device"')]
+    self.assertEqual(len(updates), 1)
+    self.assertEqual(Device.objects.get(chip_id='chip-7').rssi, -7)
+
+  def test_flush_moves_the_device_generation(self):
+    before = fragments.generations(mock.Mock(spec=[]), Device)['device']
+    heartbeat.heartbeats.record('chip-1')
+    heartbeat.heartbeats.flush()
+    self.assertEqual(fragments.generations(mock.Mock(spec=[]), Device)['device'], before + 1)
+
+  def test_routine_heartbeats_keep_the_device_generation(self):
+    heartbeat.heartbeats.record('chip-1', firmware='1.0.0')
+    heartbeat.heartbeats.flush()
+    before = fragments.generations(mock.Mock(spec=[]), Device)['device']
+    heartbeat.heartbeats.record('chip-1', firmware='1.0.0', rssi=-50)
+    heartbeat.heartbeats.flush()
+    self.assertEqual(fragments.generations(mock.Mock(spec=[]), Device)['device'], before)
+
+    heartbeat.heartbeats.record('chip-1', firmware='1.1.0')
+    heartbeat.heartbeats.flush()
+    self.assertEqual(fragments.generations(mock.Mock(spec=[]), Device)['device'], before + 1)
+
+  def test_bad_heartbeats(self):
+    self.assertEqual(self.beat('chip-2').status_code, 404)
+    self.assertEqual(self.beat(rssi='strong').status_code, 400)
+    self.assertEqual(self.beat(fw='x' * 65).status_code, 400)
+    self.assertEqual(heartbeat.heartbeats.pending(), 0)
+    self.assertFalse(Device.objects.filter(chip_id='chip-2').exists())
+
+  @override_settings(HEARTBEAT={'BUFFERED': False})
+  def test_unbuffered_heartbeats_are_written_inline(self):
+    self.beat(fw='2.1.0')
+    self.device.refresh_from_db()
+    self.assertEqual(self.device.firmware, '2.1.0')
+
+  def test_device_list_flags_stale_devices(self):
+    User.objects.create_superuser(username='root', password='secret')
+    self.client.login(username='root', password='secret')
+    silent = Device.objects.create(chip_id='chip-2')
+    Device.objects.filter(pk=silent.pk).update(last_seen=timezone.now() - timedelta(hours=1))
+    Device.objects.filter(pk=self.device.pk).update(last_seen=timezone.now())
+    Device.objects.create(chip_id='chip-3')  # Never sent a heartbeat
+
+    self.assertEqual(list(heartbeat.stale()), [silent])
+    self.assertContains(self.client.get(reverse('device_list')), 'Silent (1)')
+
+    rows = self.client.get(reverse('device_list_data'), {'draw': 1}).json()['data']
+    self.assertEqual({row['1']: row['DT_RowClass'] for row in rows}, {'chip-1': '', 'chip-2': 'tr-unknown', 'chip-3': 'tr-unknown'})
+    Device.objects.filter(pk=silent.pk).update(status=Device.Status.TRUSTED)
+    rows = self.client.get(reverse('device_list_data'), {'draw': 1, 'stale': 1}).json()['data']
+    self.assertEqual([(row['1'], row['DT_RowClass']) for row in rows], [('chip-2', 'tr-stale')])
+
+
+class JobRunnerTests(TestCase):
+
+  def setUp(self):
+    self.options = {'WORKERS': 0, 'ARTIFACT_DIR': tempfile.mkdtemp(), 'TIMEOUT': 60}
+    self.runner = jobs.JobRunner('REPORT_JOBS', '.pdf')
+
+  def test_failures_are_recorded_and_retried(self):
+    with self.settings(REPORT_JOBS=self.options):
+      with self.assertLogs('webapp.jobs'):
+        self.assertEqual(self.runner.submit('ab' * 16, os.remove), jobs.FAILED)
+      self.assertIn('FileNotFoundError', self.runner.error('ab' * 16))
+      self.assertEqual(self.runner.submit('ab' * 16, write_artifact, b'%PDF'), jobs.DONE)
+
+  def test_stale_jobs_time_out(self):
+    with self.settings(REPORT_JOBS=self.options):
+      marker = os.path.join(self.options['ARTIFACT_DIR'], 'cd' * 16 + '.pending')
+      open(marker, 'w').close()
+      self.assertEqual(self.runner.status('cd' * 16), jobs.PENDING)
+      os.utime(marker, (0, 0))
+      self.assertEqual(self.runner.status('cd' * 16), jobs.FAILED)
+      self.assertIsNone(self.runner.status('../etc/passwd'))
+
+  def test_least_recently_downloaded_artifacts_are_evicted(self):
+    with self.settings(REPORT_JOBS=self.options):
+      for job in ('a' * 32, 'b' * 32, 'c' * 32):
+        self.runner.submit(job, write_artifact, b'%PDF')
+      an_hour_ago = time.time() - 3600
+      for job in ('a' * 32, 'c' * 32):
+        os.utime(self.runner.path(job), (an_hour_ago, an_hour_ago))
+      os.utime(self.runner.path('b' * 32), (0, 0))  # Past MAX_AGE
+      self.runner.touch('a' * 32)
+
+    with self.settings(REPORT_JOBS={**self.options, 'MAX_BYTES': 4}):
+      self.runner.evict()
+      self.assertEqual([self.runner.status(job) for job in ('a' * 32, 'b' * 32, 'c' * 32)], [jobs.DONE, None, None])
+
+
+def write_artifact(path, content):
+  with open(path, 'wb') as f:
+    f.write(content)
+
+
+@skipUnless(connection.vendor == 'sqlite', "Reads SQLite's EXPLAIN QUERY PLAN output")
+class QueryPlanTests(AuthorizationTestCase):
+  """The log listings must walk an index in order, never scan and sort the whole table."""
+
+  def assertIndexedPlan(self, queryset):
+    plan = queryset.explain()
+    # Sorting only the ties of an index walk (the pk tiebreaker) is fine
+    self.assertNotIn('TEMP B-TREE FOR ORDER BY', plan)
+    table = queryset.model._meta.db_table
+    self.assertIsNone(re.search(rf'\bSCAN {table}\b(?! USING)', plan), plan)
+
+  def test_report(self):
+    self.assertIndexedPlan(AccessRecord.objects.filter(lock__name='Front Door'))
+    self.assertIndexedPlan(AccessRecord.objects.filter(lock=self.lock)[:50])
+
+  def test_card_history(self):
+    self.assertIndexedPlan(AccessRecord.objects.filter(card=self.card)[:50])
+
+  def test_logs(self):
+    self.assertIndexedPlan(AccessRecord.objects.all()[:50])
+    self.assertIndexedPlan(ActivityRecord.objects.all()[:50])
+    self.assertIndexedPlan(ActivityRecord.objects.filter(type=ActivityRecord.Type.LOGIN)[:50])
+
+  def test_activity_page(self):
+    self.assertIndexedPlan(ActivityRecord.objects.order_by('-timestamp', '-pk')[20:30])
+
+  def test_exports(self):
+    since, until = reports.day_bounds('2024-05-01', '2024-05-31')
+    self.assertIndexedPlan(exports.access_records(since=since, until=until))
+    self.assertIndexedPlan(exports.access_records(lock='Front Door', since=since))
+    self.assertIndexedPlan(exports.activity_records(type=ActivityRecord.Type.LOGIN, until=until))
+
+  def test_card_expiry(self):
+    now = timezone.now()
+    self.assertIndexedPlan(Card.objects.filter(expired=False, due_date__lte=now))
+    self.assertIndexedPlan(Card.objects.filter(expired=False, due_date__gt=now).order_by('due_date')[:1])
+
+  def test_stale_devices(self):
+    self.assertIndexedPlan(heartbeat.stale())
+
+
+@override_settings(ACCESS_LOG={'BUFFERED': False}, AUDIT_LOG={'BUFFERED': False}, ALLOWLIST={'BUFFERED': False})
+class ReadReplicaRoutingTests(TransactionTestCase):
+  # The replica mirrors default through a second connection, so test data must be committed
+  databases = {'default', 'replica'}
+
+  def setUp(self):
+    Card.objects.create(uuid='card-1', due_date=timezone.now())
+    User.objects.create_superuser(username='root', password='secret')
+
+  def test_reads_follow_the_replica_block(self):
+    self.assertEqual(Card.objects.all().db, 'default')
+    with routers.use_replica():
+      self.assertEqual(Card.objects.all().db, 'replica')
+      self.assertEqual(Card.objects.count(), 1)
+
+  def test_session_reads_primary_after_write(self):
+    self.client.get(reverse('login'))
+    self.client.post(reverse('login'), {'username': 'root', 'password': 'secret'})
+    session = self.client.session
+    session.pop(routers.PIN_KEY)
+    session.save()
+
+    self.assertEqual(self.client.get(reverse('logs')).status_code, 200)
+    self.assertNotIn(routers.PIN_KEY, self.client.session)
+
+    self.client.post(reverse('device_create'), {'chip-id': 'chip-9'})
+    self.assertGreater(self.client.session[routers.PIN_KEY], 0)
+
+  def test_metrics_count_the_replica_queries(self):
+    self.client.login(username='root', password='secret')
+    session = self.client.session
+    session.pop(routers.PIN_KEY, None)
+    session.save()
+
+    def sql_queries():
+      return metrics.collect()[0].get('card_list_data', [0] * metrics.ROW_SIZE)[metrics.SQL_QUERIES]
 
-# Create your tests here.
+    before = sql_queries()
+    with CaptureQueriesContext(connections['default']) as primary, CaptureQueriesContext(connections['replica']) as replica:
+      self.assertEqual(self.client.get(reverse('card_list_data'), {'draw': 1}).status_code, 200)
+    self.assertTrue(replica.captured_queries)
+    self.assertEqual(sql_queries() - before, len(primary) + len(replica))
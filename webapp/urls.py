@@ -4,19 +4,32 @@ from webapp import views
 
 urlpatterns = [
   path('auth', views.authorize, name='auth'),
+  path('auth/batch', views.authorize_batch, name='auth_batch'),
+  path('auth/allowlist', views.authorize_allowlist, name='auth_allowlist'),
+  path('auth/heartbeat', views.authorize_heartbeat, name='auth_heartbeat'),
   path('accounts/login/', views.login_view, name='login'),
   path('accounts/logout/', views.logout_view, name='logout'),
   path('booking', views.booking, name='booking'),
+  path('report/job/<slug:job>', views.report_job, name='report_job'),
   path('report/<str:name>', views.report, name='report'),
   path('logs', views.logs, name='logs'),
+  path('logs/data', views.logs_data, name='logs_data'),  # Page of activity records for DataTables
+  path('export/access', views.export_access, name='export_access'),
+  path('export/activity', views.export_activity, name='export_activity'),
+  path('stats/access', views.access_stats, name='access_stats'),
+  path('events', views.event_stream, name='event_stream'),  # Server-Sent Events of new access and activity records
+  path('metrics', views.metrics_view, name='metrics'),
   
   path('card/list', views.card_list, name='card_list'),  # List all cards
+  path('card/list/data', views.card_list_data, name='card_list_data'),  # Page of cards for DataTables
   path('card/create', views.card_create, name='card_create'),  # Create a new card
+  path('card/import', views.card_import, name='card_import'),  # Create cards from a CSV file
   path('card/<str:uuid>', views.card_detail, name='card_detail'),  # Detail view for a specific card
   path('card/update/<str:uuid>', views.card_update, name='card_update'),  # Update an existing card
   path('card/delete/<str:uuid>', views.card_delete, name='card_delete'),  # Delete a card
   
   path('device/list', views.device_list, name='device_list'),  # List all devices
+  path('device/list/data', views.device_list_data, name='device_list_data'),  # Page of devices for DataTables
   path('device/create', views.device_create, name='device_create'),  # Create a new device
   path('device/<str:id>', views.device_detail, name='device_detail'),  # Detail view for a specific device
   path('device/update/<str:id>', views.device_update, name='device_update'),  # Update an existing device
@@ -24,6 +37,7 @@ urlpatterns = [
   path('device/authorize/<str:id>', views.device_authorize, name='device_authorize'),  # Authorize a device
   
   path('lock/list', views.lock_list, name='lock_list'),  # List all locks
+  path('lock/list/data', views.lock_list_data, name='lock_list_data'),  # Page of locks for DataTables
   path('lock/create', views.lock_create, name='lock_create'),  # Create a new lock
   path('lock/<str:name>', views.lock_detail, name='lock_detail'),  # Detail view for a specific lock
   path('lock/update/<str:name>', views.lock_update, name='lock_update'),  # Update an existing lock
@@ -36,7 +50,9 @@ urlpatterns = [
   path('lock/group/delete/<str:name>', views.group_lock_delete, name='group_lock_delete'),  # Delete a lock group
   
   path('user/list', views.user_list, name='user_list'),  # List all users
+  path('user/list/data', views.user_list_data, name='user_list_data'),  # Page of users for DataTables
   path('user/create', views.user_create, name='user_create'),  # Create a new user
+  path('user/import', views.user_import, name='user_import'),  # Create users from a CSV or JSON file
   path('user/<str:username>', views.user_detail, name='user_detail'),  # Detail view for a specific user
   path('user/update/<str:username>', views.user_update, name='user_update'),  # Update an existing user
   path('user/delete/<str:username>', views.user_delete, name='user_delete'),  # Delete a user
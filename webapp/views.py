@@ -5,21 +5,60 @@ from django.contrib.auth import login
 from django.contrib.auth import logout
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
+from django.core.handlers.asgi import ASGIRequest
+from django.http import FileResponse
 from django.http import HttpResponse
+from django.http import StreamingHttpResponse
 from django.http import JsonResponse
 from django.http import Http404
 from django.shortcuts import redirect
 from django.shortcuts import render
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.html import escape
+from django.utils.text import get_valid_filename
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from django.db import transaction
+from django.db.models import Sum
 from webapp.models import AccessRecord
+from webapp.models import AccessRollup
 from webapp.models import ActivityRecord
 from webapp.models import Card
 from webapp.models import LockGroup
 from webapp.models import UserGroup
 from webapp.models import Device
 from webapp.models import Lock
-from weasyprint import HTML
+from webapp import allowlist
+from webapp import events
+from webapp import exports
+from webapp import fragments
+from webapp import heartbeat
+from webapp import jobs
+from webapp import metrics
+from webapp import policy
+from webapp import provisioning
+from webapp import reports
+from webapp import roles
+from webapp import swipes
+from webapp.fragments import versioned
+from webapp.heartbeat import heartbeats
+from webapp.routers import read_replica
+from webapp.tables import Column
+from webapp.tables import action_button
+from webapp.tables import local_datetime
+from webapp.tables import server_side
+from webapp.writebehind import audit_log
+
+import io
+import json
 
 from datetime import datetime
+from urllib.parse import urlencode
+
+
+# Most swipes accepted by one `authorize_batch` request (16 readers with a few queued swipes each)
+MAX_BATCH_SWIPES = 64
 
 
 # =====================================================================================
@@ -33,12 +72,14 @@ def convert_to_django_date(datetime_str):
       datetime_str: The string representation of the datetime in ISO 8601 format.
 
   Returns:
-      A Django model date object representing the parsed datetime.
+      A Django model date object representing the parsed datetime, in the
+      current time zone.
   """
   
   try:
     datetime_obj = datetime.strptime(datetime_str, "%Y-%m-%dT%H:%M")
-    return datetime_obj # Extract the date portion for Django model
+    # Aware, as USE_TZ requires, so it compares with timezone.now() (see Card.is_overdue)
+    return timezone.make_aware(datetime_obj)
   except ValueError:
     raise ValueError(f"Invalid datetime string format: {datetime_str}")
 
@@ -49,8 +90,13 @@ def notify(request, type, title, content):
 
 
 def log(request, type, message):
-  activity_record = ActivityRecord(type=type, message=message, user=request.user)
-  activity_record.save()
+  audit_log.write(type=type, message=message, user_id=request.user.pk)
+
+
+def report_file(job, filename):
+  """Sends a finished report from the artifact cache, counting as a fresh download for eviction."""
+  reports.report_jobs.touch(job)
+  return FileResponse(open(reports.report_jobs.path(job), 'rb'), content_type='application/pdf', filename=filename)
 
 
 def authorize(request):
@@ -58,85 +104,130 @@ def authorize(request):
     chip_id = request.GET.get('dev')  # This is the hardware chip_id
     is_locked = int(request.GET.get('status', 0))
 
-    # --- STEP 1: Device Verification & Auto-Registration ---
-    # Retrieve the device or create it as UNKNOWN if it's new
-    device, created = Device.objects.get_or_create(
-        chip_id=chip_id,
-        defaults={'status': Device.Status.UNKNOWN}
+    decision = swipes.authorize(card_uuid, chip_id, is_locked)
+
+    return JsonResponse({
+        "status": decision.status, 
+        "message": decision.message
+    })
+
+
+@csrf_exempt
+@require_POST
+def authorize_batch(request):
+    """Answers several swipes from a multi-reader controller in one request.
+
+    The body is a JSON array of `[uuid, chip_id, status]` tuples, or of objects
+    with the same `uuid`, `dev` and `status` keys as `authorize`. Each swipe
+    gets the same answer `authorize` would give, in request order.
+    """
+    try:
+        items = json.loads(request.body)
+        if not isinstance(items, list) or len(items) > MAX_BATCH_SWIPES:
+            raise ValueError(f"Expected a list of at most {MAX_BATCH_SWIPES} swipes")
+        batch = []
+        for item in items:
+            if isinstance(item, dict):
+                item = (item.get('uuid'), item.get('dev'), item.get('status', 0))
+            elif not isinstance(item, list) or len(item) != 3:
+                # A 3-character string would unpack too
+                raise TypeError("Expected a [uuid, dev, status] array or an object")
+            card_uuid, chip_id, is_locked = item
+            if not isinstance(card_uuid, str) or not isinstance(chip_id, str):
+                raise TypeError("uuid and dev must be strings")
+            batch.append((card_uuid, chip_id, int(is_locked or 0)))
+    except (ValueError, TypeError):
+        return JsonResponse({"status": 0, "message": "BAD REQUEST"}, status=400)
+
+    chip_ids = {chip_id for _, chip_id, _ in batch}
+    access_policy = policy.AccessPolicy.compile(
+        card_uuids={card_uuid for card_uuid, _, _ in batch},
+        chip_ids=chip_ids
     )
 
-    if created:
-        ActivityRecord.objects.create(
-            type=ActivityRecord.Type.CREATE,
-            message=f"New device {chip_id} connected"
+    # Register every device seen for the first time, as `authorize` does one by one
+    unknown_chip_ids = chip_ids - access_policy.devices.keys()
+    if unknown_chip_ids:
+        # Registered by another worker since the policy was compiled: not new, only logged once
+        existing = set(Device.objects.filter(chip_id__in=unknown_chip_ids).values_list('chip_id', flat=True))
+        new_chip_ids = sorted(unknown_chip_ids - existing)
+        Device.objects.bulk_create(
+            [Device(chip_id=chip_id, status=Device.Status.UNKNOWN) for chip_id in new_chip_ids],
+            ignore_conflicts=True
         )
+        ActivityRecord.objects.bulk_create([
+            ActivityRecord(type=ActivityRecord.Type.CREATE, message=f"New device {chip_id} connected")
+            for chip_id in new_chip_ids
+        ])
+        policy.invalidate()
 
-    # Security Gate: If not TRUSTED, kill the request immediately
-    if device.status != Device.Status.TRUSTED:
-        return JsonResponse({
-            "status": 0, 
-            "message": f"DEVICE {device.get_status_display().upper()}"
-        })
+    # Freshly registered devices are UNKNOWN and drive no lock yet
+    unregistered = policy.DeviceEntry(None, Device.Status.UNKNOWN, None, 0)
 
-    # --- STEP 2: Card Verification ---
-    try:
-        card = Card.objects.get(uuid=card_uuid)
-    except Card.DoesNotExist:
-        return JsonResponse({"status": 0, "message": "CARD UNKNOWN"})
+    results = []
+    records = []
+    for card_uuid, chip_id, is_locked in batch:
+        device = access_policy.device(chip_id) or unregistered
+        decision = access_policy.evaluate(card_uuid, device, is_locked)
+        if decision.record is not None:
+            records.append(AccessRecord(**decision.record))
+        results.append({"status": decision.status, "message": decision.message})
 
-    # --- STEP 3: Logic Delegation ---
-    authorized = has_authorization(card, chip_id, is_locked)
-    
-    response_messages = {
-        1: "AUTHORIZED",
-        2: "DO NOT DISTURB",
-        0: "NOT AUTHORIZED"
-    }
-    
-    # --- STEP 4: Logging ---
-    # We can now use the 'device' object we already fetched to find the lock
-    lock = Lock.objects.filter(device=device).first()
-    AccessRecord.objects.create(is_locked=bool(is_locked), card=card, lock=lock)
+    AccessRecord.objects.bulk_create(records)
+
+    return JsonResponse({"results": results})
 
-    return JsonResponse({
-        "status": authorized, 
-        "message": response_messages.get(authorized, "ERROR")
-    })
 
+def authorize_allowlist(request):
+    """Serves the offline allowlist of the lock driven by a trusted device.
 
-def has_authorization(access_card, chip_id, is_locked):
+    `since` is the allowlist version the device already holds; only entries
+    changed after it are returned, or the full list when it is 0 or unknown.
+    """
+    chip_id = request.GET.get('dev')
     try:
-        # 1. Identify the lock and its associated LockGroups
-        door_lock = Lock.objects.get(device__chip_id=chip_id)
-        lock_groups = door_lock.groups.all()
-        
-        # 2. Get the User's UserGroup (Extended Group)
-        # We assume the Django User is linked to exactly one UserGroup
-        django_group = access_card.user.groups.first()
-        user_group_ext = UserGroup.objects.get(name=django_group.name)
+        since = int(request.GET.get('since', 0))
+    except ValueError:
+        return JsonResponse({"status": 0, "message": "BAD REQUEST"}, status=400)
+
+    device = Device.objects.filter(chip_id=chip_id).first()
+    if device is None or device.status != Device.Status.TRUSTED:
+        status_display = device.get_status_display() if device else Device.Status.UNKNOWN.label
+        return JsonResponse({"status": 0, "message": f"DEVICE {status_display.upper()}"}, status=403)
 
-        # 3. Check if any of the lock's groups intersect with the user's allowed groups
-        # AND check if the card is expired
-        has_group_access = lock_groups.filter(id__in=user_group_ext.lock_groups.all()).exists()
-        is_valid_card = not access_card.is_overdue()
+    lock = Lock.objects.filter(device=device).first()
+    if lock is None:
+        return JsonResponse({"version": 0, "full": True, "grant": [], "revoke": []})
 
-        if not (has_group_access and is_valid_card):
-            return 0 # Not Authorized
+    return JsonResponse(allowlist.delta(lock, since))
 
-        # 4. Handle the "Lock Pin" (DND) logic
-        if is_locked and not user_group_ext.override_lock_pin:
-            return 2 # Authorized but blocked by physical pin
 
-        return 1 # Fully Authorized
+def authorize_heartbeat(request):
+    """Records that a device is alive, with the firmware version and signal strength it reports.
+
+    Heartbeats are coalesced in memory and written in bulk (see
+    webapp/heartbeat.py), so a known device is answered without a query.
+    Devices register with their first swipe, unknown ones get a 404.
+    """
+    chip_id = request.GET.get('dev')
+    firmware = request.GET.get('fw') or None
+    try:
+        rssi = int(request.GET['rssi']) if request.GET.get('rssi') else None
+    except ValueError:
+        return JsonResponse({"status": 0, "message": "BAD REQUEST"}, status=400)
+    if not chip_id or (firmware and len(firmware) > Device._meta.get_field('firmware').max_length):
+        return JsonResponse({"status": 0, "message": "BAD REQUEST"}, status=400)
 
-    except (Lock.DoesNotExist, UserGroup.DoesNotExist, AttributeError) as e:
-        print(f"Auth Error: {e}")
-        return 0
+    if not policy.is_registered(chip_id):
+        return JsonResponse({"status": 0, "message": "DEVICE NOT FOUND"}, status=404)
+
+    heartbeats.record(chip_id, firmware, rssi)
+    return JsonResponse({"status": 1, "message": "OK"})
 
 
 def group_check(allowed_groups):
   def check(user):
-    return user.groups.filter(name__in=allowed_groups).exists() or user.is_superuser
+    return roles.in_groups(user, allowed_groups)
   return check
 
 
@@ -182,12 +273,13 @@ def logout_view(request):
 
 @user_passes_test(group_check(['Admins', 'Operators']))
 @login_required
+@read_replica
 def booking(request):
   view = 'booking'
   locks = Lock.objects.all()
   
   # Check if the user is in the 'Operators' group
-  is_operator = request.user.groups.filter(name='Operators').exists()
+  is_operator = 'Operators' in roles.group_names(request.user)
   if is_operator:
     # Get all cards from users in the 'Guests' group
     cards = Card.objects.filter(user__groups__name='Guests')
@@ -196,50 +288,88 @@ def booking(request):
     cards = Card.objects.all()
     users = User.objects.all()
 
+  # Current bookings only, and every row prints its owner
+  cards = cards.filter(expired=False).select_related('user')
+
   context = {'view': view, 'cards': cards, 'locks': locks, 'users': users}
   return render(request, 'webapp/booking.html', context)
 
 
 @user_passes_test(group_check(['Admins', 'Operators']))
 @login_required
+@read_replica
 def card_list(request):
   view = 'cards'
   locks = Lock.objects.all()
 
   # Check if the user is in the 'Operators' group
-  is_operator = request.user.groups.filter(name='Operators').exists()
+  is_operator = 'Operators' in roles.group_names(request.user)
   if is_operator:
-    # Get all cards from users in the 'Guests' group
-    cards = Card.objects.filter(user__groups__name='Guests')
+    # Get all users in the 'Guests' group
     users = User.objects.filter(groups__name='Guests')
   else:
-    cards = Card.objects.all()
     users = User.objects.all()
 
-  context = {'view': view, 'cards': cards, 'locks': locks, 'users': users}
+  context = {'view': view, 'locks': locks, 'users': users}
   return render(request, 'webapp/cards.html', context)
 
 
 @user_passes_test(group_check(['Admins', 'Operators']))
 @login_required
+@read_replica
+def card_list_data(request):
+  is_admin = group_check(['Admins'])(request.user)
+
+  # Check if the user is in the 'Operators' group
+  is_operator = 'Operators' in roles.group_names(request.user)
+  if is_operator:
+    cards = Card.objects.filter(user__groups__name='Guests')
+  else:
+    cards = Card.objects.all()
+
+  columns = [
+    Column('user__username', ['user__username']),
+    Column('created_at'),
+    Column('due_date'),
+    Column(),
+  ]
+  if is_admin:
+    columns.insert(0, Column('uuid', ['uuid']))
+
+  def to_row(card):
+    cells = [
+      escape(f"@{card.user.username if card.user else ''}"),
+      local_datetime(card.created_at),
+      local_datetime(card.due_date),
+      action_button('btn-edit', 'bi-pencil-fill', reverse('card_detail', args=[card.uuid]))
+      + action_button('btn-delete', 'bi-trash3-fill', reverse('card_delete', args=[card.uuid])),
+    ]
+    if is_admin:
+      cells.insert(0, escape(card.uuid))
+    return cells
+
+  return server_side(request, cards.select_related('user'), columns, to_row)
+
+
+@user_passes_test(group_check(['Admins', 'Operators']))
+@login_required
+@read_replica
 def card_detail(request, uuid):
   view = 'cards'
 
   # Check if the user is in the 'Operators' group
-  is_operator = request.user.groups.filter(name='Operators').exists()
+  is_operator = 'Operators' in roles.group_names(request.user)
   if is_operator:
-    # Get all cards from users in the 'Guests' group
-    cards = Card.objects.filter(user__groups__name='Guests')
+    # Get all users in the 'Guests' group
     users = User.objects.filter(groups__name='Guests')
   else:
-    cards = Card.objects.all()
     users = User.objects.all()
 
   try:
     card = Card.objects.get(uuid=uuid)
   except Card.DoesNotExist:
     raise Http404("Card Not Found")
-  context = {'view': view, 'cards': cards, 'users': users, 'query': card}
+  context = {'view': view, 'users': users, 'query': card}
   return render(request, 'webapp/cards.html', context)
 
 
@@ -307,29 +437,102 @@ def card_delete(request, uuid):
   
   return redirect('card_list')
 
+@user_passes_test(group_check(['Admins', 'Operators']))
+@login_required
+@require_POST
+def card_import(request):
+  """Creates cards from an uploaded `uuid,username,due_date` CSV file, answering with a per-row error report."""
+  upload = request.FILES.get('file')
+  if upload is None:
+    return JsonResponse({"status": 0, "message": "BAD REQUEST"}, status=400)
+  dry_run = request.POST.get('dry-run') is not None
+
+  try:
+    result = provisioning.import_cards(io.TextIOWrapper(upload, encoding='utf-8-sig'), dry_run=dry_run)
+  except ValueError as e:
+    return JsonResponse({"status": 0, "message": str(e)}, status=400)
+
+  if result.created and not dry_run:
+    # One record for the whole file rather than one per card
+    message = f"{result.created} cards imported from {upload.name}, {len(result.errors)} rows rejected"
+    log(request, ActivityRecord.Type.CREATE, message)
+
+  return JsonResponse({
+    "created": result.created,
+    "dry_run": dry_run,
+    "errors": [error._asdict() for error in result.errors],
+  })
+
 # =====================================================================================
 # Devices
 # =====================================================================================
 
 @user_passes_test(group_check(['Admins']))
 @login_required
+@read_replica
+@versioned(Device, period=heartbeat.options()['FLUSH_INTERVAL'])
 def device_list(request):
   view = 'devices'
-  devices = Device.objects.all()
-  context = {'view': view, 'devices': devices}
+  context = {
+    'view': view,
+    'stale_only': request.GET.get('stale') == '1',
+    'stale_count': heartbeat.stale().count(),
+    'stale_after': heartbeat.options()['STALE_AFTER'],
+  }
   return render(request, 'webapp/devices.html', context)
 
 
 @user_passes_test(group_check(['Admins']))
 @login_required
+@read_replica
+@versioned(Device, period=heartbeat.options()['FLUSH_INTERVAL'])
+def device_list_data(request):
+  columns = [
+    Column('id'),
+    Column('chip_id', ['chip_id']),
+    Column('status', ['status']),
+    Column('last_seen'),
+    Column('firmware', ['firmware']),
+    Column('rssi'),
+    Column(),
+  ]
+  stale_since = heartbeat.stale_since()
+
+  def to_row(device):
+    if device.status == Device.Status.UNKNOWN:
+      action = action_button('btn-green', 'bi-check2', reverse('device_authorize', args=[device.chip_id]))
+    else:
+      action = action_button('btn-edit', 'bi-pencil-fill', reverse('device_detail', args=[device.chip_id]))
+    return [
+      device.id,
+      escape(device.chip_id),
+      escape(device.get_status_display()),
+      local_datetime(device.last_seen),
+      escape(device.firmware),
+      f"{device.rssi} dBm" if device.rssi is not None else '',
+      action + action_button('btn-delete', 'bi-trash3-fill', reverse('device_delete', args=[device.chip_id])),
+    ]
+
+  def row_class(device):
+    if device.status == Device.Status.UNKNOWN:
+      return 'tr-unknown'
+    return 'tr-stale' if device.last_seen is not None and device.last_seen < stale_since else ''
+
+  devices = heartbeat.stale() if request.GET.get('stale') == '1' else Device.objects.all()
+  return server_side(request, devices, columns, to_row, row_class)
+
+
+@user_passes_test(group_check(['Admins']))
+@login_required
+@read_replica
+@versioned(Device)
 def device_detail(request, id):
   view = 'devices'
-  devices = Device.objects.all()
   try:
     device = Device.objects.get(chip_id=id)
   except Device.DoesNotExist:
     raise Http404("Device Not Found")
-  context = {'view': view, 'devices': devices, 'query': device}
+  context = {'view': view, 'query': device}
   return render(request, 'webapp/devices.html', context)
 
 
@@ -417,27 +620,54 @@ def device_authorize(request, id):
 
 @user_passes_test(group_check(['Admins']))
 @login_required
+@read_replica
+@versioned(Lock, Device, LockGroup)
 def lock_list(request):
   view = 'locks'
-  locks = Lock.objects.all()
   devices = Device.objects.all()
   groups = LockGroup.objects.all()
-  context = {'view': view, 'locks': locks, 'devices': devices, 'groups': groups}
+  generations = fragments.generations(request, Device, LockGroup)
+  context = {'view': view, 'devices': devices, 'groups': groups, 'generations': generations}
   return render(request, 'webapp/locks.html', context)
 
 
 @user_passes_test(group_check(['Admins']))
 @login_required
+@read_replica
+@versioned(Lock, Device, LockGroup)
+def lock_list_data(request):
+  columns = [Column('id'), Column('name', ['name']), Column('device__chip_id', ['device__chip_id']), Column(), Column()]
+
+  def to_row(lock):
+    lock_group = next(iter(lock.groups.all()), '')
+    return [
+      lock.id,
+      escape(lock.name),
+      escape(lock.device.chip_id if lock.device else ''),
+      escape(lock_group),
+      action_button('btn-edit', 'bi-file-earmark-fill', reverse('report', args=[lock.name]), new_tab=True)
+      + action_button('btn-edit', 'bi-pencil-fill', reverse('lock_detail', args=[lock.name]))
+      + action_button('btn-delete', 'bi-trash3-fill', reverse('lock_delete', args=[lock.name])),
+    ]
+
+  locks = Lock.objects.select_related('device').prefetch_related('groups')
+  return server_side(request, locks, columns, to_row)
+
+
+@user_passes_test(group_check(['Admins']))
+@login_required
+@read_replica
+@versioned(Lock, Device, LockGroup)
 def lock_detail(request, name):
   view = 'locks'
-  locks = Lock.objects.all()
   devices = Device.objects.all()
   groups = LockGroup.objects.all()
   try:
     lock = Lock.objects.get(name=name)
   except Lock.DoesNotExist:
     raise Http404("Lock Not Found")
-  context = {'view': view, 'locks': locks, 'devices': devices, 'groups': groups, 'query': lock}
+  generations = fragments.generations(request, Device, LockGroup)
+  context = {'view': view, 'devices': devices, 'groups': groups, 'query': lock, 'generations': generations}
   return render(request, 'webapp/locks.html', context)
 
 
@@ -449,10 +679,11 @@ def lock_create(request):
     lock_device = Device.objects.get(chip_id=request.POST.get('device'))
     lock_group = LockGroup.objects.get(name=request.POST.get('lock-group'))
     
-    lock = Lock(name=lock_name, device=lock_device)
-    lock.save()
-    
-    lock.groups.set([lock_group])
+    with transaction.atomic():
+      lock = Lock(name=lock_name, device=lock_device)
+      lock.save()
+      
+      lock.groups.set([lock_group])
     
     title = f"New lock added"
     message = f"{lock_name} is linked to {lock_device.chip_id}"
@@ -475,11 +706,13 @@ def lock_update(request, name):
     lock_device = Device.objects.get(chip_id=request.POST.get('device'))
     lock_group = LockGroup.objects.get(name=request.POST.get('lock-group'))
 
-    lock.name = lock_name
-    lock.device = lock_device
-    lock.save()
-    
-    lock.groups.set([lock_group])
+    with transaction.atomic():
+      lock.name = lock_name
+      lock.device = lock_device
+      # Only what the form edits: the mask and allowlist version may have moved since the lock was read
+      lock.save(update_fields=['name', 'device'])
+      
+      lock.groups.set([lock_group])
     
     title = f"Lock updated"
     message = f"{lock_name} is now linked to {lock_device.chip_id}"
@@ -514,15 +747,20 @@ def lock_delete(request, name):
 
 @user_passes_test(group_check(['Admins']))
 @login_required
+@read_replica
+@versioned(LockGroup)
 def group_lock_list(request):
   view = 'lock_groups'
   lock_groups = LockGroup.objects.all()
-  context = {'view': view, 'lock_groups': lock_groups}
+  generations = fragments.generations(request, LockGroup)
+  context = {'view': view, 'lock_groups': lock_groups, 'generations': generations}
   return render(request, 'webapp/lock_groups.html', context)
 
 
 @user_passes_test(group_check(['Admins']))
 @login_required
+@read_replica
+@versioned(LockGroup)
 def group_lock_detail(request, name):
   view = 'lock_groups'
   lock_groups = LockGroup.objects.all()
@@ -530,7 +768,8 @@ def group_lock_detail(request, name):
     group = LockGroup.objects.get(name=name)
   except LockGroup.DoesNotExist:
     raise Http404("LockGroup Not Found")
-  context = {'view': view, 'lock_groups': lock_groups, 'query': group}
+  generations = fragments.generations(request, LockGroup)
+  context = {'view': view, 'lock_groups': lock_groups, 'query': group, 'generations': generations}
   return render(request, 'webapp/lock_groups.html', context)
 
 
@@ -540,8 +779,12 @@ def group_lock_create(request):
   if request.method == 'POST':
     group_name = request.POST.get('name')
 
-    group = LockGroup.objects.create(name=group_name)
-    group.save()
+    try:
+      group = LockGroup.objects.create(name=group_name)
+      group.save()
+    except ValueError as e:
+      # Every bit of the lock group masks is taken
+      notify(request, "danger", "Lock group not created", str(e))
   return redirect('group_lock_list')
 
 
@@ -577,16 +820,21 @@ def group_lock_delete(request, name):
 
 @user_passes_test(group_check(['Admins']))
 @login_required
+@read_replica
+@versioned(UserGroup, LockGroup)
 def group_user_list(request):
   view = 'user_groups'
   user_groups = UserGroup.objects.all()
   lock_groups = LockGroup.objects.all()
-  context = {'view': view, 'user_groups': user_groups, 'lock_groups': lock_groups}
+  generations = fragments.generations(request, UserGroup, LockGroup)
+  context = {'view': view, 'user_groups': user_groups, 'lock_groups': lock_groups, 'generations': generations}
   return render(request, 'webapp/user_groups.html', context)
 
 
 @user_passes_test(group_check(['Admins']))
 @login_required
+@read_replica
+@versioned(UserGroup, LockGroup)
 def group_user_detail(request, name):
   view = 'user_groups'
   user_groups = UserGroup.objects.all()
@@ -595,7 +843,11 @@ def group_user_detail(request, name):
     user_group = UserGroup.objects.get(name=name)
   except UserGroup.DoesNotExist:
     raise Http404("UserGroup Not Found")
-  context = {'view': view, 'user_groups': user_groups, 'lock_groups': lock_groups, 'query': user_group}
+  # Looked up once instead of once per lock group checkbox
+  granted = set(user_group.lock_groups.values_list('id', flat=True))
+  generations = fragments.generations(request, UserGroup, LockGroup)
+  context = {'view': view, 'user_groups': user_groups, 'lock_groups': lock_groups, 'query': user_group, 'granted': granted,
+             'generations': generations}
   return render(request, 'webapp/user_groups.html', context)
 
 
@@ -608,9 +860,10 @@ def group_user_create(request):
     
     selected_lock_groups = [lock_group for lock_group in LockGroup.objects.all() if request.POST.get(lock_group.tag()) is not None]
 
-    group = UserGroup.objects.create(name=group_name, override_lock_pin=group_master_access)
-    group.lock_groups.set(selected_lock_groups)
-    group.save()
+    with transaction.atomic():
+      group = UserGroup.objects.create(name=group_name, override_lock_pin=group_master_access)
+      group.lock_groups.set(selected_lock_groups)
+      group.save()
     
   return redirect('group_user_list')
 
@@ -628,10 +881,11 @@ def group_user_update(request, name):
     
     selected_lock_groups = [lock_group for lock_group in LockGroup.objects.all() if request.POST.get(lock_group.tag()) is not None]
 
-    group.name = group_name
-    group.override_lock_pin = group_master_access
-    group.lock_groups.set(selected_lock_groups)
-    group.save()
+    with transaction.atomic():
+      group.name = group_name
+      group.override_lock_pin = group_master_access
+      group.lock_groups.set(selected_lock_groups)
+      group.save()
     
   return redirect('group_user_list')
 
@@ -653,43 +907,82 @@ def group_user_delete(request, name):
 
 @user_passes_test(group_check(['Admins', 'Operators']))
 @login_required
+@read_replica
 def user_list(request):
   view = 'users'
 
   # Check if the user is in the 'Operators' group
-  is_operator = request.user.groups.filter(name='Operators').exists()
+  is_operator = 'Operators' in roles.group_names(request.user)
   if is_operator:
-    # Get all users in the 'Guests' group
-    users = User.objects.filter(groups__name='Guests')
+    # Only the 'Guests' group is offered
     groups = UserGroup.objects.filter(name='Guests')
   else:
-    users = User.objects.all()
     groups = UserGroup.objects.all()
 
-  context = {'view': view, 'users': users, 'groups': groups}
+  context = {'view': view, 'groups': groups}
   return render(request, 'webapp/users.html', context)
 
 
 @user_passes_test(group_check(['Admins', 'Operators']))
 @login_required
+@read_replica
+def user_list_data(request):
+  is_admin = group_check(['Admins'])(request.user)
+
+  # Check if the user is in the 'Operators' group
+  is_operator = 'Operators' in roles.group_names(request.user)
+  if is_operator:
+    users = User.objects.filter(groups__name='Guests')
+  else:
+    users = User.objects.all()
+
+  columns = [
+    Column('last_name', ['last_name']),
+    Column('first_name', ['first_name']),
+    Column('username', ['username']),
+    Column('email', ['email']),
+  ]
+  if is_admin:
+    columns = [Column('id')] + columns + [Column()]
+  columns.append(Column())
+
+  def to_row(user_item):
+    cells = [
+      escape(user_item.last_name),
+      escape(user_item.first_name),
+      escape(f"@{user_item.username}"),
+      escape(user_item.email),
+    ]
+    if is_admin:
+      cells = [user_item.id] + cells + [escape(next(iter(user_item.groups.all()), ''))]
+    cells.append(
+      action_button('btn-edit', 'bi-pencil-fill', reverse('user_detail', args=[user_item.username]))
+      + action_button('btn-delete', 'bi-trash3-fill', reverse('user_delete', args=[user_item.username]))
+    )
+    return cells
+
+  return server_side(request, users.prefetch_related('groups').order_by('id'), columns, to_row)
+
+
+@user_passes_test(group_check(['Admins', 'Operators']))
+@login_required
+@read_replica
 def user_detail(request, username):
   view = 'users'
 
   # Check if the user is in the 'Operators' group
-  is_operator = request.user.groups.filter(name='Operators').exists()
+  is_operator = 'Operators' in roles.group_names(request.user)
   if is_operator:
-    # Get all users in the 'Guests' group
-    users = User.objects.filter(groups__name='Guests')
+    # Only the 'Guests' group is offered
     groups = UserGroup.objects.filter(name='Guests')
   else:
-    users = User.objects.all()
     groups = UserGroup.objects.all()
 
   try:
     user = User.objects.get(username=username)
   except User.DoesNotExist:
     raise Http404("User Not Found")
-  context = {'view': view, 'users': users, 'groups': groups, 'query': user}
+  context = {'view': view, 'groups': groups, 'query': user}
   return render(request, 'webapp/users.html', context)
 
 
@@ -732,7 +1025,9 @@ def user_update(request, username):
     user_group = UserGroup.objects.get(name=request.POST.get('group'))
 
     user.username = user_name
-    user.set_password(user_password)
+    # A blank password keeps the current one instead of paying for a new hash
+    if user_password:
+      user.set_password(user_password)
     user.email = user_email
     user.first_name = user_first_name
     user.last_name = user_last_name
@@ -768,40 +1063,221 @@ def user_delete(request, username):
   return redirect('user_list')
 
 
+@user_passes_test(group_check(['Admins', 'Operators']))
+@login_required
+@require_POST
+def user_import(request):
+  """Creates users from an uploaded CSV or JSON file, answering with a per-row error report."""
+  upload = request.FILES.get('file')
+  if upload is None:
+    return JsonResponse({"status": 0, "message": "BAD REQUEST"}, status=400)
+  import_format = 'json' if upload.name.lower().endswith('.json') else 'csv'
+  dry_run = request.POST.get('dry-run') is not None
+
+  try:
+    result = provisioning.import_users(io.TextIOWrapper(upload, encoding='utf-8-sig'), import_format, dry_run=dry_run)
+  except ValueError as e:
+    return JsonResponse({"status": 0, "message": str(e)}, status=400)
+
+  if result.created and not dry_run:
+    # One record for the whole file rather than one per user
+    message = f"{result.created} users imported from {upload.name}, {len(result.errors)} rows rejected"
+    log(request, ActivityRecord.Type.CREATE, message)
+
+  return JsonResponse({
+    "created": result.created,
+    "dry_run": dry_run,
+    "users_per_second": round(result.created / result.seconds, 1) if result.seconds else None,
+    "errors": [error._asdict() for error in result.errors],
+  })
+
+
 # =====================================================================================
 # Logs & Reports
 # =====================================================================================
 
 @user_passes_test(group_check(['Admins']))
 @login_required
+@read_replica
 def logs(request):
   view = 'logs'
-  activity_records = ActivityRecord.objects.all()
-  context = {'view': view, 'activity_records': activity_records}
+  context = {'view': view}
   return render(request, 'webapp/logs.html', context)
 
 
 @user_passes_test(group_check(['Admins']))
 @login_required
+@read_replica
+def logs_data(request):
+  columns = [
+    Column('id'),
+    Column('type', ['type']),
+    Column(None, ['message']),
+    Column('user__username', ['user__username']),
+    Column('timestamp'),
+  ]
+
+  def to_row(record):
+    return [
+      record.id,
+      escape(record.type),
+      escape(record.message),
+      escape(f"@{record.user.username if record.user else ''}"),
+      local_datetime(record.timestamp, 'DATETIME_FORMAT'),
+    ]
+
+  return server_side(request, ActivityRecord.objects.select_related('user'), columns, to_row)
+
+
+@user_passes_test(group_check(['Admins']))
+@login_required
+@read_replica
 def report(request, name):
+    lock = Lock.objects.filter(name=name).first()
+    if lock is None:
+        raise Http404
+
+    # Optional inclusive range of days, as ?from=YYYY-MM-DD&to=YYYY-MM-DD
+    start, end = request.GET.get('from'), request.GET.get('to')
+    try:
+        since, until = reports.day_bounds(start, end)
+    except ValueError:
+        return HttpResponse("BAD REQUEST", status=400)
+
     current_time = datetime.now()
     timestamp = current_time.strftime("%Y%m%d")
-    
+
     doc_name = f"{name} Access Log"
     filename = f"{name.upper()}_{timestamp}.pdf"
-  
-    # Get data for the PDF (from model, queryset, etc.)
-    access_records = AccessRecord.objects.filter(lock__name=name)
-    context = {'access_records': access_records, 'doc_name': doc_name}
-    
-    # Render the HTML template with the data
-    html_template = render(request, 'webapp/report.html', context)
+    if start or end:
+        doc_name = f"{doc_name} ({start or '...'} to {end or '...'})"
+
+    # Every page of a report is held in memory until it is written, see `reports.render_pdf`
+    if reports.access_records(lock, since, until).count() > reports.max_records():
+        return HttpResponse(f"More than {reports.max_records()} records, narrow the range with ?from= and ?to=", status=400)
+
+    # Rendered by a worker process, then served from the artifact cache
+    job = reports.job_id(lock, since, until)
+    status = reports.report_jobs.submit(job, reports.write_report, lock.pk, since, until, doc_name)
+    if status == jobs.DONE:
+        return report_file(job, filename)
+    return redirect(f"{reverse('report_job', args=[job])}?{urlencode({'filename': filename})}")
+
+
+@user_passes_test(group_check(['Admins']))
+@login_required
+def report_job(request, job):
+    filename = get_valid_filename(request.GET.get('filename') or f"{job}.pdf")
+    status = reports.report_jobs.status(job)
+    if status is None:
+        raise Http404
+    if status == jobs.DONE:
+        return report_file(job, filename)
+
+    context = {'job': job, 'status': status, 'filename': filename}
+    if status == jobs.FAILED:
+        context['error'] = reports.report_jobs.error(job)
+        return render(request, 'webapp/report_job.html', context, status=500)
+    # 202 until the file is ready, the page refreshes itself
+    return render(request, 'webapp/report_job.html', context, status=202)
 
-    # Generate the PDF using Weasyprint
-    pdf = HTML(string=html_template.content).write_pdf()
 
-    # Set the response headers for PDF download
-    response = HttpResponse(pdf, content_type='application/pdf')
-    response['Content-Disposition'] = 'filename="{}"'.format(filename)
+@user_passes_test(group_check(['Admins']))
+@login_required
+@read_replica
+def export_access(request):
+    try:
+        since, until = reports.day_bounds(request.GET.get('from'), request.GET.get('to'))
+    except ValueError:
+        return HttpResponse("BAD REQUEST", status=400)
+    export_format = request.GET.get('format', 'csv')
+    if export_format not in exports.FORMATS:
+        return HttpResponse("BAD REQUEST", status=400)
+
+    records = exports.access_records(
+        lock=request.GET.get('lock'),
+        card=request.GET.get('card'),
+        user=request.GET.get('user'),
+        since=since,
+        until=until,
+    )
+    # The rows are read while streaming, after `read_replica` has returned: bind the alias now
+    records = records.using(records.db)
+    return exports.response(records, exports.ACCESS_COLUMNS, exports.access_row, export_format, 'access')
+
 
-    return response
\ No newline at end of file
+@user_passes_test(group_check(['Admins']))
+@login_required
+@read_replica
+def export_activity(request):
+    try:
+        since, until = reports.day_bounds(request.GET.get('from'), request.GET.get('to'))
+    except ValueError:
+        return HttpResponse("BAD REQUEST", status=400)
+    export_format = request.GET.get('format', 'csv')
+    if export_format not in exports.FORMATS:
+        return HttpResponse("BAD REQUEST", status=400)
+
+    records = exports.activity_records(
+        user=request.GET.get('user'),
+        type=request.GET.get('type'),
+        since=since,
+        until=until,
+    )
+    records = records.using(records.db)
+    return exports.response(records, exports.ACTIVITY_COLUMNS, exports.activity_row, export_format, 'activity')
+
+
+@user_passes_test(group_check(['Admins']))
+@login_required
+@read_replica
+def access_stats(request):
+    """Swipes per lock and hour, split by outcome, read from the hourly rollups."""
+    try:
+        since, until = reports.day_bounds(request.GET.get('from'), request.GET.get('to'))
+    except ValueError:
+        return JsonResponse({"status": 0, "message": "BAD REQUEST"}, status=400)
+
+    rollups = AccessRollup.objects.all()
+    if since is not None:
+        rollups = rollups.filter(hour__gte=since)
+    if until is not None:
+        rollups = rollups.filter(hour__lt=until)
+    if request.GET.get('lock'):
+        rollups = rollups.filter(lock__name=request.GET['lock'])
+
+    outcomes = {outcome.value: outcome.name.lower() for outcome in AccessRecord.Outcome}
+    hours = {}
+    rows = rollups.values_list('hour', 'lock__name', 'outcome').annotate(total=Sum('count')).order_by('hour', 'lock__name')
+    for hour, lock_name, outcome, total in rows:
+        entry = hours.get((hour, lock_name))
+        if entry is None:
+            entry = hours[(hour, lock_name)] = {"hour": hour.isoformat(), "lock": lock_name, **dict.fromkeys(outcomes.values(), 0), "unknown": 0}
+        entry[outcomes.get(outcome, "unknown")] += total
+
+    return JsonResponse({"hours": list(hours.values())})
+
+
+@user_passes_test(group_check(['Admins', 'Operators']))
+@login_required
+async def event_stream(request):
+    """Pushes new access and activity records to the dashboard as Server-Sent Events.
+
+    Served by the ASGI application (project/asgi.py) only: every client is a
+    coroutine waiting on the event loop, not a thread. Under WSGI the stream
+    would be buffered whole and hold a worker thread forever.
+    """
+    if not isinstance(request, ASGIRequest):
+        return HttpResponse("Event streams are served by the ASGI application", status=501)
+
+    cursor = events.parse_cursor(request.headers.get('Last-Event-ID') or request.GET.get('last_event_id'))
+    response = StreamingHttpResponse(events.stream(cursor), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # Let nginx pass events through as they come
+    return response
+
+
+@user_passes_test(group_check(['Admins']))
+@login_required
+def metrics_view(request):
+  return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,358 @@
+import atexit
+import glob
+import json
+import logging
+import os
+import queue
+import secrets
+import threading
+import time
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError
+from django.db import OperationalError
+from django.db import close_old_connections
+from django.db import models
+from django.db import transaction
+
+from webapp.models import AccessRecord
+from webapp.models import ActivityRecord
+
+try:
+  import fcntl
+except ImportError:  # Windows: spool files are not locked, see `_claim`
+  fcntl = None
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+  'BUFFERED': True,        # False inserts every row inline, as a plain `create()`
+  'BATCH_SIZE': 200,       # Rows per `bulk_create`
+  'FLUSH_INTERVAL': 1.0,   # Seconds a row may wait in memory before being flushed
+  'QUEUE_SIZE': 10000,     # Rows held in memory before backpressure applies
+  'BACKPRESSURE': 'block', # 'block' waits for room, 'sync' inserts the row inline
+  'BLOCK_TIMEOUT': 2.0,    # Seconds 'block' waits before inserting inline
+  'SPOOL_DIR': None,       # Directory of crash-safe spool files, None disables spooling
+  'FSYNC': False,          # fsync the spool after every row
+  'RETRY_DELAY': 0.5,      # Seconds between attempts while the database is locked
+  'RETRIES': 3,            # Attempts after the first before the rows are deferred to a later flush
+}
+
+
+class WriteBehindLog:
+  """Buffers model rows in memory and inserts them in batches from a writer thread.
+
+  Every row is appended to a per-process spool file before it is queued, and
+  acknowledged there once its batch has been committed. A spool file left
+  behind by a dead process is replayed by the next writer that starts, so rows
+  are delivered at least once across crashes and restarts.
+  """
+
+  def __init__(self, model, setting_name, start_thread=True):
+    self.model = model
+    self.setting_name = setting_name
+    self.start_thread = start_thread
+
+    self._lock = threading.Lock()
+    self._spool_lock = threading.Lock()
+    self._pid = None
+    self._queue = None
+    self._thread = None
+    self._spool = None
+    self._seq = 0
+    self._pending = set()
+    self._deferred_lock = threading.Lock()
+    self._deferred = []
+
+  @property
+  def options(self):
+    return {**DEFAULTS, **getattr(settings, self.setting_name, {})}
+
+  def write(self, **fields):
+    """Records one row, returning as soon as it has been spooled and queued."""
+    options = self.options
+    for field in self.model._meta.concrete_fields:
+      if field.attname not in fields and field.has_default():
+        fields[field.attname] = field.get_default()
+
+    if not options['BUFFERED']:
+      self.model.objects.create(**fields)
+      return
+
+    self._ensure_started(options)
+    with self._spool_lock:
+      seq = self._append(fields, options)
+    try:
+      if options['BACKPRESSURE'] == 'block':
+        self._queue.put((seq, fields), timeout=options['BLOCK_TIMEOUT'])
+      else:
+        self._queue.put_nowait((seq, fields))
+    except queue.Full:
+      self._insert([(seq, fields)])
+
+  def flush(self):
+    """
+    Inserts every row written so far before returning.
+
+    With a writer thread running, the flush is handed to it: it may hold a
+    batch taken off the queue for up to `FLUSH_INTERVAL`, which the calling
+    thread cannot reach. Otherwise the queue is drained from the calling
+    thread.
+    """
+    if self._queue is None:
+      return
+    thread = self._thread
+    if thread is not None and self._pid == os.getpid() and thread.is_alive():
+      done = threading.Event()
+      # Queued behind every row written so far, see `_run`
+      self._queue.put((None, done))
+      while not done.wait(1):
+        if not thread.is_alive():
+          break
+      else:
+        return
+
+    batch = self._take_deferred()
+    while True:
+      try:
+        seq, fields = self._queue.get_nowait()
+      except queue.Empty:
+        break
+      if seq is None:
+        fields.set()  # Handed to a writer thread that died meanwhile
+      else:
+        batch.append((seq, fields))
+    self._insert_batches(batch, self.options['BATCH_SIZE'])
+
+  def replay(self):
+    """Inserts the unacknowledged rows of spool files left behind by dead processes."""
+    spool_dir = self.options['SPOOL_DIR']
+    if not spool_dir:
+      return 0
+    replayed = 0
+    own = self._spool.name if self._spool else None
+    for path in sorted(glob.glob(os.path.join(spool_dir, f'{self._spool_prefix()}-*.spool'))):
+      if path == own:
+        continue
+      with open(path, 'r+', encoding='utf-8') as spool:
+        if not self._claim(spool):
+          continue  # Still owned by a live process
+        rows, acked = {}, set()
+        for line in spool:
+          try:
+            entry = json.loads(line)
+          except ValueError:
+            continue  # Torn write from the crash
+          if 'ack' in entry:
+            acked.update(entry['ack'])
+          else:
+            rows[entry['seq']] = self._decode(entry['row'])
+        missing = [rows[seq] for seq in sorted(rows) if seq not in acked]
+        batch_size = self.options['BATCH_SIZE']
+        for start in range(0, len(missing), batch_size):
+          self._store(missing[start:start + batch_size])
+        os.remove(path)
+        replayed += len(missing)
+    if replayed:
+      logger.warning("Replayed %d %s rows from spool", replayed, self.model.__name__)
+    return replayed
+
+  # ---------------------------------------------------------------------------------
+  # Internals
+  # ---------------------------------------------------------------------------------
+
+  def _ensure_started(self, options):
+    if self._pid == os.getpid():
+      return
+    with self._lock:
+      if self._pid == os.getpid():
+        return
+      # First use in this process (or first use after a fork)
+      self._queue = queue.Queue(maxsize=options['QUEUE_SIZE'])
+      self._seq = 0
+      self._pending = set()
+      self._deferred = []
+      self._spool = self._open_spool(options)
+      if self.start_thread:
+        self._thread = threading.Thread(target=self._run, name=f'{self._spool_prefix()}-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+      self._pid = os.getpid()
+
+  def _spool_prefix(self):
+    return self.model._meta.model_name
+
+  def _open_spool(self, options):
+    if not options['SPOOL_DIR']:
+      return None
+    os.makedirs(options['SPOOL_DIR'], exist_ok=True)
+    # Unique per start: a restarted worker often gets the pid of the one that crashed
+    # (PID 1 in a container), and must replay that file rather than append to it
+    path = os.path.join(options['SPOOL_DIR'], f'{self._spool_prefix()}-{os.getpid()}-{secrets.token_hex(4)}.spool')
+    spool = open(path, 'a', encoding='utf-8')
+    self._claim(spool)
+    return spool
+
+  def _claim(self, spool):
+    """Takes the exclusive lock that marks a spool file as owned by a live process."""
+    if fcntl is None:
+      return self._spool is None or spool.name != self._spool.name
+    try:
+      fcntl.flock(spool.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+      return True
+    except OSError:
+      return False
+
+  def _append(self, fields, options):
+    self._seq += 1
+    if self._spool is not None:
+      self._spool_line({'seq': self._seq, 'row': fields}, options['FSYNC'])
+      self._pending.add(self._seq)
+    return self._seq
+
+  def _spool_line(self, entry, fsync):
+    self._spool.write(json.dumps(entry, cls=DjangoJSONEncoder) + '\n')
+    self._spool.flush()
+    if fsync:
+      os.fsync(self._spool.fileno())
+
+  def _acknowledge(self, seqs):
+    if self._spool is None:
+      return
+    with self._spool_lock:
+      self._pending.difference_update(seqs)
+      if self._pending:
+        self._spool_line({'ack': seqs}, self.options['FSYNC'])
+      else:
+        # Everything spooled so far is committed, start the file over
+        self._spool.truncate(0)
+
+  def _decode(self, row):
+    for field in self.model._meta.concrete_fields:
+      if row.get(field.attname) is not None:
+        row[field.attname] = field.to_python(row[field.attname])
+    return row
+
+  def _take_deferred(self):
+    with self._deferred_lock:
+      deferred, self._deferred = self._deferred, []
+    return deferred
+
+  def _insert(self, batch):
+    """Inserts a batch, returning False when the database stayed unavailable and the batch was deferred."""
+    try:
+      self._store([fields for _, fields in batch])
+    except OperationalError as e:
+      # Left unacknowledged in the spool: retried by the next flush, or replayed after a crash
+      logger.warning("Deferring %d %s rows: %s", len(batch), self.model.__name__, e)
+      with self._deferred_lock:
+        self._deferred.extend(batch)
+      return False
+    self._acknowledge([seq for seq, _ in batch])
+    return True
+
+  def _insert_batches(self, batch, batch_size):
+    for start in range(0, len(batch), batch_size):
+      if not self._insert(batch[start:start + batch_size]):
+        # No point waiting on the database again for every remaining chunk
+        with self._deferred_lock:
+          self._deferred.extend(batch[start + batch_size:])
+        return
+
+  def _store(self, rows):
+    """
+    Inserts rows in one transaction.
+
+    Raises:
+        OperationalError: If the database is still unavailable (typically
+            "database is locked") after `RETRIES` more attempts. The retries
+            are bounded because request threads insert inline when the
+            queue is full.
+    """
+    retries = self.options['RETRIES']
+    for attempt in range(retries + 1):
+      try:
+        with transaction.atomic():
+          self.model.objects.bulk_create([self.model(**fields) for fields in rows])
+        return
+      except IntegrityError:
+        # A referenced row was deleted while these rows waited, keep the ones that are still valid
+        self._store_each(rows)
+        return
+      except OperationalError:
+        if attempt == retries:
+          raise
+        time.sleep(self.options['RETRY_DELAY'])
+
+  def _store_each(self, rows):
+    for fields in rows:
+      try:
+        with transaction.atomic():
+          self.model.objects.create(**fields)
+        continue
+      except IntegrityError as e:
+        error = e
+      detached = self._detach(fields)
+      if detached is not None:
+        try:
+          with transaction.atomic():
+            self.model.objects.create(**detached)
+          continue
+        except IntegrityError as e:
+          error = e
+      logger.error("Discarding %s row %s: %s", self.model.__name__, fields, error)
+
+  def _detach(self, fields):
+    """Nulls the SET_NULL references to rows deleted meanwhile, as their deletion would have done."""
+    detached = dict(fields)
+    for field in self.model._meta.concrete_fields:
+      value = detached.get(field.attname)
+      if value is None or not field.is_relation or field.remote_field.on_delete is not models.SET_NULL:
+        continue
+      if not field.related_model._default_manager.filter(pk=value).exists():
+        detached[field.attname] = None
+    return detached if detached != fields else None
+
+  def _run(self):
+    try:
+      self.replay()
+    except Exception:
+      logger.exception("Could not replay %s spool files", self.model.__name__)
+
+    while True:
+      options = self.options
+      # Deferred rows are retried once per FLUSH_INTERVAL, even if nothing new comes in
+      batch = self._take_deferred()
+      flushes = []  # Events of the `flush()` calls waiting on this batch
+      deadline = None  # Set by the first row, FLUSH_INTERVAL later
+      while len(batch) < options['BATCH_SIZE'] and not flushes:
+        if deadline is None:
+          timeout = options['FLUSH_INTERVAL'] if batch else None
+        else:
+          timeout = deadline - time.monotonic()
+          if timeout <= 0:
+            break
+        try:
+          seq, fields = self._queue.get(timeout=timeout)
+        except queue.Empty:
+          break
+        if deadline is None:
+          deadline = time.monotonic() + options['FLUSH_INTERVAL']
+        if seq is None:
+          flushes.append(fields)  # Every row written before the flush is in the batch by now
+        else:
+          batch.append((seq, fields))
+      try:
+        self._insert_batches(batch, options['BATCH_SIZE'])
+      except Exception:
+        logger.exception("Could not write %d %s rows", len(batch), self.model.__name__)
+      finally:
+        close_old_connections()
+        for done in flushes:
+          done.set()
+
+
+access_log = WriteBehindLog(AccessRecord, 'ACCESS_LOG')
+audit_log = WriteBehindLog(ActivityRecord, 'AUDIT_LOG')